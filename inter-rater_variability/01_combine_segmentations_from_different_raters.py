@@ -3,7 +3,16 @@
 # segmentation using the STAPLE algorithm.
 #
 # Note: since the segmentations are multi-class (i.e., not binary), we need to binaries them. We do this for each
-# spinal level separately.
+# spinal level separately. Alternatively, all the levels can be combined at once using the multi-label STAPLE algorithm
+# (-multi-label).
+#
+# STAPLE is computed with numpy on the union bounding box of the raters' masks (see utilities/staple.py); the results
+# are the same as with SimpleITK (sitk.STAPLE and sitk.MultiLabelSTAPLE, whose float32 computations are reproduced in
+# the same order), which is checked by test_staple.py. With -multi-label-fast, the multi-label STAPLE runs on the
+# bounding box only (much faster, but a few voxels close to a tie between two levels can differ from SimpleITK).
+#
+# Instead of STAPLE, the levels can be combined by majority vote or by a vote weighted by the performance of each rater
+# (-strategy), see utilities/consensus.py. The levels are processed concurrently (-jobs).
 #
 # Example:
 #   python 01_combine_segmentations_from_different_raters.py
@@ -17,11 +26,18 @@
 #
 
 import os
+import sys
 import argparse
 
 import numpy as np
 import SimpleITK as sitk
 
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from staple import multi_label_staple
+from consensus import STRATEGIES, DEFAULT_THRESHOLDS, assemble_levels, compute_consensus, get_rater_performance, \
+    load_performance, save_performance
+
 
 def get_parser():
     """
@@ -46,82 +62,129 @@ def get_parser():
         type=str,
         help='Path to the output. Example: sub-001_T2w_label-rootlet_staple.nii.gz'
     )
+    parser.add_argument(
+        '-multi-label',
+        action='store_true',
+        help='Combine all the levels at once using the multi-label STAPLE algorithm (the voxels with several most '
+             'probable levels are set to 0), instead of running the binary STAPLE algorithm for each level separately.'
+    )
+    parser.add_argument(
+        '-multi-label-fast',
+        action='store_true',
+        help='With -multi-label, run the EM of the multi-label STAPLE on the bounding box of the segmentations only, '
+             'in float64. Much faster, but a few voxels close to a tie between two levels can differ from SimpleITK, '
+             'whose float32 sums go through all the voxels of the image in order.'
+    )
+    parser.add_argument(
+        '-strategy',
+        required=False,
+        choices=STRATEGIES,
+        default='staple',
+        help='Strategy to combine the binarized segmentations of each level: STAPLE, majority vote, or vote weighted by '
+             'the performance (sensitivity and specificity) of each rater from a previous STAPLE run (see -performance). '
+             'Default: staple.'
+    )
+    parser.add_argument(
+        '-threshold',
+        required=False,
+        type=float,
+        help=f'Threshold of the probability maps of the levels. Default: {DEFAULT_THRESHOLDS} (depending on the '
+             f'strategy).'
+    )
+    parser.add_argument(
+        '-performance',
+        required=False,
+        type=str,
+        help='Path to a JSON file with the performance of the raters, used by the weighted strategy. If the file does not '
+             'exist, the performance is estimated by STAPLE (all levels together) and saved to this file. Default: the '
+             'performance is estimated and not saved.'
+    )
+    parser.add_argument(
+        '-jobs',
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help='Number of threads processing the levels. Default: number of CPU cores.'
+    )
 
     return parser
 
 
-def combine_staple(segmentations, fname_out):
+def combine_levels(segmentations, fname_out, strategy='staple', threshold=None, performance=None, jobs=1):
     """
-    Combine several segmentations into a reference segmentation using the STAPLE algorithm.
+    Combine several segmentations into a reference segmentation, level by level (by default, using the STAPLE
+    algorithm).
 
     Note: The segmentations are multi-class (i.e., not binary), with one class per spinal level. 
       Since the STAPLE algorithm expects binary masks, we binarize the 
       segmentations by processing each level separately.
       Finally, since STAPLE produces a probabilistic map, we apply a threshold to obtain 
       the final binary mask.
+      The voxels above the threshold for several levels are assigned to the most probable level (instead of summing
+      the levels into an invalid label, e.g., 2+3=5).
 
     Inspiration: https://simpleitk.org/doxygen/latest/html/classitk_1_1simple_1_1STAPLEImageFilter.html#details
 
     :param segmentations: list of segmentations
     :param fname_out: output file name
+    :param strategy: strategy to combine the binarized segmentations of each level (see consensus.STRATEGIES)
+    :param threshold: threshold of the probability maps; None for the default threshold of the strategy
+    :param performance: (sensitivity, specificity) of the raters used by the weighted strategy
+    :param jobs: number of threads processing the levels
     Returns:
     """
 
-    # Initialize the list for reference segmentations for each level
-    reference_segmentations_all_levels = list()
-
-    # Loop across spinal levels
-    for level in np.unique(sitk.GetArrayFromImage(segmentations[0])):
-        # Skip zero (background)
-        if level == 0:
-            continue
-
-        print(f'Processing level {level} ...')
-        segmentations_current_level = list()
-        # Binarize the segmentations for a specific level
-        for i in range(len(segmentations)):
-            segmentations_current_level.append(sitk.BinaryThreshold(
-                    segmentations[i],
-                    lowerThreshold=int(level),
-                    upperThreshold=int(level),
-                    insideValue=1,
-                    outsideValue=0
-                )
-            )
-
-        # Combine the segmentations for a specific level using STAPLE
-        foregroundValue = 1
-        threshold = 0.95
-        reference_segmentation_STAPLE_probabilities = sitk.STAPLE(
-            segmentations_current_level, foregroundValue
-        )
-
-        # Threshold the probabilities
-        reference_segmentation_current_level = reference_segmentation_STAPLE_probabilities > threshold
-
-        # Change the reference_segmentation_current_level value to the current level to be able to recreate the
-        # multi-class segmentation
-        reference_segmentation_current_level = sitk.Cast(
-            reference_segmentation_current_level,
-            sitk.sitkUInt8
-        ) * level
-
-        # Store the combined segmentation for each level into a list
-        reference_segmentations_all_levels.append(reference_segmentation_current_level)
-
-    # Now, combine the segmentations for each level back into one multi-class file
-    # Initialize the final segmentation
-    final_segmentation = sitk.Image(
-        segmentations[0].GetSize(),
-        sitk.sitkUInt8
-    )
-    final_segmentation.CopyInformation(segmentations[0])
+    data_segmentations = [sitk.GetArrayViewFromImage(segmentation) for segmentation in segmentations]
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS[strategy]
+
+    # Spinal levels, skip zero (background)
+    levels = [int(level) for level in np.unique(data_segmentations[0]) if level != 0]
+    print(f'Processing levels {levels} (strategy: {strategy}, threshold: {threshold}) ...')
+    results = compute_consensus(data_segmentations, levels, strategy, performance, jobs)
+
+    for level, result in results.items():
+        print(f'Level {level}: {result["time"]:.3f} s')
+    print(f'Total time of the levels: {sum(result["time"] for result in results.values()):.3f} s')
 
-    for i in range(len(reference_segmentations_all_levels)):
-        final_segmentation = sitk.Add(
-            final_segmentation,
-            reference_segmentations_all_levels[i]
-        )
+    # Threshold the probabilities and recreate the multi-class segmentation; the voxels above the threshold for several
+    # levels get the most probable level
+    final_segmentation, n_contested = assemble_levels(results, data_segmentations[0].shape, threshold)
+    print(f'Contested voxels (above the threshold for several levels): {n_contested}')
+
+    save_segmentation(final_segmentation, segmentations[0], fname_out)
+
+
+def combine_multi_label_staple(segmentations, fname_out, exact=True):
+    """
+    Combine several segmentations into a reference segmentation using the multi-label STAPLE algorithm, i.e., all the
+    levels are estimated at once and each voxel gets the most probable level.
+
+    Inspiration: https://simpleitk.org/doxygen/latest/html/classitk_1_1simple_1_1MultiLabelSTAPLEImageFilter.html
+
+    :param segmentations: list of segmentations
+    :param fname_out: output file name
+    :param exact: if True, same results as sitk.MultiLabelSTAPLE; if False, faster EM on the bounding box only
+    Returns:
+    """
+    data_segmentations = [sitk.GetArrayViewFromImage(segmentation) for segmentation in segmentations]
+
+    # Voxels with several most probable levels are set to background
+    final_segmentation = multi_label_staple(data_segmentations, undecided_label=0, exact=exact)
+
+    save_segmentation(final_segmentation, segmentations[0], fname_out)
+
+
+def save_segmentation(data, reference, fname_out):
+    """
+    Save the combined segmentation with the header of one of the input segmentations.
+    :param data: numpy array (in the SimpleITK axes order) with the combined segmentation
+    :param reference: SimpleITK image of one of the input segmentations
+    :param fname_out: output file name
+    Returns:
+    """
+    final_segmentation = sitk.GetImageFromArray(data)
+    final_segmentation.CopyInformation(reference)
 
     # Save the reference segmentation
     sitk.WriteImage(
@@ -152,7 +215,25 @@ def main():
         for file_name in full_paths
     ]
 
-    combine_staple(segmentations, args.o)
+    if args.multi_label:
+        combine_multi_label_staple(segmentations, args.o, exact=not args.multi_label_fast)
+        return
+
+    # Performance of the raters for the weighted strategy: from a previous STAPLE run if available
+    performance = None
+    if args.strategy == 'weighted':
+        if args.performance is not None and os.path.exists(args.performance):
+            performance = load_performance(args.performance)
+            print(f'Performance of the raters loaded from {args.performance}.')
+        else:
+            performance = get_rater_performance([sitk.GetArrayViewFromImage(seg) for seg in segmentations])
+            if args.performance is not None:
+                save_performance(args.performance, *performance, raters=full_paths)
+                print(f'Performance of the raters saved as {args.performance}.')
+        print(f'Sensitivity of the raters: {np.round(performance[0], 4)}')
+        print(f'Specificity of the raters: {np.round(performance[1], 4)}')
+
+    combine_levels(segmentations, args.o, args.strategy, args.threshold, performance, args.jobs)
 
 
 if __name__ == '__main__':
@@ -195,11 +195,8 @@ if [[ -f ${file_t2w}.nii.gz ]];then
     python ${PATH_REPO}/inter-rater_variability/02a_rootlets_to_spinal_levels.py -i ${file_t2w}_label-rootlet_staple.nii.gz -s ${file_t2w}_seg.nii.gz -pmj ${file_t2w}_pmj.nii.gz
 
     # Compute f1 and dice scores for each level between the reference STAPLE segmentation and GT segmentations
-    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_rater1.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet_rater1
-    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_rater2.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet_rater2
-    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_rater3.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet_rater3
-    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_rater4.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet_rater4
-    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_nnunet.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet_nnunet
+    # (the STAPLE segmentation and the image are loaded only once for all raters and nnUNet)
+    python ${PATH_REPO}/inter-rater_variability/02b_compute_f1_and_dice.py -gt ${file_t2w}_label-rootlet_staple.nii.gz -pr ${file_t2w}_label-rootlet_rater1.nii.gz ${file_t2w}_label-rootlet_rater2.nii.gz ${file_t2w}_label-rootlet_rater3.nii.gz ${file_t2w}_label-rootlet_rater4.nii.gz ${file_t2w}_label-rootlet_nnunet.nii.gz -im ${file_t2w}.nii.gz -o ${file_t2w}_label-rootlet
 
 fi
 # ------------------------------------------------------------------------------
@@ -22,6 +22,7 @@ Authors: Jan Valosek, Theo Mathieu
 """
 
 import os
+import sys
 import argparse
 import numpy as np
 import pandas as pd
@@ -29,6 +30,12 @@ import pandas as pd
 from argparse import RawTextHelpFormatter
 from spinalcordtoolbox.image import Image, zeros_like
 
+from spinal_levels import rootlets_to_spinal_levels
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from centerline import get_centerline_from_pmj, get_distance_from_pmj, DistanceLookupTable
+
 
 def get_parser():
     """
@@ -71,143 +78,6 @@ def get_parser():
     return parser
 
 
-def get_centerline_from_pmj(fname_seg, fname_pmj):
-    """
-    Generate extrapolated centerline from pontomedullary junction (PMJ).
-    :param fname_seg: spinal cord segmentation
-    :param fname_pmj: PMJ label
-    :return: fname_centerline: path to the CSV file with the extrapolated centerline
-    """
-    # Inspiration: https://github.com/sct-pipeline/pmj-based-csa/blob/e362536a7bef17c0e151830cf777fb51fd09cb87/process_data.sh#L157-L160
-    # Note: -v 2 is used to generate the extrapolated centerline CSV
-    os.system('sct_process_segmentation -i ' + fname_seg + ' -pmj ' + fname_pmj + ' -pmj-distance 50 -v 2')
-    # Remove unnecessary png files and csa.csv
-    os.system('rm -f *.png')
-    os.system('rm -f csa.csv')
-
-    fname_centerline = fname_seg.replace('.nii.gz', '_centerline_extrapolated.csv')
-
-    return fname_centerline
-
-
-def intersect_seg_and_rootlets(im_rootlets, fname_seg, fname_rootlets, dilate_size):
-    """
-    Intersect the spinal cord segmentation and the spinal nerve rootlet segmentation.
-    :param im_rootlets: Image object of the spinal nerve rootlet segmentation
-    :param fname_seg: path to the spinal cord segmentation
-    :param fname_rootlets: path to the spinal nerve rootlet segmentation
-    :param dilate_size: size of spinal cord segmentation dilation in pixels
-    :return: fname_intersect: path to the intersection between the spinal cord segmentation and the spinal nerve
-    rootlet segmentation
-    """
-
-    # Dilate the SC segmentation using sct_maths
-    fname_seg_dil = fname_seg.replace('.nii.gz', '_dil.nii.gz')
-    os.system('sct_maths -i ' + fname_seg + ' -o ' + fname_seg_dil + ' -dilate ' + str(dilate_size))
-
-    # Load the dilated SC segmentation
-    im_seg_dil = Image(fname_seg_dil).change_orientation('RPI')
-    im_seg_dil_data = im_seg_dil.data
-
-    # Intersect the rootlets and the dilated SC segmentation
-    intersect_data = im_rootlets.data * im_seg_dil_data
-
-    # Save the intersection using the Image class
-    im_intersect = zeros_like(im_rootlets)
-    im_intersect.data = intersect_data
-    fname_intersect = fname_rootlets.replace('.nii.gz', '_intersect.nii.gz')
-    im_intersect.save(fname_intersect)
-    print(f'Intersection saved in {fname_intersect}.')
-
-    return fname_intersect
-
-
-def project_rootlets_to_segmentation(im_rootlets, im_seg, im_intersect, rootlets_levels, fname_rootlets):
-    """"
-    Project the nerve rootlets intersection on the spinal cord segmentation
-    :param im_rootlets: Image object of the spinal nerve rootlet segmentation
-    :param im_seg: Image object of the spinal cord segmentation
-    :param im_intersect: Image object of the intersection between the spinal cord segmentation and the spinal nerve
-    rootlet segmentation
-    :param rootlets_levels: list of the spinal nerve rootlets levels
-    :param fname_rootlets: path to the spinal nerve rootlet segmentation
-    :return: fname_spinal_levels: path to the spinal levels segmentation
-    :return: start_end_slices: list of the spinal levels start and end slices
-    """
-    im_spinal_levels_data = np.copy(im_seg.data)
-
-    start_end_slices = dict()
-
-    # Loop across the rootlets levels
-    for level in rootlets_levels:
-        # Get the list of slices where the level is present
-        slices_list = np.unique(np.where(im_intersect.data == level)[2])
-        # Skip the level if it is not present in the intersection
-        if len(slices_list) != 0:
-            min_slice = min(slices_list)
-            max_slice = max(slices_list)
-            start_end_slices[level] = {'start': min_slice, 'end': max_slice}
-            # Color the SC segmentation with the level
-            im_spinal_levels_data[:, :, min_slice:max_slice+1][im_seg.data[:, :, min_slice:max_slice+1] == 1] = level
-
-    # Set zero to the slices with no intersection
-    im_spinal_levels_data[im_spinal_levels_data == 1] = 0
-
-    # Save the projection using the Image class
-    im_spinal_levels = zeros_like(im_rootlets)
-    im_spinal_levels.data = im_spinal_levels_data
-    fname_spinal_levels = fname_rootlets.replace('.nii.gz', '_spinal_levels.nii.gz')
-    im_spinal_levels.save(fname_spinal_levels)
-    print(f'Spinal levels file saved in {fname_spinal_levels}.')
-
-    return fname_spinal_levels, start_end_slices
-
-
-def get_distance_from_pmj(centerline_points, z_index, px, py, pz):
-    """
-    Compute distance from projected pontomedullary junction (PMJ) on centerline and cord centerline.
-    Inspiration: https://github.com/sct-pipeline/pmj-based-csa/blob/419ece49c81782f23405d89c7b4b15d8e03ed4bd/get_distance_pmj_disc.py#L40-L60
-    :param centerline_points: 3xn array: Centerline in continuous coordinate (float) for each slice in RPI orientation.
-    :param z_index: z index PMJ on the centerline.
-    :param px: x pixel size.
-    :param py: y pixel size.
-    :param pz: z pixel size.
-    :return: nd-array: distance from PMJ and corresponding indexes.
-    """
-    length = 0
-    arr_length = [0]
-    for i in range(z_index, 0, -1):
-        distance = np.sqrt(((centerline_points[0, i] - centerline_points[0, i - 1]) * px) ** 2 +
-                           ((centerline_points[1, i] - centerline_points[1, i - 1]) * py) ** 2 +
-                           ((centerline_points[2, i] - centerline_points[2, i - 1]) * pz) ** 2)
-        length += distance
-        arr_length.append(length)
-    arr_length = arr_length[::-1]
-    arr_length = np.stack((arr_length, centerline_points[2][:z_index + 1]), axis=0)
-
-    return arr_length
-
-
-def pmj_dist(centerline_dist, start, end):
-    """
-    Compute the distance between the pontomedullary junction (PMJ) and the start and end of the spinal level
-    :param centerline_dist: distance between the PMJ and the centerline
-    :param start: start slice of the spinal level
-    :param end: end slice of the spinal level
-    :return: dist_start: distance between the PMJ and the start of the spinal level
-    :return: dist_end: distance between the PMJ and the end of the spinal level
-    """
-    if not np.isnan(start):
-        dist_start = float(centerline_dist[0, np.where(centerline_dist[1] == start)])
-    else:
-        dist_start = np.nan
-    if not np.isnan(end):
-        dist_end = float(centerline_dist[0, np.where(centerline_dist[1] == end)])
-    else:
-        dist_end = np.nan
-    return dist_start, dist_end
-
-
 def main():
     # Parse the command line arguments
     parser = get_parser()
@@ -221,22 +91,21 @@ def main():
     im_rootlets = Image(fname_rootlets).change_orientation('RPI')
     im_seg = Image(fname_seg).change_orientation('RPI')
 
-    # Check if the SC seg is binary
-    if len(np.unique(im_seg.data)) != 2:
-        raise ValueError('The spinal cord segmentation should be binary.')
-
-    # Intersect the rootlets and the SC segmentation
-    fname_intersect = intersect_seg_and_rootlets(im_rootlets, fname_seg, fname_rootlets, dilate_size)
+    # Project the nerve rootlets on the spinal cord segmentation to obtain spinal levels
+    im_spinal_levels_data, df_levels = rootlets_to_spinal_levels(im_rootlets.data, im_seg.data,
+                                                                 im_rootlets.hdr.get_best_affine(), dilate_size)
 
-    # Load the intersection
-    im_intersect = Image(fname_intersect).change_orientation('RPI')
+    # Save the projection using the Image class
+    im_spinal_levels = zeros_like(im_rootlets)
+    im_spinal_levels.data = im_spinal_levels_data
+    fname_spinal_levels = fname_rootlets.replace('.nii.gz', '_spinal_levels.nii.gz')
+    im_spinal_levels.save(fname_spinal_levels)
+    print(f'Spinal levels file saved in {fname_spinal_levels}.')
 
     # Get unique values in the rootlets segmentation larger than 0
     rootlets_levels = np.unique(im_rootlets.data[np.where(im_rootlets.data > 0)])
-
-    # Project the nerve rootlets intersection on the spinal cord segmentation to obtain spinal levels
-    fname_spinal_levels, start_end_slices = project_rootlets_to_segmentation(im_rootlets, im_seg, im_intersect,
-                                                                             rootlets_levels, fname_rootlets)
+    start_end_slices = {row.spinal_level: {'start': row.slice_start, 'end': row.slice_end}
+                        for row in df_levels.itertuples()}
 
     if args.pmj:
         fname_pmj = args.pmj
@@ -247,13 +116,16 @@ def main():
             raise ValueError('The PMJ label file is empty.')
 
         # Generate extrapolated centerline from PMJ
-        fname_centerline = get_centerline_from_pmj(fname_seg, fname_pmj)
+        centerline = get_centerline_from_pmj(im_seg.data, im_pmj.data, im_seg.dim[4:7])
 
-        # Load CSV file with centerline coordinates generated by the previous command as an array
-        centerline = np.genfromtxt(fname_centerline, delimiter=',')
+        # Save the centerline as a CSV file (same format as `sct_process_segmentation -pmj ... -v 2`); it is used by
+        # discs_to_vertebral_levels.py
+        fname_centerline = fname_seg.replace('.nii.gz', '_centerline_extrapolated.csv')
+        np.savetxt(fname_centerline, centerline, delimiter=',')
         # Compute distance from PMJ of the centerline
         arr_distance = get_distance_from_pmj(centerline, centerline[2].argmax(), im_pmj.dim[4], im_pmj.dim[5],
                                              im_pmj.dim[6])
+        distance_lookup = DistanceLookupTable(arr_distance)
 
         output_data = list()
         for level in rootlets_levels:
@@ -265,7 +137,8 @@ def main():
                 continue
 
             # Compute the distance between the PMJ and the start and end of the spinal level
-            dist_start, dist_end = pmj_dist(arr_distance, start_end_slices[level]['start'], start_end_slices[level]['end'])
+            dist_start = distance_lookup.get_distance(start_end_slices[level]['start'])
+            dist_end = distance_lookup.get_distance(start_end_slices[level]['end'])
 
             output_data.append({'spinal_level': level,
                                 'fname': fname_rootlets,
@@ -4,7 +4,12 @@ The script does the following:
     - compute mean f1 score across slices for each level
     - compute dice score for each spinal level
     - compute mean dice score across slices for each level
-    - produce PDF report for rootlet segmentation task
+    - produce QC report (PDF or PNG) for rootlet segmentation task; the reports of the levels are generated in
+    parallel
+
+Multiple predictions (e.g., from different raters or models) can be compared against the same ground truth in one run;
+the ground truth and the image are then loaded only once and the results are saved in one table with one row per
+prediction and level.
 
 The script requires the SCT conda environment to be activated:
     source ${SCT_DIR}/python/etc/profile.d/conda.sh
@@ -17,174 +22,240 @@ Usage:
         -im ${file_t2w}.nii.gz
         -o ${file_t2w}_label-rootlet_rater1
 
+    python 02b_compute_f1_and_dice.py
+        -gt ${file_t2w}_label-rootlet_staple.nii.gz
+        -pr ${file_t2w}_label-rootlet_rater1.nii.gz ${file_t2w}_label-rootlet_rater2.nii.gz
+        -im ${file_t2w}.nii.gz
+        -o ${file_t2w}_label-rootlet
+
 OR, the script can be run using a wrapper script 02_run_batch_inter_rater_variability.sh
 
 Authors: Théo MATHIEU, Jan Valosek
 """
 
+import os
+import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from matplotlib.colors import ListedColormap
 from spinalcordtoolbox.image import Image
 
+from qc_report import MARGIN_VOX, get_level_thumbnails, generate_report
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from bbox import get_bbox, get_bbox_offset, crop_to_bbox
+
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Compute f1 and dice scores for each level.')
     parser.add_argument('-gt', required=True, help='Path to the ground truth')
-    parser.add_argument('-pr', required=True, help='Path to the predicted label')
+    parser.add_argument('-pr', required=True, nargs='+',
+                        help='Path(s) to the predicted label(s). With multiple predictions, the GT and the image are '
+                             'loaded once and the results of all predictions are saved in one table (with the '
+                             '"prediction" column).')
     parser.add_argument('-im', required=True, help='Path to the original anatomical T2w image')
-    parser.add_argument('-o', required=True, help='Path to save results')
-    parser.add_argument('-pdf', required=False, action='store_true', help='Save PDF report')
+    parser.add_argument('-o', required=True,
+                        help='Path to save results; "_f1_and_dice_scores.csv" is appended. With multiple predictions, '
+                             'the QC reports are saved in the same folder and named after the predictions.')
+    parser.add_argument('-qc', '-pdf', required=False, nargs='?', const='pdf', choices=['pdf', 'png'],
+                        help='Save QC report for each level: multi-page PDF (default) or PNG. Example: -qc png')
+    parser.add_argument('-jobs', required=False, type=int, default=os.cpu_count(),
+                        help='Number of processes generating the QC reports. Default: number of CPU cores.')
 
     return parser
 
 
-def crop_slice(image_slice, mri):
+def get_level_index(values, levels):
     """
-    Crop the slice around the ROI
+    Get the index of the level of each voxel
     Args:
-        image_slice (np.array): Slice of the segmentation image
-        mri (np.array): Slice of the original image
+        values (np.array): voxel values
+        levels (np.array): sorted levels to evaluate
     Returns:
-        cropped_image_data (np.array): Cropped slice of the segmentation image
-        cropped_mri_data (np.array): Cropped slice of the original image
+        index (np.array): index of the level in levels; len(levels) for the background and the labels which are not
+        evaluated
     """
-    #TODO adapt min max to border
-    min_x = min(np.where(image_slice > 0)[0]) - 5
-    max_x = max(np.where(image_slice > 0)[0]) + 5
-    min_y = min(np.where(image_slice > 0)[1]) - 5
-    max_y = max(np.where(image_slice > 0)[1]) + 5
-    roi_x_start = int(min_x)
-    roi_x_end = int(max_x)
-    roi_y_start = int(min_y)
-    roi_y_end = int(max_y)
-    cropped_image_data = image_slice[roi_x_start:roi_x_end, roi_y_start:roi_y_end]
-    cropped_mri_data = mri[roi_x_start:roi_x_end, roi_y_start:roi_y_end]
-    return cropped_image_data, cropped_mri_data
-
-
-def process_slice(ground_truth, label, mri):
+    index = np.searchsorted(levels, values)
+    found = index < len(levels)
+    found[found] = levels[index[found]] == values[found]
+    return np.where(found, index, len(levels))
+
+
+class LevelConfusionCounter:
     """
-    For each slice create image with TP, TN, FN, FP voxels and compute f1 score.
+    Count the true positive, false positive and false negative voxels of each level in each slice in one pass: the
+    non-zero voxels are encoded as (GT level, predicted level, slice) and counted with np.bincount. The coordinates
+    and the level indices of the GT voxels are computed once, so that many predictions can be evaluated against the
+    same GT.
     Args:
-        ground_truth (np.array): ground truth
-        label (np.array): prediction
-        mri (np.array): background original
+        data_gt (np.array): 3D ground truth with the levels
+        levels (np.array): sorted levels to evaluate; other labels are counted as background
+    """
+    def __init__(self, data_gt, levels):
+        self.data_gt = data_gt
+        self.levels = levels
+        self.n_slices = data_gt.shape[2]
+        self.nonzero_gt = np.nonzero(data_gt > 0)
+        self.index_gt = get_level_index(data_gt[self.nonzero_gt], levels)
+
+    def get_counts(self, data_prediction):
+        """
+        Args:
+            data_prediction (np.array): 3D prediction with the levels (same shape as the GT)
+        Returns:
+            tp (np.array): true positive voxels, shape (number of levels, number of slices)
+            fp (np.array): false positive voxels, shape (number of levels, number of slices)
+            fn (np.array): false negative voxels, shape (number of levels, number of slices)
+        """
+        if data_prediction.shape != self.data_gt.shape:
+            raise ValueError(f'The prediction (shape {data_prediction.shape}) and the GT (shape {self.data_gt.shape}) '
+                             f'must be in the same space.')
+        n_levels = len(self.levels)
+
+        # GT voxels (whatever the prediction)
+        index_prediction = get_level_index(data_prediction[self.nonzero_gt], self.levels)
+        codes_gt = (self.index_gt * (n_levels + 1) + index_prediction) * self.n_slices + self.nonzero_gt[2]
+        # Predicted voxels outside the GT
+        nonzero_prediction = np.nonzero(data_prediction > 0)
+        outside_gt = self.data_gt[nonzero_prediction] == 0
+        index_prediction = get_level_index(data_prediction[nonzero_prediction][outside_gt], self.levels)
+        codes_prediction = (n_levels * (n_levels + 1) + index_prediction) * self.n_slices + \
+            nonzero_prediction[2][outside_gt]
+
+        counts = np.bincount(np.concatenate((codes_gt, codes_prediction)),
+                             minlength=(n_levels + 1) ** 2 * self.n_slices).reshape(n_levels + 1, n_levels + 1,
+                                                                                    self.n_slices)
+        tp = counts[np.arange(n_levels), np.arange(n_levels)]
+        fn = counts[:n_levels].sum(axis=1) - tp
+        fp = counts[:, :n_levels].sum(axis=0) - tp
+
+        return tp, fp, fn
+
+
+def compute_level_metrics(tp, fp, fn):
+    """
+    Compute the metrics of one level from its per-slice confusion counts:
+        - Dice for the entire level and Dice for each slice (NaN for slices without GT and prediction)
+        - slice classes: SP (slice positive: GT and prediction), FN (only GT), FP (only prediction), TN (neither), for
+        the slices from the first to the last slice with GT or prediction (the last slice is excluded)
+        - F1 score for the level: (2 * SP) / (2 * SP + FN + FP), and F1 score for each SP slice (equal to the Dice of
+        the slice)
+    Args:
+        tp (np.array): true positive voxels in each slice
+        fp (np.array): false positive voxels in each slice
+        fn (np.array): false negative voxels in each slice
     Returns:
-        f1 (float): F1 score for the slice
-        cropped_ground_truth_data (np.array): Cropped ground truth around ROI
-        colors (np.array): Image with voxel value specific to TP, FP, TN, FN
-        cropped_mri_data (np.array): Cropped mri around ROI
+        dice_level (float): Dice score for the entire level
+        dict_level (dict): metrics across slices; empty if the level is in neither the GT nor the prediction
+        slice_classes (dict): slices of each class {"SP": [...], "TN": [...], "FN": [...], "FP": [...]}
     """
+    n_gt = tp + fn
+    n_prediction = tp + fp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dice_level = 2 * tp.sum() / (n_gt.sum() + n_prediction.sum())
+        dice_slices = 2 * tp / (n_gt + n_prediction)
+
+    slices = np.flatnonzero((n_gt > 0) | (n_prediction > 0))
+    if len(slices) == 0:
+        return dice_level, dict(), dict()
+    z_slices = np.arange(slices[0], slices[-1])
+
+    in_gt = n_gt[z_slices] > 0
+    in_prediction = n_prediction[z_slices] > 0
+    slice_classes = {"SP": z_slices[in_gt & in_prediction],
+                     "TN": z_slices[~in_gt & ~in_prediction],
+                     "FN": z_slices[in_gt & ~in_prediction],
+                     "FP": z_slices[~in_gt & in_prediction]}
+    n_sp, n_fn, n_fp = len(slice_classes["SP"]), len(slice_classes["FN"]), len(slice_classes["FP"])
 
-    # TODO ADAPT MIN MAX to border
-    min_x = min(min(np.where(ground_truth > 0)[0]), min(np.where(label > 0)[0])) - 5
-    max_x = max(max(np.where(ground_truth > 0)[0]), max(np.where(label > 0)[0])) + 5
-    min_y = min(min(np.where(ground_truth > 0)[1]), min(np.where(label > 0)[1])) - 5
-    max_y = max(max(np.where(ground_truth > 0)[1]), max(np.where(label > 0)[1])) + 5
-    roi_x_start = int(min_x)
-    roi_x_end = int(max_x)
-    roi_y_start = int(min_y)
-    roi_y_end = int(max_y)
-    cropped_ground_truth_data = ground_truth[roi_x_start:roi_x_end, roi_y_start:roi_y_end]
-    cropped_label_data = label[roi_x_start:roi_x_end, roi_y_start:roi_y_end]
-    cropped_mri_data = mri[roi_x_start:roi_x_end, roi_y_start:roi_y_end]
-
-    # Create one mask for each prediction type
-    # True negative
-    tn_mask = np.logical_and(cropped_ground_truth_data == 0, cropped_label_data == 0)
-    # Slice positive
-    sp_mask = np.logical_and(cropped_ground_truth_data > 0, cropped_label_data > 0)
-    # False positive
-    fp_mask = np.logical_and(cropped_ground_truth_data == 0, cropped_label_data > 0)
-    # False negative
-    fn_mask = np.logical_and(cropped_ground_truth_data > 0, cropped_label_data == 0)
-
-    result_img = np.empty(tn_mask.shape)
-    result_img[tn_mask] = 0
-    result_img[sp_mask] = 3
-    result_img[fp_mask] = 2
-    result_img[fn_mask] = 1
     # f1 = (2 * SP) / (2 * SP + FN + FP)
-    f1 = (2 * len(np.where(result_img == 3)[0])) / (2 * len(np.where(result_img == 3)[0]) +
-                                                    len(np.where(result_img == 2)[0]) +
-                                                    len(np.where(result_img == 1)[0]))
+    f1_level = (2 * n_sp) / (2 * n_sp + n_fn + n_fp) if (n_sp + n_fn + n_fp) > 0 else np.nan
+    # The F1 score of a SP slice is the Dice score of the slice
+    f1_slices = dice_slices[slice_classes["SP"]]
+
+    dict_level = {'mean_dice_across_slices': np.mean(dice_slices[z_slices]) if len(z_slices) else np.nan,
+                  'f1_level': f1_level,
+                  'mean_f1_across_slices': np.mean(f1_slices) if len(f1_slices) else np.nan,
+                  'SP': n_sp,
+                  'FP': n_fp,
+                  'TN': len(slice_classes["TN"]),
+                  'FN': n_fn,
+                  }
 
-    return f1, cropped_ground_truth_data, result_img, cropped_mri_data
+    return dice_level, dict_level, slice_classes
 
 
-def compute_dice(ground_truth, prediction):
+def get_prediction_name(fname_prediction):
     """
-    Compute dice score for a slice or a whole level
+    Get the name of the prediction used in the output table, e.g., sub-001_T2w_label-rootlet_rater1
     Args:
-        ground_truth: ground truth
-        prediction: prediction
+        fname_prediction (str): path to the prediction
     Returns:
-        dice: dice score
+        name (str): file name without the extension
     """
-    dice = 2 * np.sum(np.logical_and(ground_truth, prediction)) / (np.sum(ground_truth) + np.sum(prediction))
-
-    return dice
+    return os.path.basename(fname_prediction).replace('.nii.gz', '').replace('.nii', '')
 
 
-def generate_pdf(all_f1, level, fname_out):
+def evaluate_prediction(counter, im_gt_data, im_prediction_data, im_data, executor=None, fname_qc=None,
+                        qc_format='pdf'):
     """
-    Generate pdf with all the slices
+    Compute the metrics of each level of one prediction and submit its QC reports
     Args:
-        all_f1:
-        level:
-        fname_out:
+        counter (LevelConfusionCounter): confusion counter of the GT
+        im_gt_data (np.array): 3D ground truth
+        im_prediction_data (np.array): 3D prediction
+        im_data (np.array): 3D original image
+        executor (ProcessPoolExecutor): executor generating the QC reports; None to skip the QC reports
+        fname_qc (str): output path of the QC reports without extension (the level is appended)
+        qc_format (str): 'pdf' or 'png'
+    Returns:
+        output_data (list): list of dicts (one per level) with the metrics
+        futures (list): futures of the QC reports
     """
+    # Confusion counts of all levels and slices at once
+    tp, fp, fn = counter.get_counts(im_prediction_data)
+
+    z_offset = 0
+    bbox = get_bbox(im_gt_data, im_prediction_data, margin=MARGIN_VOX) if executor is not None else None
+    if bbox is not None:
+        # Work on the union bounding box of the GT and the prediction; the margin keeps the surroundings of the ROI
+        # shown in the QC report. The slice indices are reported in the full volume coordinates.
+        im_gt_data, im_prediction_data, im_data = crop_to_bbox(bbox, im_gt_data, im_prediction_data, im_data)
+        z_offset = get_bbox_offset(bbox)[2]
+
+    output_data = list()
+    futures = list()
+    # Loop over the rootlets levels
+    for i, level in enumerate(counter.levels):
+        print(f"Spinal level: {level}")
+
+        dice_level, dict_level, slice_classes = compute_level_metrics(tp[i], fp[i], fn[i])
+
+        if dict_level:
+            for key, value in slice_classes.items():
+                print(f"{key}: {len(value)}")
+            print(f'f1 score level: {dict_level["f1_level"]}')
+            print(f"Mean f1 across slices: {dict_level['mean_f1_across_slices']}")
+            print(f"Dice level: {dice_level}")
+            print(f"Mean Dice across slices: {dict_level['mean_dice_across_slices']}")
+            print("")
+
+            if executor is not None:
+                gt_level = np.where(im_gt_data == level, 1, 0)
+                prediction_level = np.where(im_prediction_data == level, 1, 0)
+                # The slice classes are in the full volume coordinates
+                slice_classes_crop = {key: value - z_offset for key, value in slice_classes.items()}
+                thumbnails = get_level_thumbnails(gt_level, prediction_level, im_data, slice_classes_crop, z_offset)
+                futures.append(executor.submit(generate_report, thumbnails, level, fname_qc, qc_format))
+
+        # Note: **dict_level is used to unpack the key-value pairs from the metrics dictionary
+        output_data.append({'level': level, 'dice_level': dice_level, **dict_level})
 
-    for type in ["SP", "FP", "FN"]:
-        len_all_f1_type = len(all_f1[type])
-        if len_all_f1_type != 0:
-            fig_width = len(all_f1[type]) * 1.5
-            fig_height = 4
-            if type == "SP":
-                fig, axes = plt.subplots(len_all_f1_type, 3, figsize=(fig_height, fig_width))
-            else:
-                fig, axes = plt.subplots(len_all_f1_type, 3, figsize=(fig_height, fig_width))
-            for i, slice in enumerate(all_f1[type]):
-                if type == "SP":
-                    order = 1
-                    colors_cmap = ['black', 'orange', 'red', 'green']
-                    custom_cmap = ListedColormap(colors_cmap)
-                    axes[i, 2].imshow(all_f1["SP"][slice][2], cmap=custom_cmap)
-                    axes[i, 2].axis('off')
-                    axes[i, 1].set_title(
-                        f'ground_truth|MRI|Pred,slice: {slice}, f1: {all_f1["SP"][slice][0]:.02f}')
-                else:
-                    order = 2
-                    try:
-                        axes[1].set_title(f'Image|MRI,slice: {slice}, type {type}', ha='center')
-                        axes[1].axis("off")
-                    except:
-                        axes[i, 1].set_title(f'Image|MRI,slice: {slice}, type {type}', ha='center')
-                        axes[i, 1].axis("off")
-
-                if len_all_f1_type == 1:
-                    axes[0].imshow(all_f1[type][slice][1], cmap='gray')
-                    axes[0].axis('off')
-                    axes[order].imshow(all_f1[type][slice][3], cmap='gray')
-                    axes[order].axis('off')
-                else:
-                    axes[i, 0].imshow(all_f1[type][slice][1], cmap='gray')
-                    axes[i, 0].axis('off')
-                    axes[i, order].imshow(all_f1[type][slice][3], cmap='gray')
-                    axes[i, order].axis('off')
-
-                # Adjust the layout and display the figure
-            plt.subplots_adjust(wspace=0, hspace=0.2)
-            fname_out = f"{fname_out}_{type}_{level}.pdf"
-            plt.savefig(fname_out, dpi=400, bbox_inches='tight')
-            print(f"pdf generated for {fname_out}")
-        else:
-            # print(f"not possible for {type}")
-            pass
+    return output_data, futures
 
 
 def main():
@@ -192,129 +263,50 @@ def main():
     args = parser.parse_args()
 
     fname_gt = args.gt
-    fname_prediction = args.pr
     fname_imame = args.im
     fname_out = args.o
 
+    # The GT and the image are loaded once for all predictions
     im_image = Image(fname_imame).change_orientation('RPI')
     im_data = im_image.data
 
     im_gt = Image(fname_gt).change_orientation('RPI')
     im_gt_data = im_gt.data
 
-    im_prediction = Image(fname_prediction).change_orientation('RPI')
-    im_prediction_data = im_prediction.data
-
-    output_data = list()
-
     rootlets_levels = np.unique(im_gt_data[np.where(im_gt_data > 0)])
-    # Loop over the rootlets levels
-    for level in rootlets_levels:
-
-        dict_level = dict()
-
-        print(f"Spinal level: {level}")
-
-        # Threshold the GT to keep only the current rootlet level
-        gt_level = np.where(im_gt_data == level, 1, 0)
-        # Get the slices with rootlets for the GT
-        slices_level_gt = np.unique(np.where(gt_level > 0)[2])
-
-        # Threshold the prediction to keep only the current rootlet level
-        prediction_level = np.where(im_prediction_data == level, 1, 0)
-        # Get the slices with rootlets for the prediction
-        slices_level_prediction = np.unique(np.where(prediction_level > 0)[2])
-
-        # Compute the dice score for the entire level
-        dice_level = compute_dice(gt_level, prediction_level)
-
-        len_slices_level_gt = len(slices_level_gt)
-        len_slices_level_prediction = len(slices_level_prediction)
-
-        if len_slices_level_prediction != 0 or len_slices_level_gt != 0:
-            if len_slices_level_prediction == 0:
-                slices_level_prediction = [min(slices_level_gt), max(slices_level_gt)]
-            elif len_slices_level_gt == 0:
-                slices_level_gt = [min(slices_level_prediction), max(slices_level_prediction)]
-
-            dice_list = list()
-            f1_list = list()
-
-            min_val = min(min(slices_level_prediction), min(slices_level_gt))
-            max_val = max(max(slices_level_prediction), max(slices_level_gt))
-            # SP: slice positive - 1 or more voxel similarity (but not 100%) ground truth vs predicted
-            # FN: false negative - only ground truth have voxel labeled
-            # FP: false positive - only prediction have voxel labeled
-            res_dict = {"SP": [[], 0], "TN": [[], 0], "FN": [[], 0], "FP": [[], 0]}
-            all_f1 = {"SP": {}, "FN": {}, "FP": {}}
-
-            # Loop across slices for the current rootlet level
-            for z_slice in range(min_val, max_val):
-
-                # Compute Dice score for the current slice
-                dice_slice = compute_dice(gt_level[:, :, z_slice], prediction_level[:, :, z_slice])
-                dice_list.append(dice_slice)
-
-                # Check if the slice is in the GT
-                if np.any(slices_level_gt == z_slice):
-                    # Check if the slice is in the prediction
-                    if np.any(slices_level_prediction == z_slice):
-                        res_dict["SP"][0].append(z_slice)
-                        res_dict["SP"][1] += 1
-                        f1_slice, ground_truth, pred, base = process_slice(gt_level[:, :, z_slice],
-                                                                           prediction_level[:, :, z_slice],
-                                                                           im_data[:, :, z_slice])
-                        all_f1["SP"][z_slice] = (f1_slice, ground_truth, pred, base)
-                        f1_list.append(f1_slice)
-                    else:
-                        res_dict["FN"][0].append(z_slice)
-                        res_dict["FN"][1] += 1
-                        img, base = crop_slice(gt_level[:, :, z_slice], im_data[:, :, z_slice])
-                        all_f1["FN"][z_slice] = (0, img, 0, base)
-                else:
-                    # Check if the slice is in the prediction
-                    if np.any(slices_level_prediction == z_slice):
-                        res_dict["FP"][0].append(z_slice)
-                        res_dict["FP"][1] += 1
-                        img, base = crop_slice(prediction_level[:, :, z_slice], im_data[:, :, z_slice])
-                        all_f1["FP"][z_slice] = (0, img, 0, base)
-                    else:
-                        res_dict["TN"][0].append(z_slice)
-                        res_dict["TN"][1] += 1
-            for key, value in res_dict.items():
-                print(f"{key}: {value[1]}")
-            # Compute the F1 score for the current rootlet level
-            # f1 = (2 * SP) / (2 * SP + FN + FP)
-            f1_level = (2 * res_dict['SP'][1]) / (2 * res_dict['SP'][1] + res_dict['FN'][1] + res_dict['FP'][1])
-            print(f'f1 score level: {f1_level}')
-
-            # Compute mean f1 score across slices for the current rootlet level
-            mean_f1 = np.mean(f1_list)
-            print(f"Mean f1 across slices: {mean_f1}")
-
-            print(f"Dice level: {dice_level}")
-            # Compute mean Dice score across slices for the current rootlet level
-            mean_dice = np.mean(dice_list)
-            print(f"Mean Dice across slices: {mean_dice}")
-            print("")
-
-            dict_level = {'mean_dice_across_slices': mean_dice,
-                          'f1_level': f1_level,
-                          'mean_f1_across_slices': mean_f1,
-                          'SP': res_dict['SP'][1],
-                          'FP': res_dict['FP'][1],
-                          'TN': res_dict['TN'][1],
-                          'FN': res_dict['FN'][1],
-                          }
-
-            if args.pdf:
-                generate_pdf(all_f1, level, fname_out)
-
-        # Note: **dict_level is used to unpack the key-value pairs from the metrics dictionary
-        output_data.append({'level': level, 'dice_level': dice_level, **dict_level})
-
-    # Create a pandas DataFrame from the parsed data
-    df = pd.DataFrame(output_data)
+    counter = LevelConfusionCounter(im_gt_data, rootlets_levels)
+
+    # The QC reports are generated in the background while the next levels and predictions are processed
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.qc else None
+    list_of_df = list()
+    futures = list()
+
+    # Loop over the predictions
+    for fname_prediction in args.pr:
+        prediction = get_prediction_name(fname_prediction)
+        print(f"Prediction: {fname_prediction}\n")
+
+        im_prediction = Image(fname_prediction).change_orientation('RPI')
+
+        # With multiple predictions, the QC reports are named after the prediction
+        fname_qc = fname_out if len(args.pr) == 1 else os.path.join(os.path.dirname(fname_out), prediction)
+        output_data, futures_prediction = evaluate_prediction(counter, im_gt_data, im_prediction.data, im_data,
+                                                              executor, fname_qc, args.qc)
+        futures += futures_prediction
+
+        df_prediction = pd.DataFrame(output_data)
+        df_prediction.insert(0, 'prediction', prediction)
+        list_of_df.append(df_prediction)
+
+    if executor is not None:
+        for future in futures:
+            fname_report = future.result()
+            if fname_report is not None:
+                print(f"QC report generated for {fname_report}")
+        executor.shutdown()
+
+    # Create a pandas DataFrame from the parsed data; one row per prediction and level
+    df = pd.concat(list_of_df, ignore_index=True)
 
     # Save the DataFrame to a CSV file
     fname_out = f'{fname_out}_f1_and_dice_scores.csv'
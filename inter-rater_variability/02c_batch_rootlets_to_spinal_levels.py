@@ -0,0 +1,204 @@
+"""
+Project the nerve rootlets on the spinal cord segmentation to obtain spinal levels for a whole dataset, in parallel.
+
+This is the batch counterpart of 02a_rootlets_to_spinal_levels.py: instead of running the script once per rootlets
+file (paying the SCT and Python start-up each time), the script finds all rootlets segmentations in a BIDS
+`data_processed` folder (e.g., the output of 02_run_batch_inter_rater_variability.sh) and processes them in a pool of
+processes.
+
+For each rootlets segmentation (`<file>_label-rootlet_<source>.nii.gz`), the spinal cord segmentation
+(`<file>_seg.nii.gz`) and the PMJ label (`<file>_pmj.nii.gz`) are expected in the same folder. If the PMJ label is
+missing, the distances from the PMJ are set to NaN.
+
+The results are saved in one table (CSV and, if pyarrow or fastparquet is installed, Parquet) with one row per
+rootlets file and spinal level, with the subject, session and source (e.g., rater1, nnunet, staple) columns.
+
+The script requires the SCT conda environment to be activated:
+    source ${SCT_DIR}/python/etc/profile.d/conda.sh
+    conda activate venv_sct
+
+Example:
+    python 02c_batch_rootlets_to_spinal_levels.py -i inter-rater_variability_2023-XX-XX/data_processed -o spinal_levels -jobs 8
+"""
+
+import os
+import sys
+import re
+import glob
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from spinalcordtoolbox.image import Image, zeros_like
+
+from spinal_levels import rootlets_to_spinal_levels
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from centerline import get_centerline_from_pmj, get_distance_from_pmj, DistanceLookupTable
+
+# Files generated by this script or 02a_rootlets_to_spinal_levels.py, which must not be taken as rootlets inputs
+EXCLUDED_SUFFIXES = ('_spinal_levels.nii.gz', '_intersect.nii.gz', '_dil.nii.gz')
+
+
+def get_parser():
+    """
+    parser function
+    """
+    parser = argparse.ArgumentParser(
+        description='Project the nerve rootlets on the spinal cord segmentation to obtain spinal levels for all '
+                    'subjects of a BIDS data_processed folder, in parallel. The results are saved in one table.',
+        prog=os.path.basename(__file__)
+    )
+    parser.add_argument(
+        '-i',
+        required=True,
+        help='Path to the data_processed folder.'
+    )
+    parser.add_argument(
+        '-o',
+        required=True,
+        help='Output table without extension; .csv and .parquet files are created. Example: spinal_levels'
+    )
+    parser.add_argument(
+        '-dilate',
+        required=False,
+        type=int,
+        help='Size of spinal cord segmentation dilation in pixels. Default: 3.',
+        default=3,
+    )
+    parser.add_argument(
+        '-jobs',
+        required=False,
+        type=int,
+        help='Number of parallel processes. Default: number of CPU cores.',
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '-save-levels',
+        action='store_true',
+        help='Also save the spinal levels as <rootlets>_spinal_levels.nii.gz next to each rootlets file (as '
+             '02a_rootlets_to_spinal_levels.py does).'
+    )
+
+    return parser
+
+
+def find_inputs(path_data):
+    """
+    Find the rootlets segmentations and the corresponding spinal cord segmentations and PMJ labels
+    :param path_data: path to the data_processed folder
+    :return: list of dicts with the keys subject, session, source, fname_rootlets, fname_seg, fname_pmj (None if
+    missing)
+    """
+    inputs = list()
+    for fname_rootlets in sorted(glob.glob(os.path.join(path_data, '**', '*_label-rootlet_*.nii.gz'),
+                                           recursive=True)):
+        if fname_rootlets.endswith(EXCLUDED_SUFFIXES):
+            continue
+        prefix, source = re.match(r'(.*)_label-rootlet_(.*)\.nii\.gz$', fname_rootlets).groups()
+        fname_seg = prefix + '_seg.nii.gz'
+        fname_pmj = prefix + '_pmj.nii.gz'
+        if not os.path.isfile(fname_seg):
+            print(f'WARNING: Spinal cord segmentation {fname_seg} not found. Skipping {fname_rootlets}.')
+            continue
+
+        # BIDS entities from the file name, e.g., sub-007_ses-headNormal_T2w
+        filename = os.path.basename(prefix)
+        subject = re.search(r'(sub-[a-zA-Z0-9]+)', filename)
+        session = re.search(r'(ses-[a-zA-Z0-9]+)', filename)
+        inputs.append({'subject': subject.group(1) if subject else None,
+                       'session': session.group(1) if session else None,
+                       'source': source,
+                       'fname_rootlets': fname_rootlets,
+                       'fname_seg': fname_seg,
+                       'fname_pmj': fname_pmj if os.path.isfile(fname_pmj) else None})
+    return inputs
+
+
+def process_rootlets(fname_rootlets, fname_seg, fname_pmj, dilate_size, save_levels):
+    """
+    Get the spinal levels and the distances from the PMJ of one rootlets segmentation (run in a worker process)
+    :param fname_rootlets: path to the spinal nerve rootlet segmentation
+    :param fname_seg: path to the spinal cord segmentation
+    :param fname_pmj: path to the PMJ label; None to skip the distances from the PMJ
+    :param dilate_size: size of spinal cord segmentation dilation in pixels
+    :param save_levels: save the spinal levels next to the rootlets file
+    :return: pandas DataFrame with one row per spinal level
+    """
+    im_rootlets = Image(fname_rootlets).change_orientation('RPI')
+    im_seg = Image(fname_seg).change_orientation('RPI')
+
+    data_spinal_levels, df = rootlets_to_spinal_levels(im_rootlets.data, im_seg.data,
+                                                       im_rootlets.hdr.get_best_affine(), dilate_size)
+
+    if save_levels:
+        im_spinal_levels = zeros_like(im_rootlets)
+        im_spinal_levels.data = data_spinal_levels
+        im_spinal_levels.save(fname_rootlets.replace('.nii.gz', '_spinal_levels.nii.gz'))
+
+    df['distance_from_pmj_start'] = np.nan
+    df['distance_from_pmj_end'] = np.nan
+    if fname_pmj is not None:
+        im_pmj = Image(fname_pmj).change_orientation('RPI')
+        centerline = get_centerline_from_pmj(im_seg.data, im_pmj.data, im_seg.dim[4:7])
+        arr_distance = get_distance_from_pmj(centerline, centerline[2].argmax(), im_seg.dim[4], im_seg.dim[5],
+                                             im_seg.dim[6])
+        distance_lookup = DistanceLookupTable(arr_distance)
+        df['distance_from_pmj_start'] = distance_lookup.get_distance(df['slice_start'].to_numpy())
+        df['distance_from_pmj_end'] = distance_lookup.get_distance(df['slice_end'].to_numpy())
+    df['height'] = df['distance_from_pmj_start'] - df['distance_from_pmj_end']
+
+    return df
+
+
+def main():
+    # Parse the command line arguments
+    parser = get_parser()
+    args = parser.parse_args()
+
+    inputs = find_inputs(os.path.expanduser(args.i))
+    if not inputs:
+        raise FileNotFoundError(f'No rootlets segmentation (*_label-rootlet_*.nii.gz) found in {args.i}.')
+    print(f'Found {len(inputs)} rootlets segmentations. Processing with {args.jobs} processes...')
+
+    start = time.time()
+    list_of_df = list()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(process_rootlets, item['fname_rootlets'], item['fname_seg'], item['fname_pmj'],
+                                   args.dilate, args.save_levels): item for item in inputs}
+        for i, future in enumerate(as_completed(futures), start=1):
+            item = futures[future]
+            try:
+                df = future.result()
+            except Exception as e:
+                print(f'[{i}/{len(inputs)}] ERROR: {item["fname_rootlets"]}: {e}')
+                continue
+            df.insert(0, 'subject', item['subject'])
+            df.insert(1, 'session', item['session'])
+            df.insert(2, 'source', item['source'])
+            df.insert(3, 'fname', os.path.basename(item['fname_rootlets']))
+            list_of_df.append(df)
+            print(f'[{i}/{len(inputs)}] {item["fname_rootlets"]}: {len(df)} spinal levels')
+    print(f'Done in {time.time() - start:.1f} s.')
+
+    if not list_of_df:
+        raise RuntimeError('No rootlets segmentation was processed successfully.')
+    df = pd.concat(list_of_df, ignore_index=True).sort_values(['subject', 'session', 'source', 'spinal_level'])
+
+    fname_csv = args.o + '.csv'
+    df.to_csv(fname_csv, index=False)
+    print(f'CSV file saved in {fname_csv}.')
+    fname_parquet = args.o + '.parquet'
+    try:
+        df.to_parquet(fname_parquet, index=False)
+        print(f'Parquet file saved in {fname_parquet}.')
+    except ImportError:
+        print('WARNING: pyarrow or fastparquet is not installed; the Parquet file was not saved.')
+
+
+if __name__ == '__main__':
+    main()
@@ -288,8 +288,17 @@ def main():
     # Loop across CSV files and aggregate the results into pandas dataframe
     for csv_file in csv_files:
         df_file = pd.read_csv(csv_file)
-        # Add column with the fname as the first column
-        df_file.insert(0, 'fname', os.path.basename(csv_file))
+        if 'prediction' in df_file.columns:
+            # One table with all raters (02b_compute_f1_and_dice.py -pr with multiple predictions), e.g.,
+            # sub-007_ses-headNormal_T2w_label-rootlet_rater1
+            df_file.insert(0, 'fname', df_file['prediction'])
+            df_file['rater'] = df_file['prediction'].apply(lambda x: x.split('_')[-1])
+        else:
+            # One table per rater, e.g., sub-007_ses-headNormal_T2w_label-rootlet_rater1_f1_and_dice_scores.csv
+            # Add column with the fname as the first column
+            df_file.insert(0, 'fname', os.path.basename(csv_file))
+            # Extract rater from the fname and add it as a column
+            df_file['rater'] = df_file['fname'].apply(lambda x: x.split('_')[-5])
         parsed_data.append(df_file)
 
     # Combine list of dataframes into one dataframe
@@ -298,8 +307,6 @@ def main():
     # Keep only levels 2 to 8
     df = df[df['level'].isin([2, 3, 4, 5, 6, 7, 8])]
 
-    # Extract rater from the fname and add it as a column
-    df['rater'] = df['fname'].apply(lambda x: x.split('_')[-5])
     # Extract subjectID from the fname and add it as a column
     df['subject'] = df['fname'].apply(lambda x: x.split('_')[0])
 
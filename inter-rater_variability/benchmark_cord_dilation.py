@@ -0,0 +1,105 @@
+"""
+Compare the in-process dilation of the spinal cord segmentation (`dilate_binary()` from spinal_levels.py) with
+`sct_maths -dilate`, which was used by 02a_rootlets_to_spinal_levels.py before.
+
+For each spinal cord segmentation, the script:
+    - runs `sct_maths -i <seg> -dilate <size>` and measures its wall-clock time (including the SCT start-up)
+    - loads the segmentation and dilates it in-process, and measures the time
+    - checks that both dilated masks are identical (regression check)
+
+The script exits with a non-zero code if any of the dilated masks differ.
+
+The script requires the SCT conda environment to be activated:
+    source ${SCT_DIR}/python/etc/profile.d/conda.sh
+    conda activate venv_sct
+
+Example:
+    python benchmark_cord_dilation.py -s sub-001_T2w_seg.nii.gz sub-002_T2w_seg.nii.gz -dilate 3
+"""
+
+import os
+import sys
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nib
+
+from spinal_levels import dilate_binary
+
+
+def get_parser():
+    """
+    parser function
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare the in-process dilation of the spinal cord segmentation with sct_maths -dilate (results '
+                    'and time).',
+        prog=os.path.basename(__file__)
+    )
+    parser.add_argument(
+        '-s',
+        required=True,
+        nargs='+',
+        help='Path(s) to the spinal cord segmentation(s).'
+    )
+    parser.add_argument(
+        '-dilate',
+        required=False,
+        type=int,
+        help='Size of spinal cord segmentation dilation in pixels. Default: 3.',
+        default=3,
+    )
+
+    return parser
+
+
+def main():
+    # Parse the command line arguments
+    parser = get_parser()
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='benchmark_cord_dilation_')
+    results = list()
+    try:
+        for fname_seg in args.s:
+            # sct_maths (separate process)
+            fname_seg_dil = os.path.join(tmpdir, 'seg_dil.nii.gz')
+            start = time.time()
+            subprocess.run(['sct_maths', '-i', fname_seg, '-o', fname_seg_dil, '-dilate', str(args.dilate)],
+                           check=True, stdout=subprocess.DEVNULL)
+            time_sct = time.time() - start
+            data_sct = np.asanyarray(nib.load(fname_seg_dil).dataobj) > 0
+
+            # In-process; the loading of the segmentation is included to compare the same work
+            start = time.time()
+            data_seg = np.asanyarray(nib.load(fname_seg).dataobj)
+            data_dil = dilate_binary(data_seg, args.dilate) > 0
+            time_in_process = time.time() - start
+
+            n_different = int(np.count_nonzero(data_sct != data_dil))
+            results.append((fname_seg, time_sct, time_in_process, n_different))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(f'{"segmentation":>40} | {"sct_maths [s]":>13} | {"in-process [s]":>14} | {"different voxels":>16}')
+    for fname_seg, time_sct, time_in_process, n_different in results:
+        print(f'{os.path.basename(fname_seg):>40} | {time_sct:>13.2f} | {time_in_process:>14.3f} | '
+              f'{n_different:>16}')
+    times_sct = [r[1] for r in results]
+    times_in_process = [r[2] for r in results]
+    print(f'\nMean time per subject: sct_maths {np.mean(times_sct):.2f} s, in-process '
+          f'{np.mean(times_in_process):.3f} s (saving {np.mean(times_sct) - np.mean(times_in_process):.2f} s per '
+          f'subject)')
+
+    if any(r[3] for r in results):
+        print('ERROR: The in-process dilation differs from sct_maths.')
+        sys.exit(1)
+    print('The in-process dilation is identical to sct_maths for all segmentations.')
+
+
+if __name__ == '__main__':
+    main()
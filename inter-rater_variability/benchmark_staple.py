@@ -0,0 +1,120 @@
+"""
+Compare the numpy STAPLE (`staple()` and `multi_label_staple()` from utilities/staple.py) with SimpleITK
+(`sitk.STAPLE` and `sitk.MultiLabelSTAPLE`), which was used by 01_combine_segmentations_from_different_raters.py before.
+
+For the segmentations of the raters of one subject, the script:
+    - runs the binary STAPLE of each level with SimpleITK and numpy, and measures the time of each
+    - checks that the probabilities are the same (up to -tolerance) and that the thresholded masks are identical
+    - runs the multi-label STAPLE with SimpleITK and numpy, measures the time and checks that the labels are identical
+    - runs the fast multi-label STAPLE (`exact=False`, bounding box only) and reports the number of different voxels
+
+The script exits with a non-zero code if any of the results differ, except for the fast multi-label STAPLE (which can
+differ from SimpleITK on a few voxels close to a tie between two labels). See test_staple.py for the same checks on
+synthetic segmentations.
+
+Example:
+    python benchmark_staple.py -i sub-001_T2w_label-rootlet_rater1.nii.gz sub-001_T2w_label-rootlet_rater2.nii.gz
+        sub-001_T2w_label-rootlet_rater3.nii.gz sub-001_T2w_label-rootlet_rater4.nii.gz
+"""
+
+import os
+import sys
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from staple import staple, multi_label_staple
+
+
+def get_parser():
+    """
+    parser function
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare the numpy STAPLE with SimpleITK (results and time).',
+        prog=os.path.basename(__file__)
+    )
+    parser.add_argument(
+        '-i',
+        required=True,
+        nargs='+',
+        help='Paths to the segmentations of the raters of one subject.'
+    )
+    parser.add_argument(
+        '-threshold',
+        required=False,
+        type=float,
+        help='Threshold of the STAPLE probabilities. Default: 0.95.',
+        default=0.95,
+    )
+    parser.add_argument(
+        '-tolerance',
+        required=False,
+        type=float,
+        help='Maximum absolute difference of the STAPLE probabilities. Default: 1e-6.',
+        default=1e-6,
+    )
+
+    return parser
+
+
+def main():
+    # Parse the command line arguments
+    parser = get_parser()
+    args = parser.parse_args()
+
+    segmentations = [sitk.ReadImage(fname, sitk.sitkUInt8) for fname in args.i]
+    data_segmentations = [sitk.GetArrayViewFromImage(segmentation) for segmentation in segmentations]
+
+    results = list()
+    for level in np.unique(data_segmentations[0]):
+        if level == 0:
+            continue
+        # SimpleITK
+        start = time.time()
+        masks = [sitk.BinaryThreshold(segmentation, lowerThreshold=int(level), upperThreshold=int(level),
+                                      insideValue=1, outsideValue=0) for segmentation in segmentations]
+        probabilities_sitk = sitk.GetArrayFromImage(sitk.STAPLE(masks, 1))
+        time_sitk = time.time() - start
+
+        # numpy
+        start = time.time()
+        probabilities, _, _ = staple([data == level for data in data_segmentations])
+        time_numpy = time.time() - start
+
+        max_difference = float(np.nanmax(np.abs(probabilities - probabilities_sitk)))
+        n_different = int(np.count_nonzero((probabilities > args.threshold) != (probabilities_sitk > args.threshold)))
+        results.append((f'level {level}', time_sitk, time_numpy, max_difference, n_different))
+
+    # Multi-label STAPLE
+    start = time.time()
+    labels_sitk = sitk.GetArrayFromImage(sitk.MultiLabelSTAPLE(segmentations, 255))
+    time_sitk = time.time() - start
+    start = time.time()
+    labels = multi_label_staple(data_segmentations, undecided_label=255)
+    time_numpy = time.time() - start
+    results.append(('multi-label', time_sitk, time_numpy, np.nan, int(np.count_nonzero(labels != labels_sitk))))
+    start = time.time()
+    labels_fast = multi_label_staple(data_segmentations, undecided_label=255, exact=False)
+    time_fast = time.time() - start
+    n_different_fast = int(np.count_nonzero(labels_fast != labels_sitk))
+
+    print(f'{"STAPLE":>12} | {"SimpleITK [s]":>13} | {"numpy [s]":>9} | {"max prob. difference":>20} | '
+          f'{"different voxels":>16}')
+    for name, time_sitk, time_numpy, max_difference, n_different in results:
+        print(f'{name:>12} | {time_sitk:>13.3f} | {time_numpy:>9.3f} | {max_difference:>20.2e} | {n_different:>16}')
+    print(f'{"ML fast":>12} | {"":>13} | {time_fast:>9.3f} | {"":>20} | {n_different_fast:>16}')
+    print(f'\nTotal time: SimpleITK {sum(r[1] for r in results):.2f} s, numpy {sum(r[2] for r in results):.2f} s')
+
+    if any(r[4] for r in results) or any(r[3] > args.tolerance for r in results):
+        print('ERROR: The numpy STAPLE differs from SimpleITK.')
+        sys.exit(1)
+    print('The numpy STAPLE is the same as SimpleITK for all levels.')
+
+
+if __name__ == '__main__':
+    main()
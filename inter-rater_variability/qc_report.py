@@ -0,0 +1,193 @@
+"""
+QC report of the rootlets segmentation for 02b_compute_f1_and_dice.py.
+
+For each spinal level, the slices classified as SP (slice positive: GT and prediction), FN (only GT) and FP (only
+prediction) are cropped around the ROI and rendered as thumbnails into one pre-allocated RGB mosaic (one row per
+slice: segmentation | MRI | TP/FP/FN voxels). The mosaic is saved as one raster image per page, so the report stays
+small regardless of the number of slices, and each figure is closed once saved. The reports of the different levels
+are independent and can be generated in a pool of processes (see `generate_report()`).
+
+Example:
+    thumbnails = get_level_thumbnails(gt_level, prediction_level, im_data, slice_classes)
+    generate_report(thumbnails, level, 'sub-001_T2w_label-rootlet_rater1', 'pdf')
+"""
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+# Margin (in voxels) around the ROI of the slices shown in the report
+MARGIN_VOX = 5
+# Size of a voxel in the report (in pixels)
+ZOOM = 4
+# Number of slices per page of the PDF report
+ROWS_PER_PAGE = 20
+# Voxel colors of the TP/FP/FN image: TN (black), FN (orange), FP (red), TP (green)
+COLORS = np.array([[0, 0, 0], [255, 165, 0], [255, 0, 0], [0, 128, 0]], dtype=np.uint8)
+COLUMNS = ['segmentation', 'MRI', 'TP green, FN orange, FP red']
+
+
+def get_roi(*slices):
+    """
+    Get the ROI of the non-zero voxels of one or more 2D slices, with a margin of MARGIN_VOX voxels
+    Args:
+        slices (np.array): 2D slices of the same shape
+    Returns:
+        roi (tuple): tuple of two slices
+    """
+    x, y = np.nonzero(np.logical_or.reduce([s > 0 for s in slices]))
+    shape = slices[0].shape
+    return (slice(max(x.min() - MARGIN_VOX, 0), min(x.max() + MARGIN_VOX, shape[0])),
+            slice(max(y.min() - MARGIN_VOX, 0), min(y.max() + MARGIN_VOX, shape[1])))
+
+
+def crop_slice(image_slice, mri):
+    """
+    Crop the slice around the ROI
+    Args:
+        image_slice (np.array): Slice of the segmentation image
+        mri (np.array): Slice of the original image
+    Returns:
+        cropped_image_data (np.array): Cropped slice of the segmentation image
+        cropped_mri_data (np.array): Cropped slice of the original image
+    """
+    roi = get_roi(image_slice)
+    return image_slice[roi], mri[roi]
+
+
+def process_slice(ground_truth, label, mri):
+    """
+    For each slice create image with TP, TN, FN, FP voxels and compute f1 score.
+    Args:
+        ground_truth (np.array): ground truth
+        label (np.array): prediction
+        mri (np.array): background original
+    Returns:
+        f1 (float): F1 score for the slice
+        cropped_ground_truth_data (np.array): Cropped ground truth around ROI
+        result_img (np.array): Image with voxel value specific to TN (0), FN (1), FP (2), TP (3)
+        cropped_mri_data (np.array): Cropped mri around ROI
+    """
+    roi = get_roi(ground_truth, label)
+    cropped_ground_truth_data = ground_truth[roi] > 0
+    cropped_label_data = label[roi] > 0
+
+    # TN: 0, FN: 1, FP: 2, TP: 3
+    result_img = cropped_ground_truth_data + 2 * cropped_label_data.astype(np.uint8)
+    n_fn = np.count_nonzero(result_img == 1)
+    n_fp = np.count_nonzero(result_img == 2)
+    n_tp = np.count_nonzero(result_img == 3)
+    # f1 = (2 * SP) / (2 * SP + FN + FP)
+    f1 = (2 * n_tp) / (2 * n_tp + n_fp + n_fn)
+
+    return f1, cropped_ground_truth_data.astype(np.uint8), result_img, mri[roi]
+
+
+def get_level_thumbnails(gt_level, prediction_level, im_data, slice_classes, z_offset=0):
+    """
+    Get the thumbnails of the SP, FN and FP slices of a level
+    Args:
+        gt_level (np.array): 3D binary ground truth of the level
+        prediction_level (np.array): 3D binary prediction of the level
+        im_data (np.array): 3D original image
+        slice_classes (dict): slices of each class {"SP": [...], "FN": [...], "FP": [...], ...}
+        z_offset (int): offset added to the slice numbers shown in the report (e.g., when the arrays are cropped)
+    Returns:
+        thumbnails (list): list of (type, slice, f1, segmentation, mri, result_img) tuples; f1 and result_img are None
+        for the FN and FP slices
+    """
+    thumbnails = list()
+    # SP: slice positive - 1 or more voxel similarity (but not 100%) ground truth vs predicted
+    for z_slice in slice_classes["SP"]:
+        f1, ground_truth, result_img, mri = process_slice(gt_level[:, :, z_slice], prediction_level[:, :, z_slice],
+                                                          im_data[:, :, z_slice])
+        thumbnails.append(("SP", z_slice + z_offset, f1, ground_truth, mri, result_img))
+    # FN: false negative - only ground truth have voxel labeled
+    for z_slice in slice_classes["FN"]:
+        img, mri = crop_slice(gt_level[:, :, z_slice], im_data[:, :, z_slice])
+        thumbnails.append(("FN", z_slice + z_offset, None, img, mri, None))
+    # FP: false positive - only prediction have voxel labeled
+    for z_slice in slice_classes["FP"]:
+        img, mri = crop_slice(prediction_level[:, :, z_slice], im_data[:, :, z_slice])
+        thumbnails.append(("FP", z_slice + z_offset, None, img, mri, None))
+
+    return thumbnails
+
+
+def build_mosaic(thumbnails):
+    """
+    Render the thumbnails into one pre-allocated RGB mosaic; one row per slice, one column per image type
+    Args:
+        thumbnails (list): list returned by `get_level_thumbnails()`
+    Returns:
+        mosaic (np.array): RGB uint8 array of shape (number of slices * tile height, 3 * tile width, 3)
+        tile_height (int): height of one row (in pixels)
+    """
+    tile_height = max(t[3].shape[0] for t in thumbnails) * ZOOM
+    tile_width = max(t[3].shape[1] for t in thumbnails) * ZOOM
+    mosaic = np.zeros((len(thumbnails) * tile_height, len(COLUMNS) * tile_width, 3), dtype=np.uint8)
+
+    for row, (_, _, _, segmentation, mri, result_img) in enumerate(thumbnails):
+        mri = mri.astype(float)
+        mri_range = np.ptp(mri)
+        tiles = [np.where(segmentation > 0, 255, 0).astype(np.uint8),
+                 ((mri - mri.min()) / mri_range * 255 if mri_range else np.zeros_like(mri)).astype(np.uint8),
+                 COLORS[result_img] if result_img is not None else None]
+        for column, tile in enumerate(tiles):
+            if tile is None:
+                continue
+            # Gray images are repeated along the RGB channels
+            if tile.ndim == 2:
+                tile = tile[..., np.newaxis]
+            tile = np.repeat(np.repeat(tile, ZOOM, axis=0), ZOOM, axis=1)
+            y = row * tile_height
+            x = column * tile_width
+            mosaic[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+
+    return mosaic, tile_height
+
+
+def generate_report(thumbnails, level, fname_out, fmt='pdf'):
+    """
+    Save the report of a level: one page per ROWS_PER_PAGE slices in a multi-page PDF, or one PNG with all the slices
+    Args:
+        thumbnails (list): list returned by `get_level_thumbnails()`
+        level (int): spinal level
+        fname_out (str): output path without extension; the level and the extension are appended
+        fmt (str): 'pdf' or 'png'
+    Returns:
+        fname_report (str): path to the saved report; None if there is no slice to show
+    """
+    if not thumbnails:
+        return None
+    mosaic, tile_height = build_mosaic(thumbnails)
+    rows_per_page = ROWS_PER_PAGE if fmt == 'pdf' else len(thumbnails)
+    fname_report = f"{fname_out}_{level}.{fmt}"
+
+    pdf = PdfPages(fname_report) if fmt == 'pdf' else None
+    try:
+        for first_row in range(0, len(thumbnails), rows_per_page):
+            rows = thumbnails[first_row:first_row + rows_per_page]
+            page = mosaic[first_row * tile_height:(first_row + len(rows)) * tile_height]
+            # One raster image per page; 100 pixels per inch, plus room for the labels on the left and the title
+            width, height = page.shape[1] / 100 + 2, page.shape[0] / 100 + 0.5
+            fig = plt.figure(figsize=(max(width, 3), height), dpi=100)
+            ax = fig.add_axes((2 / max(width, 3), 0, (width - 2) / max(width, 3), 1 - 0.5 / height))
+            ax.imshow(page, interpolation='nearest')
+            fig.text(0.01, 1, f'Level {level}\n' + ' | '.join(COLUMNS), ha='left', va='top', fontsize=7)
+            ax.axis('off')
+            for i, (slice_type, z_slice, f1, _, _, _) in enumerate(rows):
+                label = f'slice {z_slice}, {slice_type}' + (f', f1: {f1:.02f}' if f1 is not None else '')
+                ax.text(-5, (i + 0.5) * tile_height, label, ha='right', va='center', fontsize=7)
+            if pdf is not None:
+                pdf.savefig(fig)
+            else:
+                fig.savefig(fname_report)
+            plt.close(fig)
+    finally:
+        if pdf is not None:
+            pdf.close()
+
+    return fname_report
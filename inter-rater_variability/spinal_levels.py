@@ -0,0 +1,205 @@
+"""
+Functions to project the nerve rootlets on the spinal cord segmentation to obtain spinal levels.
+
+All functions work on arrays in memory (no intermediate files), so they can be chained in batch drivers. The arrays
+are expected in the RPI orientation (i.e., the third axis goes from inferior to superior).
+
+The spinal cord segmentation is dilated in-process (see `dilate_binary()`), so the functions themselves do not need
+SCT; SCT is used in the example below only to load and reorient the images. `rootlets_to_spinal_levels()` works on
+the union bounding box of the rootlets and the spinal cord segmentation (see `utilities/bbox.py`) and maps the
+results back to the full volume.
+
+Example:
+    from spinalcordtoolbox.image import Image
+    from spinal_levels import rootlets_to_spinal_levels
+
+    im_rootlets = Image('sub-001_T2w_label-rootlet.nii.gz').change_orientation('RPI')
+    im_seg = Image('sub-001_T2w_seg.nii.gz').change_orientation('RPI')
+    data_spinal_levels, df_levels = rootlets_to_spinal_levels(im_rootlets.data, im_seg.data,
+                                                              im_rootlets.hdr.get_best_affine())
+"""
+
+import os
+import sys
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import binary_dilation
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from bbox import get_bbox, get_bbox_offset, crop_to_bbox, uncrop
+
+
+@lru_cache(maxsize=8)
+def get_ball(radius):
+    """
+    Get a ball structuring element; same as `skimage.morphology.ball()` used by `sct_maths -dilate` (default shape)
+    :param radius: radius of the ball in voxels
+    :return: 3D boolean array of shape (2 * radius + 1,) * 3
+    """
+    grid = np.mgrid[-radius:radius + 1, -radius:radius + 1, -radius:radius + 1]
+    ball = np.sum(grid ** 2, axis=0) <= radius ** 2
+    # The cached array is shared between the calls
+    ball.flags.writeable = False
+    return ball
+
+
+def dilate_binary(data, dilate_size):
+    """
+    Dilate a binary mask by a ball; in-process equivalent of `sct_maths -dilate <dilate_size>`. The dilation is
+    computed only inside the bounding box of the mask extended by the dilation size.
+    :param data: 3D array with the binary mask
+    :param dilate_size: radius of the ball in voxels
+    :return: 3D uint8 array with the dilated mask
+    """
+    mask = data > 0
+    data_dil = np.zeros(data.shape, dtype=np.uint8)
+    if not mask.any() or dilate_size < 1:
+        data_dil[mask] = 1
+        return data_dil
+
+    # Bounding box of the mask extended by the dilation size
+    bbox = list()
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        bbox.append(slice(max(int(nonzero[0]) - dilate_size, 0),
+                          min(int(nonzero[-1]) + dilate_size + 1, mask.shape[axis])))
+    bbox = tuple(bbox)
+
+    data_dil[bbox] = binary_dilation(mask[bbox], structure=get_ball(dilate_size))
+    return data_dil
+
+
+def intersect_seg_and_rootlets(data_rootlets, data_seg, dilate_size):
+    """
+    Intersect the spinal cord segmentation and the spinal nerve rootlet segmentation.
+    :param data_rootlets: 3D array with the spinal nerve rootlet segmentation
+    :param data_seg: 3D array with the spinal cord segmentation
+    :param dilate_size: size of spinal cord segmentation dilation in pixels
+    :return: data_intersect: 3D array with the intersection between the dilated spinal cord segmentation and the
+    spinal nerve rootlet segmentation
+    """
+    # Dilate the SC segmentation (same as `sct_maths -dilate`, which uses a ball by default)
+    data_seg_dil = dilate_binary(data_seg, dilate_size)
+
+    # Intersect the rootlets and the dilated SC segmentation
+    return data_rootlets * data_seg_dil
+
+
+def get_level_extents(data_labels):
+    """
+    Get the first and last slice (third axis) of each label in one pass over the volume, using a bincount over
+    (label, slice) pairs of the non-zero voxels
+    :param data_labels: 3D array with labels
+    :return: dict {label: (min_slice, max_slice)}
+    """
+    nonzero = np.nonzero(data_labels)
+    labels, label_indices = np.unique(data_labels[nonzero], return_inverse=True)
+    n_slices = data_labels.shape[2]
+    # presence[i, z] is True if the label i is present in the slice z
+    presence = np.bincount(label_indices.ravel() * n_slices + nonzero[2],
+                           minlength=len(labels) * n_slices).reshape(len(labels), n_slices) > 0
+
+    extents = dict()
+    for label, slices in zip(labels, presence):
+        slices_list = np.flatnonzero(slices)
+        extents[label] = (slices_list[0], slices_list[-1])
+    return extents
+
+
+def project_rootlets_to_segmentation(data_seg, data_intersect, rootlets_levels):
+    """
+    Project the nerve rootlets intersection on the spinal cord segmentation
+    :param data_seg: 3D array with the spinal cord segmentation
+    :param data_intersect: 3D array with the intersection between the spinal cord segmentation and the spinal nerve
+    rootlet segmentation
+    :param rootlets_levels: list of the spinal nerve rootlets levels
+    :return: data_spinal_levels: 3D array with the spinal levels
+    :return: start_end_slices: dict {level: {'start': min_slice, 'end': max_slice}}
+    """
+    # z-extent of all levels at once
+    extents = get_level_extents(data_intersect)
+
+    start_end_slices = dict()
+    # Level of each slice; 1 (i.e., the SC segmentation value) for the slices with no level
+    slice_levels = np.ones(data_seg.shape[2])
+
+    # Loop across the rootlets levels; the slices of overlapping levels get the higher level
+    for level in rootlets_levels:
+        # Skip the level if it is not present in the intersection
+        if level in extents:
+            min_slice, max_slice = extents[level]
+            start_end_slices[level] = {'start': min_slice, 'end': max_slice}
+            slice_levels[min_slice:max_slice+1] = level
+
+    # Color the SC segmentation with the level of each slice (broadcast along the third axis)
+    data_spinal_levels = np.where(data_seg == 1, slice_levels, data_seg).astype(data_seg.dtype)
+
+    # Set zero to the slices with no intersection
+    data_spinal_levels[data_spinal_levels == 1] = 0
+
+    return data_spinal_levels, start_end_slices
+
+
+def get_slice_z(affine, shape, z):
+    """
+    Get the world z-coordinate (in mm) of a slice, taken in the centre of the slice
+    :param affine: 4x4 affine of the image
+    :param shape: shape of the image
+    :param z: slice index
+    :return: z-coordinate in mm
+    """
+    return float((affine @ [(shape[0] - 1) / 2, (shape[1] - 1) / 2, z, 1])[2])
+
+
+def rootlets_to_spinal_levels(data_rootlets, data_seg, affine, dilate_size=3):
+    """
+    Project the nerve rootlets on the spinal cord segmentation to obtain spinal levels.
+    :param data_rootlets: 3D array with the spinal nerve rootlet segmentation (RPI orientation)
+    :param data_seg: 3D array with the binary spinal cord segmentation (RPI orientation)
+    :param affine: 4x4 affine of the images; used to get the z-coordinates (in mm) of the spinal levels
+    :param dilate_size: size of spinal cord segmentation dilation in pixels
+    :return: data_spinal_levels: 3D array with the spinal levels
+    :return: df_levels: pandas DataFrame with one row per spinal level found in the intersection; columns:
+    spinal_level, slice_start, slice_end, z_start, z_end (z-coordinates of the start and end slices in mm)
+    """
+    if data_rootlets.shape != data_seg.shape:
+        raise ValueError(f'The rootlets segmentation (shape {data_rootlets.shape}) and the spinal cord segmentation '
+                         f'(shape {data_seg.shape}) must be in the same space.')
+    # Check if the SC seg is binary
+    if len(np.unique(data_seg)) != 2:
+        raise ValueError('The spinal cord segmentation should be binary.')
+
+    # Work on the union bounding box of the rootlets and the SC segmentation; the dilated SC segmentation outside the
+    # box does not matter because there are no rootlets to intersect there
+    bbox = get_bbox(data_rootlets, data_seg)
+    data_rootlets_crop, data_seg_crop = crop_to_bbox(bbox, data_rootlets, data_seg)
+    z_offset = get_bbox_offset(bbox)[2]
+
+    # Intersect the rootlets and the SC segmentation
+    data_intersect = intersect_seg_and_rootlets(data_rootlets_crop, data_seg_crop, dilate_size)
+
+    # Get unique values in the rootlets segmentation larger than 0
+    rootlets_levels = np.unique(data_rootlets_crop[np.where(data_rootlets_crop > 0)])
+
+    # Project the nerve rootlets intersection on the spinal cord segmentation to obtain spinal levels
+    data_spinal_levels_crop, start_end_slices = project_rootlets_to_segmentation(data_seg_crop, data_intersect,
+                                                                                 rootlets_levels)
+
+    # Map the results back to the full volume
+    data_spinal_levels = uncrop(data_spinal_levels_crop, bbox, data_seg.shape)
+    start_end_slices = {level: {'start': slices['start'] + z_offset, 'end': slices['end'] + z_offset}
+                        for level, slices in start_end_slices.items()}
+
+    df_levels = pd.DataFrame([{'spinal_level': level,
+                               'slice_start': slices['start'],
+                               'slice_end': slices['end'],
+                               'z_start': get_slice_z(affine, data_seg.shape, slices['start']),
+                               'z_end': get_slice_z(affine, data_seg.shape, slices['end'])}
+                              for level, slices in start_end_slices.items()],
+                             columns=['spinal_level', 'slice_start', 'slice_end', 'z_start', 'z_end'])
+
+    return data_spinal_levels, df_levels
@@ -0,0 +1,81 @@
+"""
+Check that the numpy STAPLE (utilities/staple.py) gives the same results as SimpleITK on synthetic segmentations of
+several raters generated with fixed seeds:
+    - binary STAPLE of each level: same probabilities (up to 1e-6), sensitivities and specificities as `sitk.STAPLE`
+    - multi-label STAPLE: identical labels to `sitk.MultiLabelSTAPLE` (exact mode); at most 0.1% of different voxels
+      (fast mode)
+
+Run with pytest or directly:
+    python test_staple.py
+"""
+
+import os
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from staple import staple, multi_label_staple
+
+SEEDS = range(5)
+SHAPE = (60, 40, 40)
+N_RATERS = 4
+LEVELS = range(1, 6)
+
+
+def get_segmentations(seed):
+    """
+    Generate the segmentations of the raters: one block per level along the first axis, shifted by up to one voxel
+    for each rater, with random labels on part of the voxels (more for the last raters)
+    :param seed: seed of the random generator
+    :return: list of uint8 arrays (one per rater), in the SimpleITK axes order
+    """
+    rng = np.random.default_rng(seed)
+    reference = np.zeros(SHAPE, dtype=np.uint8)
+    for i, level in enumerate(LEVELS):
+        reference[5 + 10 * i:15 + 10 * i, 10:30, 12:28] = level
+
+    segmentations = list()
+    for rater in range(N_RATERS):
+        data = np.roll(reference, rng.integers(-1, 2), axis=0)
+        noise = rng.random(SHAPE) < 0.1 * (rater + 1)
+        data[noise] = rng.integers(0, max(LEVELS) + 1, np.count_nonzero(noise))
+        segmentations.append(data)
+    return segmentations
+
+
+def test_binary_staple():
+    for seed in SEEDS:
+        segmentations = get_segmentations(seed)
+        for level in LEVELS:
+            masks = [(data == level).astype(np.uint8) for data in segmentations]
+            staple_filter = sitk.STAPLEImageFilter()
+            staple_filter.SetForegroundValue(1)
+            probabilities_sitk = sitk.GetArrayFromImage(staple_filter.Execute([sitk.GetImageFromArray(mask)
+                                                                               for mask in masks]))
+            probabilities, sensitivity, specificity = staple(masks)
+
+            assert np.abs(probabilities - probabilities_sitk).max() <= 1e-6, (seed, level)
+            assert np.allclose(sensitivity, staple_filter.GetSensitivity(), atol=1e-6), (seed, level)
+            assert np.allclose(specificity, staple_filter.GetSpecificity(), atol=1e-6), (seed, level)
+
+
+def test_multi_label_staple():
+    for seed in SEEDS:
+        segmentations = get_segmentations(seed)
+        labels_sitk = sitk.GetArrayFromImage(sitk.MultiLabelSTAPLE([sitk.GetImageFromArray(data)
+                                                                    for data in segmentations], 255))
+
+        labels = multi_label_staple(segmentations, undecided_label=255)
+        assert np.array_equal(labels, labels_sitk), (seed, np.count_nonzero(labels != labels_sitk))
+
+        labels_fast = multi_label_staple(segmentations, undecided_label=255, exact=False)
+        assert np.count_nonzero(labels_fast != labels_sitk) <= 1e-3 * labels_sitk.size, seed
+
+
+if __name__ == '__main__':
+    test_binary_staple()
+    test_multi_label_staple()
+    print('The numpy STAPLE is the same as SimpleITK.')
@@ -0,0 +1,107 @@
+"""
+Benchmark the throughput of the sliding-window inference for different numbers of tiles evaluated in one forward pass
+(tile batch size).
+
+For each tile batch size, the script reports:
+    - the time and throughput (tiles/s) when the images are predicted one after another
+    - the time and throughput when the tiles of all images are batched together (only if more than one image is
+    provided)
+The speed-up is reported relative to the tile batch size of 1 (i.e., the default nnUNet behaviour).
+
+The images are preprocessed (resampled and normalized) only once, so the reported times include only the network
+evaluation and the aggregation of the tiles.
+
+Note: conda environment with nnUNetV2 is required to run this script.
+
+Example:
+    python benchmark_tile_batching.py
+        -i sub-001_T2w.nii.gz sub-002_T2w.nii.gz
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -fold 0
+        -tile-batch-sizes 1 2 4 8
+"""
+
+import os
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from run_inference_single_subject import load_predictor
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark the sliding-window inference for different tile batch '
+                                                 'sizes.')
+    parser.add_argument('-i', nargs='+', required=True,
+                        help='Input image(s). Example: sub-001_T2w.nii.gz sub-002_T2w.nii.gz')
+    parser.add_argument('-path-model', required=True, type=str,
+                        help='Path to the model folder. This folder should contain individual folders like fold_0, '
+                             'fold_1, etc. and dataset.json, dataset_fingerprint.json and plans.json files.')
+    parser.add_argument('-fold', type=str, required=True, choices=['0', '1', '2', '3', '4', 'all'],
+                        help='Fold to use for inference.')
+    parser.add_argument('-tile-batch-sizes', nargs='+', type=int, default=[1, 2, 4, 8],
+                        help='Tile batch sizes to benchmark. Default: 1 2 4 8')
+    parser.add_argument('-tile-step-size', default=0.5, type=float,
+                        help='Tile step size defining the overlap between images patches during inference. '
+                             'Default: 0.5')
+    parser.add_argument('-use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    folds_avail = 'all' if args.fold == 'all' else [int(args.fold)]
+    predictor = load_predictor(args.path_model, folds_avail, use_gpu=args.use_gpu,
+                               tile_step_size=args.tile_step_size)
+    predictor.allow_tqdm = False
+
+    # Preprocess the images only once
+    preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+    list_of_data = list()
+    for fname in args.i:
+        data, _, _ = preprocessor.run_case([os.path.expanduser(fname)], None, predictor.plans_manager,
+                                           predictor.configuration_manager, predictor.dataset_json)
+        list_of_data.append(torch.from_numpy(data))
+        print(f'Preprocessed {fname}: shape {data.shape[1:]}')
+
+    n_tiles = sum(len(predictor._internal_get_sliding_window_slicers(data.shape[1:])) for data in list_of_data)
+    print(f'Number of tiles: {n_tiles} (patch size: {predictor.configuration_manager.patch_size}, '
+          f'automatic tile batch size: {predictor.get_tile_batch_size()})\n')
+
+    results = list()
+    with torch.inference_mode():
+        for tile_batch_size in args.tile_batch_sizes:
+            predictor.tile_batch_size = tile_batch_size
+
+            start = time.time()
+            for data in list_of_data:
+                predictor.predict_logits_from_preprocessed_data(data)
+            time_per_subject = time.time() - start
+
+            time_across_subjects = np.nan
+            if len(list_of_data) > 1:
+                start = time.time()
+                predictor.predict_logits_from_preprocessed_list(list_of_data)
+                time_across_subjects = time.time() - start
+
+            results.append((tile_batch_size, time_per_subject, time_across_subjects))
+
+    # Reference: tile batch size of 1 (or the smallest benchmarked batch size)
+    time_reference = min(results)[1]
+    print(f'{"tile batch size":>15} | {"per subject [s]":>15} | {"tiles/s":>8} | {"speed-up":>8} | '
+          f'{"across subjects [s]":>19} | {"tiles/s":>8} | {"speed-up":>8}')
+    for tile_batch_size, time_per_subject, time_across_subjects in results:
+        print(f'{tile_batch_size:>15} | {time_per_subject:>15.2f} | {n_tiles / time_per_subject:>8.2f} | '
+              f'{time_reference / time_per_subject:>8.2f} | {time_across_subjects:>19.2f} | '
+              f'{n_tiles / time_across_subjects:>8.2f} | {time_reference / time_across_subjects:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
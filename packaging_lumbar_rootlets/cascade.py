@@ -0,0 +1,67 @@
+"""
+Functions for the coarse-to-fine (cascade) inference.
+
+In the cascade mode, the same nnUNet model is first run at a coarser spacing (the target spacing of the model
+multiplied by a factor) to localize the rootlets. The full-resolution inference is then run only inside the region of
+interest (ROI) around the coarse prediction.
+"""
+
+from contextlib import contextmanager
+
+import numpy as np
+
+
+@contextmanager
+def coarse_spacing(predictor, factor):
+    """
+    Temporarily multiply the target spacing of the nnUNet configuration by a factor. Both the preprocessing (resampling
+    to the target spacing) and the export (resampling back to the original spacing) use the modified spacing, so the
+    prediction is returned in the original image space.
+    :param predictor: initialized nnUNetPredictor
+    :param factor: spacing factor, for example 2 (i.e., half resolution)
+    """
+    configuration = predictor.configuration_manager.configuration
+    spacing = configuration['spacing']
+    configuration['spacing'] = [s * factor for s in spacing]
+    try:
+        yield
+    finally:
+        configuration['spacing'] = spacing
+
+
+def get_roi_from_prediction(data, margin_vox):
+    """
+    Get the bounding box of the non-zero voxels of the prediction extended by a margin
+    :param data: 3D array with the (coarse) prediction
+    :param margin_vox: margin (in voxels) for each axis
+    :return: bbox: tuple of three slices; None if the prediction is empty
+    """
+    if not np.any(data):
+        return None
+
+    bbox = list()
+    for axis in range(data.ndim):
+        other_axes = tuple(a for a in range(data.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(data, axis=other_axes))
+        start = max(int(nonzero[0]) - margin_vox[axis], 0)
+        stop = min(int(nonzero[-1]) + margin_vox[axis] + 1, data.shape[axis])
+        bbox.append(slice(start, stop))
+
+    return tuple(bbox)
+
+
+def dice_per_label(data_1, data_2):
+    """
+    Compute the Dice score between two multi-class segmentations for each label
+    :param data_1: 3D array with the first segmentation
+    :param data_2: 3D array with the second segmentation
+    :return: dict {label: dice}
+    """
+    labels = np.union1d(np.unique(data_1), np.unique(data_2))
+    dice = dict()
+    for label in labels[labels > 0]:
+        mask_1 = data_1 == label
+        mask_2 = data_2 == label
+        dice[int(label)] = 2 * np.sum(mask_1 & mask_2) / (np.sum(mask_1) + np.sum(mask_2))
+
+    return dice
@@ -0,0 +1,126 @@
+"""
+Guards for the inference jobs: memory estimate, wall-clock timeout and cooperative cancellation.
+
+The memory needed by the nnUNet inference is estimated before the inference starts (from the image size, the target
+spacing and the number of classes and folds of the model), so that an oversized job can be refused or split into
+slabs instead of being killed by the OOM killer.
+
+`JobGuard` is checked by the predictor between the batches of sliding-window tiles (see `predictor.py`); when the
+job is cancelled (SIGTERM/SIGINT) or runs out of time, `JobCancelled` is raised and the caller cleans up.
+"""
+
+import signal
+import threading
+import time
+
+import numpy as np
+
+
+class JobCancelled(Exception):
+    """
+    Raised when the inference job is cancelled. Not a RuntimeError: nnUNet catches RuntimeError around the GPU
+    sliding-window prediction (as a lack of memory) and runs the prediction again on CPU.
+    """
+
+
+class JobTimeout(JobCancelled):
+    """
+    Raised when the inference job exceeds its wall-clock timeout
+    """
+
+
+class JobGuard:
+    """
+    Wall-clock timeout and cooperative cancellation of an inference job
+    :param timeout: timeout in seconds; None for no timeout
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check(self):
+        """
+        Raise an exception if the job was cancelled or timed out
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled('The inference job was cancelled')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise JobTimeout(f'The inference job exceeded the timeout of {self.timeout} s')
+
+    def install_signal_handlers(self):
+        """
+        Cancel the job on SIGTERM and SIGINT (Ctrl+C). The job stops at the next check; a second signal interrupts
+        the job immediately.
+        """
+        def handler(signum, frame):
+            if self.cancelled.is_set():
+                raise KeyboardInterrupt
+            print(f'\nReceived signal {signum}, cancelling the inference job...')
+            self.cancel()
+
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, handler)
+
+
+def estimate_memory(predictor, shape, zooms):
+    """
+    Estimate the peak memory (in bytes) of the nnUNet inference of an image:
+        - the resampled image (and its padded copy), float32
+        - the logits (one array per class, float16) and the weights of the sliding-window aggregation; the folds are
+        accumulated, so multiple folds only add one more logits array
+        - the export: logits resampled back to the original image shape and the probabilities, float32
+        - the model weights of all folds and the batch of tiles
+    :param predictor: initialized BatchedTilePredictor
+    :param shape: shape of the image
+    :param zooms: voxel size of the image (mm)
+    :return: estimated memory in bytes
+    """
+    # The number of voxels after resampling does not depend on the order of the axes (transpose in the plans)
+    target_spacing = predictor.configuration_manager.spacing
+    n_voxels = int(np.prod(shape))
+    n_voxels_resampled = int(np.prod(shape) * np.prod(zooms[:3]) / np.prod(target_spacing))
+    n_classes = predictor.label_manager.num_segmentation_heads
+    n_folds = len(predictor.list_of_parameters)
+
+    memory = 2 * n_voxels_resampled * 4
+    memory += n_voxels_resampled * n_classes * 2 * (2 if n_folds > 1 else 1)
+    memory += n_voxels_resampled * 2
+    memory += 2 * n_voxels * n_classes * 4
+    memory += get_fixed_memory(predictor)
+
+    return memory
+
+
+def get_fixed_memory(predictor):
+    """
+    Memory (in bytes) which does not depend on the image size: the model weights of all folds and the batch of tiles.
+    The automatic tile batch size is estimated during the inference from the memory left after the volume buffers, so
+    only one tile is counted then; an explicit tile batch size is counted in full.
+    :param predictor: initialized BatchedTilePredictor
+    :return: memory in bytes
+    """
+    n_params = sum(p.numel() for p in predictor.network.parameters())
+    tile_batch_size = predictor.tile_batch_size if predictor.tile_batch_size is not None else 1
+    return n_params * 4 * len(predictor.list_of_parameters) + predictor.estimate_tile_memory() * tile_batch_size
+
+
+def get_number_of_slabs(predictor, shape, zooms, budget, margin_vox):
+    """
+    Get the smallest number of slabs (along the third axis) for which the inference of one slab fits into the memory
+    budget
+    :param predictor: initialized BatchedTilePredictor
+    :param shape: shape of the image
+    :param zooms: voxel size of the image (mm)
+    :param budget: memory budget in bytes
+    :param margin_vox: margin (in voxels) added on both sides of each slab
+    :return: number of slabs; None if even one-slice slabs do not fit into the budget
+    """
+    for n_slabs in range(1, shape[2] + 1):
+        thickness = min(int(np.ceil(shape[2] / n_slabs)) + 2 * margin_vox, shape[2])
+        if estimate_memory(predictor, (shape[0], shape[1], thickness), zooms) <= budget:
+            return n_slabs
+    return None
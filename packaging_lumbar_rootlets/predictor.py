@@ -0,0 +1,384 @@
+"""
+nnUNetPredictor wrapper evaluating several sliding-window tiles in one batched forward pass.
+
+nnUNet evaluates the sliding-window tiles one at a time (batch size 1), which under-uses the CPU (SIMD, caches) for
+small patch sizes. `BatchedTilePredictor` groups K tiles into one forward pass. K is either given explicitly or
+estimated from the available memory (RAM for CPU, free GPU memory for CUDA) and the network architecture in the plans.
+
+`BatchedTilePredictor.predict_logits_from_preprocessed_list()` additionally batches tiles from several images (e.g.,
+several subjects) together, so the last, partially filled batch of one image is completed with tiles of the next one.
+Note: this is an API for a batch driver processing several subjects in one process; run_inference_single_subject.py
+and run_inference_server.py segment one image at a time and only use the per-image batching. The cross-subject batching
+is currently only exercised by benchmark_tile_batching.py.
+
+`PooledBufferPredictor` is meant for a warm process running many predictions one after another: it memoizes the
+Gaussian importance maps and reuses the full-volume accumulation buffers across subjects of similar shape.
+
+The results are identical to nnUNetPredictor (up to floating point differences), only the tiles are evaluated in
+batches.
+"""
+
+import os
+
+import numpy as np
+import torch
+from torch._dynamo import OptimizedModule
+from tqdm import tqdm
+
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import empty_cache, dummy_context
+
+# Fraction of the available memory that can be used by a batch of tiles
+MEMORY_FRACTION = 0.5
+# Upper bound of the automatically estimated batch size
+MAX_TILE_BATCH_SIZE = 16
+
+
+def get_available_memory(device):
+    """
+    Get the available memory in bytes
+    :param device: torch.device
+    :return: available memory in bytes
+    """
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    # Linux: MemAvailable also counts the memory which can be reclaimed (e.g., page cache)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+class BatchedTilePredictor(nnUNetPredictor):
+    """
+    nnUNetPredictor evaluating K sliding-window tiles in one forward pass.
+    :param tile_batch_size: number of tiles in one forward pass; None to estimate it from the available memory
+    :param job_guard: optional JobGuard (see `job_guard.py`) checked between the batches of tiles
+    All other parameters are passed to nnUNetPredictor.
+    """
+    def __init__(self, *args, tile_batch_size=None, job_guard=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tile_batch_size = tile_batch_size
+        self.job_guard = job_guard
+
+    def estimate_tile_memory(self):
+        """
+        Rough estimate of the memory (in bytes) needed to evaluate one tile: the activations of each stage of the
+        network (kept for the skip connections plus the working copies of convolution and normalization) and the
+        logits.
+        """
+        patch_voxels = int(np.prod(self.configuration_manager.patch_size))
+        arch_kwargs = self.configuration_manager.network_arch_init_kwargs
+        features_per_stage = arch_kwargs['features_per_stage']
+        strides = arch_kwargs['strides']
+
+        n_elements = 0
+        downsampling = np.ones(len(self.configuration_manager.patch_size))
+        for features, stride in zip(features_per_stage, strides):
+            downsampling = downsampling * np.array(stride)
+            n_elements += 3 * features * patch_voxels / np.prod(downsampling)
+        n_elements += self.label_manager.num_segmentation_heads * patch_voxels
+
+        # float32 activations; a second copy of the input/logits when mirroring
+        return int(n_elements * 4 * (2 if self.use_mirroring else 1))
+
+    def get_tile_batch_size(self):
+        """
+        Get the number of tiles evaluated in one forward pass
+        :return: tile batch size
+        """
+        if self.tile_batch_size is not None:
+            return self.tile_batch_size
+        available = get_available_memory(self.device) * MEMORY_FRACTION
+        return int(np.clip(available // self.estimate_tile_memory(), 1, MAX_TILE_BATCH_SIZE))
+
+    def _internal_predict_sliding_window_return_logits(self, data, slicers, do_on_device=True):
+        # Same as nnUNetPredictor._internal_predict_sliding_window_return_logits, but the tiles are evaluated in
+        # batches of `tile_batch_size`
+        return self._internal_predict_sliding_window_return_logits_list([data], [slicers], do_on_device)[0]
+
+    def _internal_predict_sliding_window_return_logits_list(self, list_of_data, list_of_slicers,
+                                                            do_on_device=True):
+        """
+        Sliding-window prediction of several (padded) images with tiles from all images grouped into batches
+        :param list_of_data: list of torch.Tensor (c, x, y, z)
+        :param list_of_slicers: list of the sliding-window slicers for each image
+        :param do_on_device: keep the results on the device
+        :return: list of predicted logits (one per image)
+        """
+        list_of_logits = list_of_n_predictions = prediction = gaussian = workon = None
+        results_device = self.device if do_on_device else torch.device('cpu')
+
+        try:
+            empty_cache(self.device)
+
+            # move data to device and preallocate results arrays
+            list_of_data = [data.to(results_device) for data in list_of_data]
+            list_of_logits = [self._allocate_buffer((self.label_manager.num_segmentation_heads, *data.shape[1:]),
+                                                    torch.half, results_device) for data in list_of_data]
+            list_of_n_predictions = [self._allocate_buffer(data.shape[1:], torch.half, results_device)
+                                     for data in list_of_data]
+
+            gaussian = self._get_gaussian(results_device) if self.use_gaussian else 1
+
+            # (image index, slicer) for all tiles of all images
+            tiles = [(i, sl) for i, slicers in enumerate(list_of_slicers) for sl in slicers]
+            tile_batch_size = self.get_tile_batch_size()
+            if self.verbose:
+                print(f'running prediction: {len(tiles)} tiles in batches of {tile_batch_size}')
+
+            for start in tqdm(range(0, len(tiles), tile_batch_size), disable=not self.allow_tqdm):
+                # Stop between tiles if the job was cancelled or timed out
+                if self.job_guard is not None:
+                    self.job_guard.check()
+                batch = tiles[start:start + tile_batch_size]
+                workon = torch.stack([list_of_data[i][sl] for i, sl in batch]).to(self.device)
+
+                prediction = self._internal_maybe_mirror_and_predict(workon).to(results_device)
+
+                for (i, sl), tile_prediction in zip(batch, prediction):
+                    if self.use_gaussian:
+                        tile_prediction *= gaussian
+                    list_of_logits[i][sl] += tile_prediction
+                    list_of_n_predictions[i][sl[1:]] += gaussian
+
+            for logits, n_predictions in zip(list_of_logits, list_of_n_predictions):
+                logits /= n_predictions
+                self._release_buffer(n_predictions)
+                # check for infs
+                if torch.any(torch.isinf(logits)):
+                    raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
+                                       'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
+                                       'predicted_logits to fp32')
+        except Exception as e:
+            for buffer in (list_of_logits or []) + (list_of_n_predictions or []):
+                self._release_buffer(buffer)
+            del list_of_logits, list_of_n_predictions, prediction, gaussian, workon
+            empty_cache(self.device)
+            empty_cache(results_device)
+            raise e
+        return list_of_logits
+
+    def _predict_sliding_window_list(self, list_of_data, list_of_slicers):
+        """
+        Sliding-window prediction of several (padded) images with the same fallback as
+        nnUNetPredictor.predict_sliding_window_return_logits: if the prediction with the results arrays on the device
+        fails (usually out of memory), it is run again with the results arrays on CPU
+        :param list_of_data: list of torch.Tensor (c, x, y, z)
+        :param list_of_slicers: list of the sliding-window slicers for each image
+        :return: list of predicted logits (one per image)
+        """
+        if self.perform_everything_on_device and self.device.type != 'cpu':
+            try:
+                return self._internal_predict_sliding_window_return_logits_list(list_of_data, list_of_slicers, True)
+            except RuntimeError:
+                print('Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays '
+                      'to CPU')
+                empty_cache(self.device)
+        return self._internal_predict_sliding_window_return_logits_list(list_of_data, list_of_slicers, False)
+
+    @torch.inference_mode()
+    def predict_logits_from_preprocessed_list(self, list_of_data):
+        """
+        Predict the logits of several preprocessed images (e.g., several subjects) with sliding-window tiles from all
+        images grouped into batches. Multiple folds are averaged as in `predict_logits_from_preprocessed_data()`,
+        with the same limit on the number of torch threads and the same fallback to CPU results arrays.
+        :param list_of_data: list of preprocessed torch.Tensor (c, x, y, z)
+        :return: list of predicted logits (on CPU), one per image
+        """
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(min(default_num_processes, n_threads))
+        try:
+            return self._predict_logits_from_preprocessed_list(list_of_data)
+        finally:
+            torch.set_num_threads(n_threads)
+
+    def _predict_logits_from_preprocessed_list(self, list_of_data):
+        self.network = self.network.to(self.device)
+        self.network.eval()
+
+        # Pad the images and get the sliding-window slicers
+        list_of_padded, list_of_revert_padding, list_of_slicers = list(), list(), list()
+        for data in list_of_data:
+            padded, slicer_revert_padding = pad_nd_image(data, self.configuration_manager.patch_size,
+                                                         'constant', {'value': 0}, True, None)
+            list_of_padded.append(padded)
+            list_of_revert_padding.append(slicer_revert_padding)
+            list_of_slicers.append(self._internal_get_sliding_window_slicers(padded.shape[1:]))
+
+        predictions = None
+        for params in self.list_of_parameters:
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+
+            # Autocast is only used on CUDA (see nnUNetPredictor.predict_sliding_window_return_logits)
+            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+                list_of_logits = self._predict_sliding_window_list(list_of_padded, list_of_slicers)
+            list_of_logits_cpu = list()
+            for logits in list_of_logits:
+                logits_cpu = logits.to('cpu')
+                if logits_cpu is not logits:
+                    self._release_buffer(logits)
+                list_of_logits_cpu.append(logits_cpu)
+
+            if predictions is None:
+                predictions = list_of_logits_cpu
+            else:
+                for prediction, logits in zip(predictions, list_of_logits_cpu):
+                    prediction += logits
+                    self._release_buffer(logits)
+
+        if len(self.list_of_parameters) > 1:
+            for prediction in predictions:
+                prediction /= len(self.list_of_parameters)
+
+        # Revert padding
+        return [self._detach_buffer(prediction, (slice(None), *slicer_revert_padding[1:]))
+                for prediction, slicer_revert_padding in zip(predictions, list_of_revert_padding)]
+
+    def _get_gaussian(self, device):
+        """
+        Get the Gaussian importance map of the patch size
+        :param device: torch.device
+        :return: torch.Tensor of the patch size
+        """
+        return compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
+                                value_scaling_factor=10, device=device)
+
+    def _allocate_buffer(self, shape, dtype, device):
+        """
+        Allocate a zero-filled accumulation buffer
+        """
+        return torch.zeros(shape, dtype=dtype, device=device)
+
+    def _release_buffer(self, buffer):
+        """
+        Called when an accumulation buffer is no longer used; nothing to do for freshly allocated buffers
+        """
+        pass
+
+    def _detach_buffer(self, buffer, slicer):
+        """
+        Get the part of an accumulation buffer returned to the caller
+        :param buffer: accumulation buffer
+        :param slicer: slicer reverting the padding
+        :return: torch.Tensor owned by the caller
+        """
+        return buffer[slicer]
+
+
+class BufferPool:
+    """
+    Pool of reusable accumulation buffers. `acquire()` returns a zero-filled view into a free buffer large enough for
+    the requested shape (allocating a new one only if none fits); `release()` returns the buffer to the pool.
+    New buffers are allocated with some headroom so that subjects of similar shape reuse the same memory.
+    :param headroom: new buffers are `headroom` times larger than requested
+    :param max_free_buffers: maximum number of free buffers kept in the pool; the smallest ones are dropped first
+    """
+    def __init__(self, headroom=1.25, max_free_buffers=8):
+        self.headroom = headroom
+        self.max_free_buffers = max_free_buffers
+        self.free = list()
+        # data pointer of the handed out view -> underlying flat buffer
+        self.in_use = dict()
+        self.n_allocations = 0
+        self.n_reuses = 0
+
+    def acquire(self, shape, dtype, device):
+        """
+        Get a zero-filled buffer
+        :param shape: shape of the buffer
+        :param dtype: torch.dtype
+        :param device: torch.device
+        :return: torch.Tensor of the given shape
+        """
+        n_elements = int(np.prod(shape))
+        candidates = [i for i, buffer in enumerate(self.free)
+                      if buffer.dtype == dtype and buffer.device == device and buffer.numel() >= n_elements]
+        if candidates:
+            # Smallest buffer that fits (note: list.remove() cannot be used, tensors are compared element-wise)
+            buffer = self.free.pop(min(candidates, key=lambda i: self.free[i].numel()))
+            self.n_reuses += 1
+        else:
+            buffer = torch.empty(int(np.ceil(n_elements * self.headroom)), dtype=dtype, device=device)
+            self.n_allocations += 1
+
+        view = buffer[:n_elements].view(tuple(shape))
+        view.zero_()
+        self.in_use[view.data_ptr()] = buffer
+        return view
+
+    def release(self, tensor):
+        """
+        Return a buffer obtained by `acquire()` to the pool; tensors not coming from the pool are ignored
+        :param tensor: torch.Tensor returned by `acquire()`
+        """
+        buffer = self.in_use.pop(tensor.data_ptr(), None)
+        if buffer is None:
+            return
+        self.free.append(buffer)
+        if len(self.free) > self.max_free_buffers:
+            self.free.pop(min(range(len(self.free)), key=lambda i: self.free[i].numel()))
+
+    def clear(self):
+        """
+        Drop all free buffers
+        """
+        self.free = list()
+
+    def get_memory(self):
+        """
+        Get the memory (in bytes) held by the pool (free and in-use buffers)
+        """
+        return sum(b.numel() * b.element_size() for b in self.free + list(self.in_use.values()))
+
+
+class PooledBufferPredictor(BatchedTilePredictor):
+    """
+    BatchedTilePredictor for the warm-process case (service, batch of subjects, cascade), where the same predictor is
+    used for many predictions one after another:
+        - the Gaussian importance maps are memoized per patch size and device
+        - the full-volume logits and weight accumulators are taken from a `BufferPool` and reused across subjects of
+        similar shape, instead of being allocated (and page-faulted) again for every prediction
+    Only the returned logits (after reverting the padding) are copied to a new tensor, since they are used by the
+    caller (e.g., exported asynchronously by nnUNet) after the next prediction has started.
+    :param headroom: see `BufferPool`
+    :param max_free_buffers: see `BufferPool`
+    All other parameters are passed to BatchedTilePredictor.
+    """
+    def __init__(self, *args, headroom=1.25, max_free_buffers=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer_pool = BufferPool(headroom, max_free_buffers)
+        self._gaussians = dict()
+
+    def predict_logits_from_preprocessed_data(self, data):
+        # nnUNetPredictor.predict_logits_from_preprocessed_data would return a view into a pooled buffer; the list
+        # version limits the torch threads and falls back to CPU results arrays in the same way
+        return self.predict_logits_from_preprocessed_list([data])[0]
+
+    def _get_gaussian(self, device):
+        key = (tuple(self.configuration_manager.patch_size), str(device))
+        if key not in self._gaussians:
+            self._gaussians[key] = super()._get_gaussian(device)
+        return self._gaussians[key]
+
+    def _allocate_buffer(self, shape, dtype, device):
+        return self.buffer_pool.acquire(shape, dtype, device)
+
+    def _release_buffer(self, buffer):
+        self.buffer_pool.release(buffer)
+
+    def _detach_buffer(self, buffer, slicer):
+        result = buffer[slicer].clone()
+        self.buffer_pool.release(buffer)
+        return result
@@ -0,0 +1,355 @@
+"""
+Local HTTP service running the nnUNetV2 rootlets model. The model is loaded once and kept in memory, so the individual
+requests do not pay the model loading time.
+
+Endpoints:
+    POST /predict   segment an image and return the label NIfTI (.nii.gz)
+                    - the body is either the NIfTI image itself (.nii or .nii.gz bytes) or a JSON object with the path
+                    to the image: {"path": "/path/to/sub-001_T2w.nii.gz"}. If the JSON object also contains "output",
+                    the prediction is saved to this path and a JSON object {"output": ...} is returned instead.
+                    - optional parameters (URL query or JSON keys): fold, tile_step_size
+    GET /healthz    200 if the service is running; 500 if the model could not be loaded (so the orchestrator can
+                    restart the worker)
+    GET /readyz     200 if the model (default fold) is loaded, 503 otherwise
+    GET /metrics    request counts, queue depth, latency histogram and resident memory in the Prometheus text format
+
+The requests are accepted concurrently, but the predictions are run one at a time (the model uses all CPU cores or
+the GPU); waiting requests are reported as the queue depth.
+
+Note: conda environment with nnUNetV2 is required to run this script.
+
+Example:
+    python run_inference_server.py
+        -path-model <PATH_TO_MODEL_FOLDER>
+        -fold all
+        -port 8080
+
+    curl --data-binary @sub-001_T2w.nii.gz "http://127.0.0.1:8080/predict?tile_step_size=0.5" -o sub-001_T2w_label-rootlet.nii.gz
+    curl -d '{"path": "/data/sub-001_T2w.nii.gz", "output": "/data/sub-001_T2w_label-rootlet.nii.gz"}' http://127.0.0.1:8080/predict
+"""
+
+import os
+import gzip
+import json
+import shutil
+import argparse
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from run_inference_single_subject import get_orientation, tmp_create, load_predictor, run_prediction
+
+FOLDS = ['0', '1', '2', '3', '4', 'all']
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600]
+
+
+def get_parser():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Local HTTP service segmenting images using nnUNet model.')
+    parser.add_argument('-path-model', help='Path to the model folder. This folder should contain individual '
+                                            'folders like fold_0, fold_1, etc. and dataset.json, '
+                                            'dataset_fingerprint.json and plans.json files.', required=True, type=str)
+    parser.add_argument('-fold', type=str, required=True, choices=FOLDS,
+                        help='Default fold, loaded at start-up. Other folds are loaded on the first request using '
+                             'them.')
+    parser.add_argument('-use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+    parser.add_argument('-use-best-checkpoint', action='store_true', default=False,
+                        help='Use the best checkpoint (instead of the final checkpoint) for prediction. '
+                             'NOTE: nnUNet by default uses the final checkpoint. Default: False')
+    parser.add_argument('-tile-step-size', default=0.5, type=float,
+                        help='Default tile step size defining the overlap between images patches during inference. '
+                             'Default: 0.5')
+    parser.add_argument('-tile-batch-size', default=None, type=int,
+                        help='Number of sliding-window tiles evaluated in one forward pass. Default: estimated from '
+                             'the available memory')
+    parser.add_argument('-host', default='127.0.0.1', type=str,
+                        help='Host to listen on. Default: 127.0.0.1')
+    parser.add_argument('-port', default=8080, type=int,
+                        help='Port to listen on. Default: 8080')
+
+    return parser
+
+
+def get_resident_memory():
+    """
+    Get the resident memory of the current process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Not Linux; ru_maxrss is the peak (not current) resident memory, in kilobytes
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics:
+    """
+    Thread-safe counters exposed by the /metrics endpoint
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict()      # (endpoint, status) -> count
+        self.queue_depth = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def count_request(self, endpoint, status):
+        with self.lock:
+            self.requests[(endpoint, status)] = self.requests.get((endpoint, status), 0) + 1
+
+    def change_queue_depth(self, delta):
+        with self.lock:
+            self.queue_depth += delta
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency_buckets[i] += 1
+            self.latency_sum += seconds
+            self.latency_count += 1
+
+    def to_prometheus(self, ready):
+        """
+        Format the metrics in the Prometheus text exposition format
+        :param ready: whether the model is loaded
+        :return: str
+        """
+        with self.lock:
+            lines = ['# HELP rootlets_requests_total Number of HTTP requests by endpoint and status code.',
+                     '# TYPE rootlets_requests_total counter']
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'rootlets_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += ['# HELP rootlets_queue_depth Number of prediction requests waiting or running.',
+                      '# TYPE rootlets_queue_depth gauge',
+                      f'rootlets_queue_depth {self.queue_depth}',
+                      '# HELP rootlets_prediction_latency_seconds Latency of the prediction requests.',
+                      '# TYPE rootlets_prediction_latency_seconds histogram']
+            for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+                lines.append(f'rootlets_prediction_latency_seconds_bucket{{le="{bound}"}} {count}')
+            lines += [f'rootlets_prediction_latency_seconds_bucket{{le="+Inf"}} {self.latency_count}',
+                      f'rootlets_prediction_latency_seconds_sum {self.latency_sum:.3f}',
+                      f'rootlets_prediction_latency_seconds_count {self.latency_count}']
+        lines += ['# HELP rootlets_model_ready Whether the model is loaded.',
+                  '# TYPE rootlets_model_ready gauge',
+                  f'rootlets_model_ready {int(ready)}',
+                  '# HELP process_resident_memory_bytes Resident memory size in bytes.',
+                  '# TYPE process_resident_memory_bytes gauge',
+                  f'process_resident_memory_bytes {get_resident_memory()}']
+        return '\n'.join(lines) + '\n'
+
+
+class RootletsService:
+    """
+    Keeps the loaded predictors (one per fold) and runs the predictions one at a time
+    """
+    def __init__(self, args):
+        self.args = args
+        self.predictors = dict()
+        self.lock = threading.Lock()
+        self.metrics = Metrics()
+        self.ready = threading.Event()
+        # Error of the loading of the default model, if any
+        self.load_error = None
+
+    def get_predictor(self, fold):
+        """
+        Get the predictor of a fold, load it if needed. Must be called with `self.lock` held.
+        """
+        if fold not in self.predictors:
+            folds_avail = 'all' if fold == 'all' else [int(fold)]
+            self.predictors[fold] = load_predictor(self.args.path_model, folds_avail, use_gpu=self.args.use_gpu,
+                                                   tile_step_size=self.args.tile_step_size,
+                                                   use_best_checkpoint=self.args.use_best_checkpoint,
+                                                   tile_batch_size=self.args.tile_batch_size, reuse_buffers=True)
+            # The service logs are enough; do not print the progress bar for each request
+            self.predictors[fold].allow_tqdm = False
+        return self.predictors[fold]
+
+    def load_default_predictor(self):
+        try:
+            with self.lock:
+                self.get_predictor(self.args.fold)
+        except Exception as e:
+            # The loading runs in a background thread; keep the error to report it from /healthz
+            traceback.print_exc()
+            self.load_error = f'{type(e).__name__}: {e}'
+            print(f'ERROR: The model (fold {self.args.fold}) could not be loaded: {self.load_error}')
+            return
+        self.ready.set()
+        print(f'Model (fold {self.args.fold}) loaded. Ready to accept requests.')
+
+    def predict(self, fname_in, fname_out, fold, tile_step_size):
+        """
+        Segment an image
+        :param fname_in: input image (.nii.gz)
+        :param fname_out: output label image (.nii.gz)
+        :param fold: fold to use, one of FOLDS
+        :param tile_step_size: tile step size
+        """
+        tmpdir = tmp_create()
+        try:
+            # NOTE: Add the `_0000` suffix, because nnUNet removes the last five characters (see
+            # run_inference_single_subject.py)
+            fname_tmp = os.path.join(tmpdir, 'image_0000.nii.gz')
+            shutil.copyfile(fname_in, fname_tmp)
+
+            # Reorient the image to LPI orientation if not already in LPI
+            orig_orientation = get_orientation(fname_tmp)
+            if orig_orientation != 'LPI':
+                os.system('sct_image -i {} -setorient LPI -o {}'.format(fname_tmp, fname_tmp))
+
+            with self.lock:
+                predictor = self.get_predictor(fold)
+                predictor.tile_step_size = tile_step_size
+                pred_file = run_prediction(predictor, fname_tmp, os.path.join(tmpdir, 'nnUNet_prediction'))
+
+            # Reorient the prediction back to the original orientation
+            if orig_orientation != 'LPI':
+                os.system('sct_image -i {} -setorient {} -o {}'.format(pred_file, orig_orientation, pred_file))
+            shutil.copyfile(pred_file, fname_out)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # Set by `main()`
+    service = None
+
+    def send(self, status, body, content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.service.metrics.count_request(urlparse(self.path).path, status)
+
+    def do_GET(self):
+        endpoint = urlparse(self.path).path
+        if endpoint == '/healthz':
+            if self.service.load_error is not None:
+                self.send(500, {'status': 'error', 'error': self.service.load_error})
+            else:
+                self.send(200, {'status': 'ok'})
+        elif endpoint == '/readyz':
+            if self.service.ready.is_set():
+                self.send(200, {'status': 'ready'})
+            elif self.service.load_error is not None:
+                self.send(503, {'status': 'error', 'error': self.service.load_error})
+            else:
+                self.send(503, {'status': 'loading'})
+        elif endpoint == '/metrics':
+            self.send(200, self.service.metrics.to_prometheus(self.service.ready.is_set()),
+                      content_type='text/plain; version=0.0.4')
+        else:
+            self.send(404, {'error': f'Unknown endpoint {endpoint}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self.send(404, {'error': f'Unknown endpoint {url.path}'})
+            return
+        if not self.service.ready.is_set():
+            self.send(503, {'error': self.service.load_error or 'The model is not loaded yet.'})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        tmpdir = tmp_create()
+        start = time.time()
+        self.service.metrics.change_queue_depth(1)
+        try:
+            # Validate the request; invalid requests are client errors (400)
+            try:
+                fname_in, fname_out, fold, tile_step_size = self.parse_predict_request(body, params, tmpdir)
+            except (ValueError, json.JSONDecodeError) as e:
+                self.send(400, {'error': str(e)})
+                return
+
+            # Errors of the prediction (e.g., nnUNet or nibabel) are server errors (500)
+            fname_pred = os.path.join(tmpdir, 'prediction.nii.gz')
+            self.service.predict(fname_in, fname_pred, fold, tile_step_size)
+            self.service.metrics.observe_latency(time.time() - start)
+
+            if fname_out is not None:
+                shutil.copyfile(fname_pred, fname_out)
+                self.send(200, {'output': fname_out})
+            else:
+                with open(fname_pred, 'rb') as f:
+                    self.send(200, f.read(), content_type='application/gzip')
+        except Exception as e:
+            traceback.print_exc()
+            self.send(500, {'error': str(e)})
+        finally:
+            self.service.metrics.change_queue_depth(-1)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def parse_predict_request(self, body, params, tmpdir):
+        """
+        Parse and validate a /predict request
+        :param body: request body
+        :param params: parameters of the URL query
+        :param tmpdir: temporary folder where the image sent in the body is saved
+        :return: fname_in, fname_out (None to return the prediction in the response), fold, tile_step_size
+        """
+        # The body is either a JSON object with the path to the image, or the image itself
+        fname_out = None
+        if body[:1] == b'{':
+            request = json.loads(body)
+            params.update({key: request[key] for key in ['fold', 'tile_step_size'] if key in request})
+            if 'path' not in request:
+                raise ValueError('The JSON body must contain "path".')
+            fname_in = os.path.expanduser(request['path'])
+            if not os.path.isfile(fname_in):
+                raise ValueError(f'File {fname_in} does not exist.')
+            fname_out = os.path.expanduser(request['output']) if 'output' in request else None
+        else:
+            if not body:
+                raise ValueError('Empty request body.')
+            fname_in = os.path.join(tmpdir, 'input.nii.gz')
+            # nnUNet expects a .nii.gz file (see `file_ending` in dataset.json); gzip magic number is 1f 8b
+            with open(fname_in, 'wb') if body[:2] == b'\x1f\x8b' else gzip.open(fname_in, 'wb') as f:
+                f.write(body)
+
+        fold = str(params.get('fold', self.service.args.fold))
+        if fold not in FOLDS:
+            raise ValueError(f'Invalid fold {fold}. Choose from {FOLDS}.')
+        tile_step_size = float(params.get('tile_step_size', self.service.args.tile_step_size))
+        if not 0 < tile_step_size <= 1:
+            raise ValueError('tile_step_size must be in (0, 1].')
+
+        return fname_in, fname_out, fold, tile_step_size
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    service = RootletsService(args)
+    RequestHandler.service = service
+
+    # Load the model in the background, so /healthz and /readyz answer during the loading
+    threading.Thread(target=service.load_default_predictor, daemon=True).start()
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print(f'Listening on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,7 @@ Example:
 
 
 import os
+import sys
 import shutil
 import subprocess
 import argparse
@@ -28,9 +29,17 @@ import glob
 import time
 import tempfile
 
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+import numpy as np
+import nibabel as nib
+
 from batchgenerators.utilities.file_and_folder_operations import join
 
+from sparse_probabilities import save_sparse_probabilities
+from slab import get_slab_from_discs, get_slab_from_z_range, get_slab_chunks, crop_image, uncrop_image
+from cascade import coarse_spacing, get_roi_from_prediction, dice_per_label
+from predictor import BatchedTilePredictor, PooledBufferPredictor, get_available_memory
+from job_guard import JobGuard, JobCancelled, estimate_memory, get_number_of_slabs
+
 
 def get_parser():
     # parse command line arguments
@@ -53,6 +62,58 @@ def get_parser():
                              'Default: 0.5 '
                              'NOTE: changing it from 0.5 to 0.9 makes inference faster but there is a small drop in '
                              'performance.')
+    parser.add_argument('-save-probabilities', required=False, type=str, choices=['npz', 'zarr'], default=None,
+                        help='Save class probabilities as uint8-quantized maps cropped to the bounding box of each '
+                             'class. The maps are saved next to the output file with the "_probabilities" suffix, '
+                             'either as a compressed .npz file or as a chunked Zarr store (requires the "zarr" '
+                             'package). Use the SparseProbabilities class from sparse_probabilities.py to load them. '
+                             'NOTE: the probabilities are saved in the LPI orientation using the axis order of the '
+                             'nnUNet image reader. Default: None (probabilities are not saved)')
+    parser.add_argument('-discs', required=False, type=str,
+                        help='Path to the intervertebral disc labels (e.g., obtained using sct_label_vertebrae). If '
+                             'provided together with "-slab-discs", the inference is run only on the slab between '
+                             'the two discs (plus "-slab-margin"). Voxels outside the slab are set to zero. '
+                             'Example: sub-001_T2w_labels-disc.nii.gz')
+    parser.add_argument('-slab-discs', required=False, type=int, nargs=2, metavar=('TOP', 'BOTTOM'),
+                        help='Values of the upper and lower disc labels defining the slab. Example: 2 8 (C2/C3 to '
+                             'C7/T1 discs)')
+    parser.add_argument('-slab-margin', required=False, type=float, default=10,
+                        help='Margin (in mm) added above and below the slab defined by "-slab-discs". Also used as '
+                             'the margin (context) added above and below each slab when the inference is split into '
+                             'slabs to fit the memory budget (see "-memory-action slab"). Default: 10')
+    parser.add_argument('-z-range', required=False, type=float, nargs=2, metavar=('ZMIN', 'ZMAX'),
+                        help='Run the inference only on the slab between two z-coordinates (in mm, world '
+                             'coordinates). Voxels outside the slab are set to zero. Cannot be used together with '
+                             '"-discs".')
+    parser.add_argument('-mode', required=False, type=str, choices=['single', 'cascade'], default='single',
+                        help='Inference mode. "single": run the model on the whole image. "cascade": run the model '
+                             'at a coarser spacing first to localize the rootlets, then run the full-resolution '
+                             'inference only inside the region around the coarse prediction. Default: single')
+    parser.add_argument('-cascade-factor', required=False, type=float, default=2,
+                        help='Factor multiplying the model spacing for the coarse pass of the cascade mode. '
+                             'Default: 2')
+    parser.add_argument('-cascade-margin', required=False, type=float, default=10,
+                        help='Margin (in mm) added around the coarse prediction to define the region for the '
+                             'full-resolution pass of the cascade mode. Default: 10')
+    parser.add_argument('-compare-single-stage', action='store_true', default=False,
+                        help='In the cascade mode, also run the single-stage inference and report the latency and '
+                             'the Dice score per label between the cascade and the single-stage predictions. '
+                             'Default: False')
+    parser.add_argument('-tile-batch-size', required=False, type=str, default='auto',
+                        help='Number of sliding-window tiles evaluated in one forward pass. Larger batches use the '
+                             'CPU (or GPU) more efficiently, especially for small patch sizes. "auto" estimates the '
+                             'batch size from the available memory. Default: auto')
+    parser.add_argument('-memory-budget', required=False, type=float, default=None,
+                        help='Memory budget (in GB) of the inference. The memory needed by the inference is '
+                             'estimated before it starts (from the image size and the number of classes and folds '
+                             'of the model). Default: available RAM')
+    parser.add_argument('-memory-action', required=False, type=str, choices=['slab', 'refuse'], default='slab',
+                        help='What to do if the estimated memory exceeds "-memory-budget". "slab": split the image '
+                             'into slabs along the superior-inferior axis (each extended by "-slab-margin") and run '
+                             'the inference slab by slab. "refuse": exit with an error. Default: slab')
+    parser.add_argument('-timeout', required=False, type=float, default=None,
+                        help='Wall-clock timeout (in seconds) of the inference. The inference is stopped between '
+                             'sliding-window tiles and the temporary folder is deleted. Default: None (no timeout)')
 
     return parser
 
@@ -113,100 +174,80 @@ def add_suffix(fname, suffix):
     return os.path.join(stem + suffix + ext)
 
 
-def main():
-    parser = get_parser()
-    args = parser.parse_args()
-
-    fname_file = os.path.expanduser(args.i)
-    fname_file_out = os.path.expanduser(args.o)
-    print(f'\nFound {fname_file} file.')
-
-    # If the fname_file is .nii, gzip it
-    # This is needed, because the filename suffix must match the `file_ending` in `dataset.json`.
-    # Context: https://github.com/ivadomed/model-spinal-rootlets/issues/49
-    if not fname_file.endswith('.nii.gz'):
-        print('Compressing the input image...')
-        os.system('gzip -f {}'.format(fname_file))
-        fname_file = fname_file + '.gz'
-        print(f'Compressed {fname_file}')
-
-    # Add .gz suffix to the output file if not already present. This is needed because we gzip the input file.
-    if not fname_file_out.endswith('.gz'):
-        fname_file_out = fname_file_out + '.gz'
+def load_predictor(path_model, folds_avail, use_gpu=False, tile_step_size=0.5, use_best_checkpoint=False,
+                   tile_batch_size=None, reuse_buffers=False):
+    """
+    Initialize the predictor and load the model
+    :param path_model: path to the model folder (containing fold_0, fold_1, etc., dataset.json and plans.json)
+    :param folds_avail: 'all' or list of folds, for example [0, 1]
+    :param use_gpu: run the inference on GPU
+    :param tile_step_size: tile step size defining the overlap between image patches
+    :param use_best_checkpoint: use 'checkpoint_best.pth' instead of the final checkpoint
+    :param tile_batch_size: number of sliding-window tiles evaluated in one forward pass; None to estimate it from the
+    available memory
+    :param reuse_buffers: memoize the Gaussian maps and reuse the accumulation buffers across predictions; useful when
+    the predictor is used for several predictions (e.g., cascade mode)
+    :return: predictor
+    """
+    path_model = os.path.expanduser(path_model)
 
-    # Create temporary directory in the temp to store the reoriented images
-    tmpdir = tmp_create()
-    # Copy the file to the temporary directory using shutil.copyfile
-    # NOTE: Add the `_0000` suffix, because nnUNet removes the last five characters:
-    # https://github.com/MIC-DKFZ/nnUNet/blob/master/nnunetv2/inference/predict_from_raw_data.py#L171C19-L172C51
-    # Context: https://github.com/ivadomed/model-spinal-rootlets/issues/49
-    fname_file_tmp = os.path.join(tmpdir, os.path.basename(add_suffix(fname_file, '_0000')))
-    shutil.copyfile(fname_file, fname_file_tmp)
-    print(f'Copied {fname_file} to {fname_file_tmp}')
-
-    # Get the original orientation of the image, for example LPI
-    orig_orientation = get_orientation(fname_file_tmp)
-
-    # Reorient the image to LPI orientation if not already in LPI
-    if orig_orientation != 'LPI':
-        print(f'Original orientation: {orig_orientation}')
-        print(f'Reorienting to LPI orientation...')
-        # reorient the image to LPI using SCT
-        os.system('sct_image -i {} -setorient LPI -o {}'.format(fname_file_tmp, fname_file_tmp))
-
-    # Note: even a single file must be in a list of lists
-    fname_file_tmp_list = [[fname_file_tmp]]
-
-    # Use fold_all (all train/val subjects were used for training) or specific fold(s)
-    folds_avail = 'all' if args.fold == 'all' else [int(f) for f in args.fold.split(',')]
-    print(f'Using fold(s): {folds_avail}')
-
-    # Create directory for nnUNet prediction
-    tmpdir_nnunet = os.path.join(tmpdir, 'nnUNet_prediction')
-    fname_prediction = os.path.join(tmpdir_nnunet, os.path.basename(add_suffix(fname_file_tmp, '_pred')))
-    os.mkdir(tmpdir_nnunet)
-
-    # Run nnUNet prediction
-    print('Starting inference...it may take a few minutes...\n')
-    start = time.time()
     # directly call the predict function
-    predictor = nnUNetPredictor(
-        tile_step_size=args.tile_step_size,     # changing it from 0.5 to 0.9 makes inference faster
+    predictor_class = PooledBufferPredictor if reuse_buffers else BatchedTilePredictor
+    predictor = predictor_class(
+        tile_step_size=tile_step_size,     # changing it from 0.5 to 0.9 makes inference faster
         use_gaussian=True,      # applies gaussian noise and gaussian blur
         use_mirroring=False,    # test time augmentation by mirroring on all axes
-        perform_everything_on_device=True if args.use_gpu else False,
-        device=torch.device('cuda') if args.use_gpu else torch.device('cpu'),
+        perform_everything_on_device=True if use_gpu else False,
+        device=torch.device('cuda') if use_gpu else torch.device('cpu'),
         verbose_preprocessing=False,
-        allow_tqdm=True
+        allow_tqdm=True,
+        tile_batch_size=tile_batch_size,
     )
 
     print('Running inference on device: {}'.format(predictor.device))
 
-    # args.path_model can contain either 'checkpoint_latest.pth' or 'checkpoint_final.pth' (depending on the nnUNet
+    # path_model can contain either 'checkpoint_latest.pth' or 'checkpoint_final.pth' (depending on the nnUNet
     # version)
+    fold_name = 'all' if folds_avail == 'all' else folds_avail[0]
     checkpoint_name = 'checkpoint_final.pth' if (
-        os.path.isfile(os.path.join(os.path.expanduser(args.path_model),
-                                    f'fold_{folds_avail[0]}',
-                                    'checkpoint_final.pth'))) else 'checkpoint_latest.pth'
-    # use 'checkpoint_best.pth' if 'args.use_best_checkpoint' is True
-    if args.use_best_checkpoint:
+        os.path.isfile(os.path.join(path_model, f'fold_{fold_name}', 'checkpoint_final.pth'))) \
+        else 'checkpoint_latest.pth'
+    # use 'checkpoint_best.pth' if 'use_best_checkpoint' is True
+    if use_best_checkpoint:
         checkpoint_name = 'checkpoint_best.pth'
 
     print(f'Using checkpoint: {checkpoint_name}')
 
     # initializes the network architecture, loads the checkpoint
     predictor.initialize_from_trained_model_folder(
-        join(os.path.expanduser(args.path_model)),
+        join(path_model),
         use_folds=folds_avail,
         checkpoint_name=checkpoint_name,
     )
-    print('Model loaded successfully. Fetching data...')
+    print(f'Tiles evaluated in one forward pass: {predictor.get_tile_batch_size()}')
+
+    return predictor
 
+
+def run_prediction(predictor, fname_in, output_folder, save_probabilities=False, n_slabs=1, margin_vox=0):
+    """
+    Run the nnUNet prediction on a single image
+    :param predictor: initialized nnUNetPredictor
+    :param fname_in: input image; the filename must end with the `_0000` suffix
+    :param output_folder: folder to save the prediction (created if it does not exist)
+    :param save_probabilities: save the class probabilities (as .npz) next to the prediction
+    :param n_slabs: number of slabs (along the third axis) predicted one after another to limit the memory
+    :param margin_vox: margin (in voxels) added on both sides of each slab
+    :return: path to the predicted segmentation
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if n_slabs > 1:
+        return run_prediction_in_slabs(predictor, fname_in, output_folder, n_slabs, margin_vox)
     # NOTE: for individual files, the image should be in a list of lists
     predictor.predict_from_files(
-        list_of_lists_or_source_folder=fname_file_tmp_list,
-        output_folder_or_list_of_truncated_output_files=tmpdir_nnunet,
-        save_probabilities=False,
+        list_of_lists_or_source_folder=[[fname_in]],
+        output_folder_or_list_of_truncated_output_files=output_folder,
+        save_probabilities=save_probabilities,
         overwrite=True,
         num_processes_preprocessing=4,
         num_processes_segmentation_export=4,
@@ -214,36 +255,266 @@ def main():
         num_parts=1,
         part_id=0
     )
+    return glob.glob(os.path.join(output_folder, '*.nii.gz'))[0]
 
-    end = time.time()
 
-    print('Inference done.')
-    total_time = end - start
-    print('Total inference time: {} minute(s) {} seconds\n'.format(int(total_time // 60), int(round(total_time % 60))))
+def run_prediction_in_slabs(predictor, fname_in, output_folder, n_slabs, margin_vox):
+    """
+    Run the nnUNet prediction slab by slab and stitch the predictions. Each slab is extended by a margin to provide
+    context; only the core of each slab (without the margin) is kept.
+    :param predictor: initialized nnUNetPredictor
+    :param fname_in: input image; the filename must end with the `_0000` suffix
+    :param output_folder: folder to save the prediction (created if it does not exist)
+    :param n_slabs: number of slabs along the third axis
+    :param margin_vox: margin (in voxels) added on both sides of each slab
+    :return: path to the predicted segmentation
+    """
+    img = nib.load(fname_in)
+    data_pred = header_pred = None
+    for i, (z_start, z_end, core_start, core_end) in enumerate(get_slab_chunks(img.shape[2], n_slabs, margin_vox)):
+        print(f'Predicting slab {i + 1}/{n_slabs}: slices {z_start}-{z_end - 1}')
+        folder_slab = os.path.join(output_folder, f'slab_{i}')
+        fname_slab = os.path.join(folder_slab, os.path.basename(fname_in))
+        os.makedirs(folder_slab, exist_ok=True)
+        crop_image(fname_in, fname_slab, (slice(None), slice(None), slice(z_start, z_end)))
+        img_slab = nib.load(run_prediction(predictor, fname_slab, os.path.join(folder_slab, 'prediction')))
+
+        if data_pred is None:
+            data_pred = np.zeros(img.shape, dtype=img_slab.get_data_dtype())
+            header_pred = img_slab.header
+        data_pred[:, :, core_start:core_end] = \
+            np.asanyarray(img_slab.dataobj)[:, :, core_start - z_start:core_end - z_start]
+
+    # Same file name as nnUNet (the `_0000` suffix is removed)
+    fname_pred = os.path.join(output_folder, os.path.basename(fname_in).replace('_0000.nii.gz', '.nii.gz'))
+    nib.save(nib.Nifti1Image(data_pred, img.affine, header_pred), fname_pred)
+    return fname_pred
+
 
-    # Copy .nii.gz file from tmpdir_nnunet to tmpdir
-    pred_file = glob.glob(os.path.join(tmpdir_nnunet, '*.nii.gz'))[0]
-    shutil.copyfile(pred_file, fname_prediction)
-    print(f'Copied {pred_file} to {fname_prediction}')
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
 
-    # Reorient the image back to original orientation
-    # skip if already in LPI
-    if orig_orientation != 'LPI':
-        print(f'Reorienting to original orientation {orig_orientation}...')
-        # reorient the image to the original orientation using SCT
-        os.system('sct_image -i {} -setorient {} -o {}'.format(fname_prediction, orig_orientation, fname_prediction))
+    if args.discs and args.z_range:
+        parser.error('"-discs" and "-z-range" cannot be used together.')
+    if bool(args.discs) != bool(args.slab_discs):
+        parser.error('"-discs" and "-slab-discs" must be used together.')
+    if args.compare_single_stage and args.mode != 'cascade':
+        parser.error('"-compare-single-stage" can be used only with "-mode cascade".')
+    if args.tile_batch_size == 'auto':
+        args.tile_batch_size = None
+    elif not args.tile_batch_size.isdigit() or int(args.tile_batch_size) < 1:
+        parser.error('"-tile-batch-size" must be a positive integer or "auto".')
+    else:
+        args.tile_batch_size = int(args.tile_batch_size)
 
-    # Copy level-specific (i.e., non-binary) segmentation
-    shutil.copyfile(fname_prediction, fname_file_out)
-    print(f'Copied {fname_prediction} to {fname_file_out}')
+    fname_file = os.path.expanduser(args.i)
+    fname_file_out = os.path.expanduser(args.o)
+    print(f'\nFound {fname_file} file.')
 
-    print('Deleting the temporary folder...')
-    # Delete the temporary folder
-    shutil.rmtree(tmpdir)
+    # If the fname_file is .nii, gzip it
+    # This is needed, because the filename suffix must match the `file_ending` in `dataset.json`.
+    # Context: https://github.com/ivadomed/model-spinal-rootlets/issues/49
+    if not fname_file.endswith('.nii.gz'):
+        print('Compressing the input image...')
+        os.system('gzip -f {}'.format(fname_file))
+        fname_file = fname_file + '.gz'
+        print(f'Compressed {fname_file}')
+
+    # Add .gz suffix to the output file if not already present. This is needed because we gzip the input file.
+    if not fname_file_out.endswith('.gz'):
+        fname_file_out = fname_file_out + '.gz'
+
+    # Create temporary directory in the temp to store the reoriented images
+    tmpdir = tmp_create()
+    # Stop the inference on timeout or on SIGTERM/SIGINT (between sliding-window tiles)
+    guard = JobGuard(args.timeout)
+    guard.install_signal_handlers()
+    try:
+        # Copy the file to the temporary directory using shutil.copyfile
+        # NOTE: Add the `_0000` suffix, because nnUNet removes the last five characters:
+        # https://github.com/MIC-DKFZ/nnUNet/blob/master/nnunetv2/inference/predict_from_raw_data.py#L171C19-L172C51
+        # Context: https://github.com/ivadomed/model-spinal-rootlets/issues/49
+        fname_file_tmp = os.path.join(tmpdir, os.path.basename(add_suffix(fname_file, '_0000')))
+        shutil.copyfile(fname_file, fname_file_tmp)
+        print(f'Copied {fname_file} to {fname_file_tmp}')
+
+        # Get the original orientation of the image, for example LPI
+        orig_orientation = get_orientation(fname_file_tmp)
+
+        # Reorient the image to LPI orientation if not already in LPI
+        if orig_orientation != 'LPI':
+            print(f'Original orientation: {orig_orientation}')
+            print(f'Reorienting to LPI orientation...')
+            # reorient the image to LPI using SCT
+            os.system('sct_image -i {} -setorient LPI -o {}'.format(fname_file_tmp, fname_file_tmp))
+
+        # Restrict the inference to a slab (defined by disc labels or by a z-range)
+        bbox_slab = None
+        if args.discs or args.z_range:
+            img_tmp = nib.load(fname_file_tmp)
+            if args.discs:
+                # Reorient the disc labels to LPI to match the reoriented image
+                fname_discs_tmp = os.path.join(tmpdir, 'discs.nii.gz')
+                shutil.copyfile(os.path.expanduser(args.discs), fname_discs_tmp)
+                if get_orientation(fname_discs_tmp) != 'LPI':
+                    os.system('sct_image -i {} -setorient LPI -o {}'.format(fname_discs_tmp, fname_discs_tmp))
+                img_discs = nib.load(fname_discs_tmp)
+                if img_discs.shape != img_tmp.shape:
+                    raise ValueError(f'The disc labels (shape {img_discs.shape}) and the input image (shape '
+                                     f'{img_tmp.shape}) must be in the same space.')
+                margin_vox = int(np.ceil(args.slab_margin / img_tmp.header.get_zooms()[2]))
+                z_start, z_end = get_slab_from_discs(np.asanyarray(img_discs.dataobj), args.slab_discs[0],
+                                                     args.slab_discs[1], margin_vox)
+            else:
+                z_start, z_end = get_slab_from_z_range(img_tmp.affine, img_tmp.shape, args.z_range[0], args.z_range[1])
+            bbox_slab = (slice(None), slice(None), slice(z_start, z_end))
+            print(f'Restricting the inference to slices {z_start}-{z_end - 1} (out of {img_tmp.shape[2]}, LPI).')
+            shape_full, affine_full = crop_image(fname_file_tmp, fname_file_tmp, bbox_slab)
+
+        # Use fold_all (all train/val subjects were used for training) or specific fold(s)
+        folds_avail = 'all' if args.fold == 'all' else [int(f) for f in args.fold.split(',')]
+        print(f'Using fold(s): {folds_avail}')
+
+        # Create directory for nnUNet prediction
+        tmpdir_nnunet = os.path.join(tmpdir, 'nnUNet_prediction')
+        fname_prediction = os.path.join(tmpdir_nnunet, os.path.basename(add_suffix(fname_file_tmp, '_pred')))
+        os.mkdir(tmpdir_nnunet)
+
+        # Run nnUNet prediction
+        print('Starting inference...it may take a few minutes...\n')
+        start = time.time()
+        predictor = load_predictor(args.path_model, folds_avail, use_gpu=args.use_gpu,
+                                   tile_step_size=args.tile_step_size, use_best_checkpoint=args.use_best_checkpoint,
+                                   tile_batch_size=args.tile_batch_size, reuse_buffers=args.mode == 'cascade')
+        predictor.job_guard = guard
+        print('Model loaded successfully. Fetching data...')
+
+        # Estimate the memory needed by the inference; if it exceeds the budget, refuse the job or split the image
+        # into slabs
+        img_tmp = nib.load(fname_file_tmp)
+        zooms = img_tmp.header.get_zooms()[:3]
+        memory = estimate_memory(predictor, img_tmp.shape, zooms)
+        budget = args.memory_budget * 1024 ** 3 if args.memory_budget else get_available_memory(torch.device('cpu'))
+        print(f'Estimated memory: {memory / 1024 ** 3:.2f} GB (budget: {budget / 1024 ** 3:.2f} GB)')
+        n_slabs, margin_vox = 1, int(np.ceil(args.slab_margin / zooms[2]))
+        if memory > budget:
+            if args.memory_action == 'refuse':
+                raise MemoryError('The estimated memory exceeds the budget. Use "-memory-action slab", restrict the '
+                                  'inference using "-discs"/"-z-range" or increase "-memory-budget".')
+            if args.save_probabilities:
+                raise MemoryError('The estimated memory exceeds the budget and the probabilities cannot be saved '
+                                  'when the inference is split into slabs.')
+            n_slabs = get_number_of_slabs(predictor, img_tmp.shape, zooms, budget, margin_vox)
+            if n_slabs is None:
+                raise MemoryError('The estimated memory exceeds the budget even for one-slice slabs.')
+            print(f'The estimated memory exceeds the budget; the inference is split into {n_slabs} slabs.')
+
+        if args.mode == 'single':
+            pred_file = run_prediction(predictor, fname_file_tmp, tmpdir_nnunet, args.save_probabilities is not None,
+                                       n_slabs, margin_vox)
+        else:
+            # Stage 1: localize the rootlets using the model at a coarser spacing
+            start_coarse = time.time()
+            with coarse_spacing(predictor, args.cascade_factor):
+                pred_file_coarse = run_prediction(predictor, fname_file_tmp, os.path.join(tmpdir, 'cascade_coarse'))
+            time_coarse = time.time() - start_coarse
+
+            img_tmp = nib.load(fname_file_tmp)
+            margin_vox_roi = [int(np.ceil(args.cascade_margin / zoom)) for zoom in img_tmp.header.get_zooms()[:3]]
+            bbox_roi = get_roi_from_prediction(np.asanyarray(nib.load(pred_file_coarse).dataobj), margin_vox_roi)
+
+            # Stage 2: full-resolution inference inside the ROI
+            start_fine = time.time()
+            if bbox_roi is None:
+                print('WARNING: The coarse pass did not find any rootlets. Running the full-resolution inference on '
+                      'the whole image.')
+                pred_file = run_prediction(predictor, fname_file_tmp, tmpdir_nnunet,
+                                           args.save_probabilities is not None, n_slabs, margin_vox)
+            else:
+                print(f'Restricting the full-resolution inference to the ROI {[(s.start, s.stop) for s in bbox_roi]} '
+                      f'(image shape: {img_tmp.shape}, LPI).')
+                fname_file_roi = os.path.join(tmpdir, 'cascade_roi', os.path.basename(fname_file_tmp))
+                os.makedirs(os.path.dirname(fname_file_roi))
+                shape_roi_ref, affine_roi_ref = crop_image(fname_file_tmp, fname_file_roi, bbox_roi)
+                pred_file = run_prediction(predictor, fname_file_roi, tmpdir_nnunet,
+                                           args.save_probabilities is not None, n_slabs, margin_vox)
+                # Pad the prediction back to the input image
+                uncrop_image(pred_file, pred_file, bbox_roi, shape_roi_ref, affine_roi_ref)
+            time_fine = time.time() - start_fine
+            print(f'Cascade latency: {time_coarse + time_fine:.1f} s (coarse pass: {time_coarse:.1f} s, '
+                  f'full-resolution pass: {time_fine:.1f} s)')
+
+            # Compare the cascade with the single-stage default
+            if args.compare_single_stage:
+                start_single = time.time()
+                pred_file_single = run_prediction(predictor, fname_file_tmp, os.path.join(tmpdir, 'single_stage'),
+                                                  n_slabs=n_slabs, margin_vox=margin_vox)
+                time_single = time.time() - start_single
+                dice = dice_per_label(np.asanyarray(nib.load(pred_file).dataobj),
+                                      np.asanyarray(nib.load(pred_file_single).dataobj))
+                print(f'Single-stage latency: {time_single:.1f} s; cascade speed-up: '
+                      f'{time_single / (time_coarse + time_fine):.2f}x')
+                print('Dice between the cascade and the single-stage predictions:')
+                for label, dice_label in dice.items():
+                    print(f'\tlabel {label}: {dice_label:.3f}')
+                if dice:
+                    print(f'\tmean: {np.mean(list(dice.values())):.3f}')
+
+        end = time.time()
+
+        print('Inference done.')
+        total_time = end - start
+        print('Total inference time: {} minute(s) {} seconds\n'.format(int(total_time // 60),
+                                                                       int(round(total_time % 60))))
+
+        # Copy .nii.gz file from tmpdir_nnunet to tmpdir
+        if bbox_slab is None:
+            shutil.copyfile(pred_file, fname_prediction)
+            print(f'Copied {pred_file} to {fname_prediction}')
+        else:
+            # Pad the prediction back to the full field of view (voxels outside the slab are zero)
+            uncrop_image(pred_file, fname_prediction, bbox_slab, shape_full, affine_full)
+            print(f'Padded {pred_file} to the full field of view and saved it to {fname_prediction}')
+
+        # Convert the dense float probabilities saved by nnUNet into sparse uint8-quantized per-class maps
+        if args.save_probabilities:
+            fname_probabilities = splitext(fname_file_out)[0] + f'_probabilities.{args.save_probabilities}'
+            probabilities = np.load(pred_file.replace('.nii.gz', '.npz'))['probabilities']
+            metadata = {'orientation': 'LPI'}
+            # Probabilities cover only the slab; keep its location (slices in the LPI orientation)
+            if bbox_slab is not None:
+                metadata.update({'slab_start': bbox_slab[2].start, 'slab_end': bbox_slab[2].stop})
+            # In the cascade mode, probabilities cover only the ROI within the (slab of the) image
+            if args.mode == 'cascade' and bbox_roi is not None:
+                metadata.update({'roi_start': [s.start for s in bbox_roi], 'roi_stop': [s.stop for s in bbox_roi]})
+            save_sparse_probabilities(probabilities, fname_probabilities, metadata=metadata)
+            print(f'Probabilities saved to {fname_probabilities}')
+
+        # Reorient the image back to original orientation
+        # skip if already in LPI
+        if orig_orientation != 'LPI':
+            print(f'Reorienting to original orientation {orig_orientation}...')
+            # reorient the image to the original orientation using SCT
+            os.system('sct_image -i {} -setorient {} -o {}'.format(fname_prediction, orig_orientation,
+                                                                   fname_prediction))
+
+        # Copy level-specific (i.e., non-binary) segmentation
+        shutil.copyfile(fname_prediction, fname_file_out)
+        print(f'Copied {fname_prediction} to {fname_file_out}')
+    except (JobCancelled, MemoryError) as e:
+        print(f'ERROR: {e}')
+        sys.exit(1)
+    finally:
+        print('Deleting the temporary folder...')
+        # Delete the temporary folder
+        shutil.rmtree(tmpdir)
 
     print('-' * 50)
     print(f"Input file: {fname_file}")
     print(f"Rootlet segmentation: {fname_file_out}")
+    if args.save_probabilities:
+        print(f"Probabilities: {fname_probabilities}")
     print('-' * 50)
 
 
@@ -0,0 +1,118 @@
+"""
+Functions to restrict the nnUNet inference to a slab (or, more generally, to a bounding box) of the input image.
+
+The slab is defined either by two intervertebral disc labels (plus a margin in mm) or by a z-range in mm (world
+coordinates). The input image is cropped to the slab before the inference, and the prediction is padded back to the
+original field of view (voxels outside the slab are set to zero).
+
+All functions assume that the images are in the LPI orientation (i.e., the third axis goes from inferior to superior).
+"""
+
+import numpy as np
+import nibabel as nib
+
+
+def get_slab_from_discs(data_discs, disc_top, disc_bottom, margin_vox):
+    """
+    Get the slab between two intervertebral disc labels
+    :param data_discs: 3D array with disc labels (LPI orientation)
+    :param disc_top: value of the upper disc label, for example 2 (C2/C3 disc)
+    :param disc_bottom: value of the lower disc label, for example 8 (C7/T1 disc)
+    :param margin_vox: margin (in voxels) added above and below the slab
+    :return: z_start, z_end: first and last+1 slice of the slab
+    """
+    slices = list()
+    for disc in [disc_top, disc_bottom]:
+        z_disc = np.where(data_discs == disc)[2]
+        if len(z_disc) == 0:
+            raise ValueError(f'Disc label {disc} not found in the disc label file.')
+        slices.append(int(np.round(np.mean(z_disc))))
+
+    z_start = max(min(slices) - margin_vox, 0)
+    z_end = min(max(slices) + margin_vox + 1, data_discs.shape[2])
+
+    return z_start, z_end
+
+
+def get_slab_from_z_range(affine, shape, z_min, z_max):
+    """
+    Get the slab between two z-coordinates (in mm, world coordinates)
+    :param affine: 4x4 affine of the image
+    :param shape: shape of the image
+    :param z_min: lower z-coordinate in mm
+    :param z_max: upper z-coordinate in mm
+    :return: z_start, z_end: first and last+1 slice of the slab
+    """
+    # World z-coordinate of each slice, taken in the centre of the slice
+    slices = np.arange(shape[2])
+    voxels = np.stack([np.full(shape[2], (shape[0] - 1) / 2),
+                       np.full(shape[2], (shape[1] - 1) / 2),
+                       slices,
+                       np.ones(shape[2])])
+    z_world = (affine @ voxels)[2]
+
+    slices_in_range = slices[(z_world >= min(z_min, z_max)) & (z_world <= max(z_min, z_max))]
+    if len(slices_in_range) == 0:
+        raise ValueError(f'The z-range [{z_min}, {z_max}] mm does not intersect the image '
+                         f'(z-range of the image: [{z_world.min():.1f}, {z_world.max():.1f}] mm).')
+
+    return int(slices_in_range.min()), int(slices_in_range.max()) + 1
+
+
+def crop_image(fname_in, fname_out, bbox):
+    """
+    Crop an image to a bounding box and update the affine accordingly
+    :param fname_in: input image
+    :param fname_out: output (cropped) image; can be the same as fname_in
+    :param bbox: tuple of three slices
+    :return: shape and affine of the input (uncropped) image; used by `uncrop_image()`
+    """
+    img = nib.load(fname_in)
+    shape, affine = img.shape, img.affine
+    # Read the data into memory before writing, since fname_out can be the same as fname_in
+    data = np.asanyarray(img.dataobj[bbox])
+
+    # Shift the origin to the first voxel of the bounding box
+    offset = [s.indices(dim)[0] for s, dim in zip(bbox, shape)]
+    affine_cropped = affine.copy()
+    affine_cropped[:3, 3] = affine[:3, :3] @ offset + affine[:3, 3]
+
+    nib.save(nib.Nifti1Image(data, affine_cropped, img.header), fname_out)
+
+    return shape, affine
+
+
+def uncrop_image(fname_in, fname_out, bbox, shape, affine):
+    """
+    Pad a cropped image (e.g., prediction) back to the original field of view; voxels outside the bounding box are set
+    to zero
+    :param fname_in: cropped image
+    :param fname_out: output image in the original field of view; can be the same as fname_in
+    :param bbox: tuple of three slices used to crop the image
+    :param shape: shape of the original image
+    :param affine: affine of the original image
+    """
+    img = nib.load(fname_in)
+    data = np.asanyarray(img.dataobj)
+
+    data_full = np.zeros(shape, dtype=data.dtype)
+    data_full[bbox] = data
+
+    nib.save(nib.Nifti1Image(data_full, affine, img.header), fname_out)
+
+
+def get_slab_chunks(n_slices, n_slabs, margin_vox):
+    """
+    Split the slices into consecutive slabs, each extended by a margin providing context for the inference
+    :param n_slices: number of slices (third axis)
+    :param n_slabs: number of slabs
+    :param margin_vox: margin (in voxels) added on both sides of each slab
+    :return: list of (z_start, z_end, core_start, core_end): slab with the margin and the slices (core) which are kept
+    from the prediction of this slab
+    """
+    bounds = np.linspace(0, n_slices, n_slabs + 1).round().astype(int)
+    chunks = list()
+    for core_start, core_end in zip(bounds[:-1], bounds[1:]):
+        chunks.append((max(int(core_start) - margin_vox, 0), min(int(core_end) + margin_vox, n_slices),
+                       int(core_start), int(core_end)))
+    return chunks
@@ -0,0 +1,198 @@
+"""
+Sparse and quantized storage of nnUNet class probabilities.
+
+Full float probability maps for all classes (background + one class per rootlet level) are too large to keep for every
+subject. This module stores each class as a uint8-quantized map (probability * 255) cropped to the bounding box of its
+non-zero voxels. The crops are written either to a compressed `.npz` file or to a chunked Zarr store (requires the
+optional `zarr` package).
+
+The `SparseProbabilities` class reads such a file back and rebuilds the dense array of a single class only when it is
+requested.
+
+Example:
+    from sparse_probabilities import SparseProbabilities
+
+    with SparseProbabilities('sub-001_T2w_label-rootlet_probabilities.npz') as probabilities:
+        print(probabilities.num_classes, probabilities.shape)
+        prob_level_3 = probabilities[3]     # dense float32 array for class 3
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# Quantization scale: probability 1.0 is stored as 255
+SCALE = 255
+# Chunk size used for the Zarr store
+ZARR_CHUNK_SIZE = 64
+
+
+def get_bounding_box(mask):
+    """
+    Get the bounding box of the non-zero voxels of a mask
+    :param mask: nd-array
+    :return: bbox: list of slices; None if the mask is empty
+    """
+    bbox = list()
+    for axis in range(mask.ndim):
+        # Collapse all axes except the current one
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return bbox
+
+
+def quantize(probability):
+    """
+    Quantize a probability map to uint8
+    :param probability: nd-array with values in [0, 1]
+    :return: nd-array of uint8 (probability * 255, rounded)
+    """
+    return np.rint(np.clip(probability, 0, 1) * SCALE).astype(np.uint8)
+
+
+def save_sparse_probabilities(probabilities, fname_out, metadata=None):
+    """
+    Save class probabilities as uint8-quantized per-class maps cropped to each class's bounding box.
+    :param probabilities: nd-array of shape (num_classes, *spatial_shape), for example the `probabilities` array
+    saved by nnUNet
+    :param fname_out: output file name; `.npz` for a compressed NumPy archive, `.zarr` for a chunked Zarr store
+    :param metadata: optional dict with additional information stored alongside the maps (e.g., orientation)
+    :return: fname_out
+    """
+    num_classes = probabilities.shape[0]
+    spatial_shape = probabilities.shape[1:]
+
+    crops = dict()
+    bboxes = dict()
+    # Loop across classes
+    for c in range(num_classes):
+        quantized = quantize(probabilities[c])
+        bbox = get_bounding_box(quantized > 0)
+        # Store an empty crop if the class is not present at all
+        if bbox is None:
+            bbox = [slice(0, 0)] * len(spatial_shape)
+        crops[c] = quantized[tuple(bbox)]
+        # Flatten the bounding box to [start_0, stop_0, start_1, stop_1, ...]
+        bboxes[c] = np.array([[s.start, s.stop] for s in bbox], dtype=np.int64).ravel()
+
+    metadata = dict() if metadata is None else metadata
+
+    if fname_out.endswith('.npz'):
+        arrays = {'shape': np.array(spatial_shape, dtype=np.int64),
+                  'num_classes': np.array(num_classes),
+                  'scale': np.array(SCALE)}
+        for c in range(num_classes):
+            arrays[f'class_{c}'] = crops[c]
+            arrays[f'bbox_{c}'] = bboxes[c]
+        for key, value in metadata.items():
+            arrays[f'meta_{key}'] = np.array(value)
+        np.savez_compressed(fname_out, **arrays)
+    elif fname_out.endswith('.zarr'):
+        if zarr is None:
+            raise ImportError('Saving probabilities as a Zarr store requires the "zarr" package. '
+                              'Install it using "pip install zarr" or use the ".npz" format instead.')
+        group = zarr.open_group(fname_out, mode='w')
+        group.attrs.update({'shape': list(spatial_shape),
+                            'num_classes': num_classes,
+                            'scale': SCALE,
+                            'metadata': metadata})
+        for c in range(num_classes):
+            chunks = tuple(max(1, min(ZARR_CHUNK_SIZE, dim)) for dim in crops[c].shape)
+            array = group.create_dataset(f'class_{c}', data=crops[c], chunks=chunks)
+            array.attrs['bbox'] = bboxes[c].tolist()
+    else:
+        raise ValueError(f'Unsupported format of {fname_out}. Use ".npz" or ".zarr".')
+
+    return fname_out
+
+
+class SparseProbabilities:
+    """
+    Lazy reader of probabilities saved by `save_sparse_probabilities()`. Only the crop of the requested class is read
+    from the disk, and the dense array is rebuilt on request.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.is_npz = fname.endswith('.npz')
+        if self.is_npz:
+            # np.load returns a lazy NpzFile; individual arrays are read on access
+            self._store = np.load(fname)
+            self.shape = tuple(int(s) for s in self._store['shape'])
+            self.num_classes = int(self._store['num_classes'])
+            self.scale = int(self._store['scale'])
+            self.metadata = {key[len('meta_'):]: self._store[key].tolist()
+                             for key in self._store.files if key.startswith('meta_')}
+        elif os.path.isdir(fname) or fname.endswith('.zarr'):
+            if zarr is None:
+                raise ImportError('Reading a Zarr store requires the "zarr" package. Install it using '
+                                  '"pip install zarr".')
+            self._store = zarr.open_group(fname, mode='r')
+            self.shape = tuple(self._store.attrs['shape'])
+            self.num_classes = int(self._store.attrs['num_classes'])
+            self.scale = int(self._store.attrs['scale'])
+            self.metadata = dict(self._store.attrs['metadata'])
+        else:
+            raise ValueError(f'Unsupported format of {fname}. Use ".npz" or ".zarr".')
+
+    def get_bbox(self, c):
+        """
+        Get the bounding box of a class
+        :param c: class index
+        :return: tuple of slices
+        """
+        if self.is_npz:
+            bbox = self._store[f'bbox_{c}']
+        else:
+            bbox = self._store[f'class_{c}'].attrs['bbox']
+        return tuple(slice(int(start), int(stop)) for start, stop in zip(bbox[0::2], bbox[1::2]))
+
+    def get_quantized(self, c):
+        """
+        Get the cropped uint8-quantized map of a class
+        :param c: class index
+        :return: crop: nd-array of uint8
+        :return: bbox: tuple of slices locating the crop in the full volume
+        """
+        if not 0 <= c < self.num_classes:
+            raise IndexError(f'Class {c} out of range (number of classes: {self.num_classes}).')
+        return np.asarray(self._store[f'class_{c}']), self.get_bbox(c)
+
+    def load_class(self, c, dtype=np.float32):
+        """
+        Rebuild the dense probability map of a single class
+        :param c: class index
+        :param dtype: output dtype
+        :return: nd-array of shape `self.shape` with probabilities in [0, 1]
+        """
+        crop, bbox = self.get_quantized(c)
+        dense = np.zeros(self.shape, dtype=dtype)
+        dense[bbox] = crop.astype(dtype) / self.scale
+        return dense
+
+    def __getitem__(self, c):
+        return self.load_class(c)
+
+    def __len__(self):
+        return self.num_classes
+
+    def __iter__(self):
+        for c in range(self.num_classes):
+            yield self.load_class(c)
+
+    def close(self):
+        if self.is_npz:
+            self._store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,161 @@
+"""
+Build a probabilistic atlas of the spinal levels in the PAM50 space from the spinal levels of many subjects (e.g.,
+obtained using the proposed nnUNet method and warped to the PAM50 template).
+
+The subjects are read one at a time and the number of subjects labeling each voxel with each level is accumulated into
+memory-mapped uint16 arrays (one per level, the size of the template) stored in a temporary folder, so the memory use
+does not depend on the number of subjects.
+
+Then, the script saves:
+    - the probability map of each level (number of subjects / total number of subjects):
+      <output folder>/PAM50_spinal_levels_probability_level-<level>.nii.gz
+    - the max-probability label map, i.e., the most probable level of each voxel (the lower level in case of equal
+      probabilities; 0 if the probability is below -threshold):
+      <output folder>/PAM50_spinal_levels_max_probability.nii.gz
+
+Example:
+    python build_probabilistic_atlas.py -i sub-*_label-rootlet_spinal_levels_PAM50.nii.gz -o atlas
+
+Authors: Jan Valosek
+"""
+
+import os
+import argparse
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from pam50_levels_overlap import load_levels
+
+# Maximum number of subjects of the uint16 counts
+MAX_SUBJECTS = np.iinfo(np.uint16).max
+
+
+def get_parser():
+    """
+    parser function
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Build a probabilistic atlas of the spinal levels in the PAM50 space from the spinal levels of '
+                    'many subjects.',
+        prog=os.path.basename(__file__).strip('.py')
+    )
+    parser.add_argument(
+        '-i',
+        required=True,
+        nargs='+',
+        help='Paths to the nii files with the spinal levels of the subjects in the PAM50 space. '
+             'Example: sub-001_T2w_label-rootlet_spinal_levels_PAM50.nii.gz '
+             'sub-002_T2w_label-rootlet_spinal_levels_PAM50.nii.gz'
+    )
+    parser.add_argument(
+        '-o',
+        required=True,
+        help='Path to the output folder (created if it does not exist).'
+    )
+    parser.add_argument(
+        '-threshold',
+        required=False,
+        type=float,
+        default=0.0,
+        help='Minimum probability of the levels in the max-probability label map. Default: 0 (all voxels labeled by at '
+             'least one subject).'
+    )
+
+    return parser
+
+
+def accumulate_counts(fnames, tmpdir):
+    """
+    Accumulate the number of subjects labeling each voxel with each level, one subject at a time
+    :param fnames: paths to the nii files with the spinal levels of the subjects (same shape)
+    :param tmpdir: folder for the memory-mapped counts
+    :return: counts: dict {level: memory-mapped uint16 array of the shape of the template}, sorted by level
+    :return: nii_template: nibabel image of the first subject (its affine and header are used for the outputs)
+    """
+    if len(fnames) > MAX_SUBJECTS:
+        raise ValueError(f'At most {MAX_SUBJECTS} subjects are supported, got {len(fnames)}.')
+
+    counts = dict()
+    nii_template = nib.load(fnames[0])
+    for i, fname in enumerate(fnames, start=1):
+        print(f'Processing subject {i}/{len(fnames)}: {fname}')
+        nii = nib.load(fname)
+        if nii.shape[:3] != nii_template.shape[:3]:
+            raise ValueError(f'The shape of {fname} {nii.shape} differs from the template {nii_template.shape}.')
+        if not np.allclose(nii.affine, nii_template.affine, atol=1e-3):
+            print(f'WARNING: The affine of {fname} differs from {fnames[0]}.')
+
+        data = load_levels(fname).ravel()
+        # Indices of the labeled voxels; each voxel has one level, so the indices of a level are unique
+        idx = np.flatnonzero(data)
+        levels = data[idx]
+        for level in np.unique(levels).tolist():
+            if level not in counts:
+                counts[level] = np.lib.format.open_memmap(os.path.join(tmpdir, f'counts_level-{level}.npy'),
+                                                          mode='w+', dtype=np.uint16, shape=nii_template.shape[:3])
+            counts[level].reshape(-1)[idx[levels == level]] += 1
+
+    return dict(sorted(counts.items())), nii_template
+
+
+def save_atlas(counts, n_subjects, nii_template, path_out, threshold=0.0):
+    """
+    Save the probability map of each level and the max-probability label map; one level is loaded at a time
+    :param counts: dict {level: uint16 array} returned by `accumulate_counts()`
+    :param n_subjects: number of subjects
+    :param nii_template: nibabel image whose affine and header are used for the outputs
+    :param path_out: output folder
+    :param threshold: minimum probability of the levels in the max-probability label map
+    :return: list of paths to the saved files
+    """
+    shape = nii_template.shape[:3]
+    header = nii_template.header.copy()
+    fnames_out = list()
+
+    # Running maximum of the counts and the corresponding level
+    labels = np.zeros(shape, dtype=np.uint8)
+    counts_max = np.zeros(shape, dtype=np.uint16)
+    for level, counts_level in counts.items():
+        probability = counts_level.astype(np.float32) / n_subjects
+        header.set_data_dtype(np.float32)
+        fname_out = os.path.join(path_out, f'PAM50_spinal_levels_probability_level-{level}.nii.gz')
+        nib.save(nib.Nifti1Image(probability, nii_template.affine, header), fname_out)
+        fnames_out.append(fname_out)
+
+        winner = (counts_level > counts_max) & (probability > threshold)
+        labels[winner] = level
+        counts_max[winner] = counts_level[winner]
+
+    header.set_data_dtype(np.uint8)
+    fname_out = os.path.join(path_out, 'PAM50_spinal_levels_max_probability.nii.gz')
+    nib.save(nib.Nifti1Image(labels, nii_template.affine, header), fname_out)
+    fnames_out.append(fname_out)
+
+    return fnames_out
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    os.makedirs(args.o, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix='pam50_atlas_', dir=args.o)
+    try:
+        counts, nii_template = accumulate_counts(args.i, tmpdir)
+        fnames_out = save_atlas(counts, len(args.i), nii_template, args.o, args.threshold)
+        print(f'Levels: {list(counts)}')
+        # Close the memory-mapped counts before removing them
+        del counts
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('Atlas saved as:')
+    print('\n'.join(fnames_out))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,11 @@ The script accepts two input arguments:
     - path to nii file with levels obtained using the proposed nnUNet method
     - path to nii file with SCT levels based on Frostell et al. 2016
 
-Then, the script iterates over levels (e.g., 2, 3, etc.) and computes the percentage overlap between the two
-segmentations. The percentage overlap is computed as the number of voxels that are present in both segmentations divided
-by the total number of voxels in the SCT segmentation. The result is printed to the console.
+Then, the script computes the overlap matrix of the two segmentations (number of voxels of each nnUNet level x SCT
+level pair) in one pass and reports, for each nnUNet level (e.g., 2, 3, etc.), the percentage overlap with the same SCT
+level. The percentage overlap is computed as the number of voxels that are present in both segmentations divided by the
+total number of voxels in the SCT segmentation. The result is printed to the console. Optionally (-o), the full overlap
+matrix (percentage of each SCT level covered by each nnUNet level) is saved as a CSV file.
 
 Authors: Jan Valosek
 """
@@ -18,6 +20,7 @@ import argparse
 
 import nibabel as nib
 import numpy as np
+import pandas as pd
 
 
 def get_parser():
@@ -42,47 +45,78 @@ def get_parser():
         help='Path to the nii file with SCT levels based on Frostell et al. 2016.'
              'Example: "${SCT_DIR}/data/PAM50/template/PAM50_spinal_levels.nii.gz"'
     )
+    parser.add_argument(
+        '-o',
+        required=False,
+        help='Path to the output CSV file with the overlap matrix (rows: nnUNet levels, columns: SCT levels, values: '
+             'percentage of the voxels of the SCT level). Example: "PAM50_levels_overlap.csv"'
+    )
 
     return parser
 
 
+def load_levels(fname):
+    """
+    Load a segmentation of the spinal levels
+    :param fname: path to the nii file
+    :return: 3D int64 array with the levels
+    """
+    data = np.rint(np.asanyarray(nib.load(fname).dataobj)).astype(np.int64)
+    if data.min() < 0:
+        raise ValueError(f'The levels must be non-negative: {fname}')
+    return data
+
+
+def get_overlap_matrix(data_nnunet, data_sct):
+    """
+    Compute the number of voxels of each (nnUNet level, SCT level) pair in one pass: the level pairs are encoded into
+    one integer per voxel and counted with np.bincount
+    :param data_nnunet: 3D int array with the nnUNet levels
+    :param data_sct: 3D int array with the SCT levels
+    :return: overlap: 2D int64 array (nnUNet levels x SCT levels), including the background (0)
+    :return: levels_nnunet: 1D array with the nnUNet levels present in the segmentation (rows of the matrix)
+    :return: levels_sct: 1D array with the SCT levels present in the segmentation (columns of the matrix)
+    """
+    n_sct = int(data_sct.max()) + 1
+    n_nnunet = int(data_nnunet.max()) + 1
+    codes = data_nnunet.ravel() * n_sct + data_sct.ravel()
+    overlap = np.bincount(codes, minlength=n_nnunet * n_sct).reshape(n_nnunet, n_sct)
+
+    # Keep the levels present in the segmentations (and the background)
+    levels_nnunet = np.flatnonzero(overlap.sum(axis=1) | (np.arange(n_nnunet) == 0))
+    levels_sct = np.flatnonzero(overlap.sum(axis=0) | (np.arange(n_sct) == 0))
+    return overlap[np.ix_(levels_nnunet, levels_sct)], levels_nnunet, levels_sct
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
 
     # Load the data
-    nnunet = nib.load(args.nnunet).get_fdata()
-    sct = nib.load(args.sct).get_fdata()
+    nnunet = load_levels(args.nnunet)
+    sct = load_levels(args.sct)
 
     # Check if the two segmentations have the same shape
     if nnunet.shape != sct.shape:
         raise ValueError('The two segmentations have different shapes.')
 
-    # Initialize the list for the results
-    results = list()
-
-    # Get unique levels from the nnUNet segmentation; skip 0 (background)
-    levels = np.unique(nnunet)[1:]
-
-    # Iterate over levels
-    for level in levels:
-        # Get the indices of the voxels that belong to the level in the SCT segmentation
-        idx_sct = np.where(sct == level)
-        # Get the indices of the voxels that belong to the level in the nnUNet segmentation
-        idx_nnunet = np.where(nnunet == level)
-        # Info: the commands above return tuples (x, y, z)
-
-        # Compute the percentage overlap
-        overlap = len(set(zip(*idx_sct)).intersection(set(zip(*idx_nnunet)))) / len(idx_sct[0])
-        # Explanation:
-        # `zip(*idx_xxx)` unpacks the idx_xxx tuple and zips the elements together (converting the list of coordinates
-        # into a set of voxel indices)
-
-        results.append(overlap)
-
-    # Print the results
-    for level, overlap in enumerate(results, start=2):
-        print(f'Level {level}: {overlap * 100:.2f}% overlap')
+    overlap, levels_nnunet, levels_sct = get_overlap_matrix(nnunet, sct)
+    # Percentage of the voxels of each SCT level covered by each nnUNet level
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overlap_percent = overlap / overlap.sum(axis=0) * 100
+    df = pd.DataFrame(overlap_percent, index=pd.Index(levels_nnunet, name='nnunet_level'),
+                      columns=pd.Index(levels_sct, name='sct_level'))
+
+    # Print the results; skip 0 (background)
+    for level in levels_nnunet[levels_nnunet > 0]:
+        if level in levels_sct:
+            print(f'Level {level}: {df.loc[level, level]:.2f}% overlap')
+        else:
+            print(f'Level {level}: not present in the SCT levels')
+
+    if args.o is not None:
+        df.drop(index=0, columns=0).to_csv(args.o, float_format='%.2f')
+        print(f'Overlap matrix saved as {args.o}.')
 
 
 if __name__ == '__main__':
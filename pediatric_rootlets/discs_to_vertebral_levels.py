@@ -11,11 +11,17 @@
 # Authors: Katerina Krejci
 # Inspired by https://github.com/sct-pipeline/pmj-based-csa/blob/419ece49c81782f23405d89c7b4b15d8e03ed4bd/get_distance_pmj_disc.py
 
+import os
+import sys
 import argparse
 import numpy as np
 import pandas as pd
 from spinalcordtoolbox.image import Image
 
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from centerline import get_distance_from_pmj, DistanceLookupTable
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -28,29 +34,6 @@ def get_parser():
     return parser
 
 
-def get_distance_from_pmj(centerline_points, z_index, px, py, pz):
-    """
-    Compute distance from projected PMJ on centerline and cord centerline.
-    :param centerline_points: 3xn array: Centerline in continuous coordinate (float) for each slice in RPI orientation.
-    :param z_index: z index PMJ on the centerline.
-    :param px: x pixel size.
-    :param py: y pixel size.
-    :param pz: z pixel size.
-    :return: nd-array: distance from PMJ and corresponding indexes.
-    """
-    length = 0
-    arr_length = [0]
-    for i in range(z_index, 0, -1):
-        distance = np.sqrt(((centerline_points[0, i] - centerline_points[0, i - 1]) * px) ** 2 +
-                           ((centerline_points[1, i] - centerline_points[1, i - 1]) * py) ** 2 +
-                           ((centerline_points[2, i] - centerline_points[2, i - 1]) * pz) ** 2)
-        length += distance
-        arr_length.append(length)
-    arr_length = arr_length[::-1]
-    arr_length = np.stack((arr_length, centerline_points[2][:z_index + 1]), axis=0)
-    return arr_length
-
-
 def main():
     parser = get_parser()
     args = parser.parse_args()
@@ -74,6 +57,7 @@ def main():
 
     # Compute distance from PMJ of the centerline
     arr_distance = get_distance_from_pmj(centerline, centerline[2].argmax(), px, py, pz)
+    distance_lookup = DistanceLookupTable(arr_distance)
 
     # Find slices, where are contained disc labels
     discs_slices = np.where(disc_label.data != 0)[-1]
@@ -88,10 +72,8 @@ def main():
         vertebral_level = idx + 1
         actual_slice_end = discs_slices[idx]
         actual_slice_start = discs_slices[idx+1]
-        index_start = int(np.where(arr_distance[1] == actual_slice_start)[0])
-        distance_from_pmj_start = float(arr_distance[0][index_start])
-        index_end = int(np.where(arr_distance[1] == actual_slice_end)[0])
-        distance_from_pmj_end = float(arr_distance[0][index_end])
+        distance_from_pmj_start = distance_lookup.get_distance(actual_slice_start)
+        distance_from_pmj_end = distance_lookup.get_distance(actual_slice_end)
         output_data.append({'spinal_level': vertebral_level,
                                 'fname': fname,
                                 'slice_start': actual_slice_start,
@@ -0,0 +1,76 @@
+"""
+Bounding-box cropping shared by the scripts processing segmentations (e.g., inter-rater_variability/spinal_levels.py,
+inter-rater_variability/02b_compute_f1_and_dice.py).
+
+The rootlets and the spinal cord occupy a small fraction of the field of view, so the analysis is run on views of the
+union bounding box of the non-zero masks, and the results are mapped back to the full-volume coordinates.
+
+Example:
+    bbox = get_bbox(data_gt, data_pred, margin=5)
+    data_gt_crop, data_pred_crop = crop_to_bbox(bbox, data_gt, data_pred)
+    ...
+    z_full = z_crop + get_bbox_offset(bbox)[2]                         # indices in the full volume
+    data_full = uncrop(data_result_crop, bbox, data_gt.shape)       # array in the full volume
+"""
+
+import numpy as np
+
+
+def get_bbox(*arrays, margin=0):
+    """
+    Get the union bounding box of the non-zero voxels of one or more arrays of the same shape
+    :param arrays: arrays (e.g., segmentations)
+    :param margin: margin (in voxels) added on both sides along each axis; clipped to the array borders
+    :return: tuple of slices (one per axis); None if all arrays are empty
+    """
+    shape = arrays[0].shape
+    if any(data.shape != shape for data in arrays):
+        raise ValueError(f'The arrays must have the same shape, got {[data.shape for data in arrays]}.')
+
+    bbox = list()
+    for axis in range(len(shape)):
+        other_axes = tuple(a for a in range(len(shape)) if a != axis)
+        # Projection of the union of the masks on the current axis
+        projection = np.zeros(shape[axis], dtype=bool)
+        for data in arrays:
+            projection |= np.any(data, axis=other_axes)
+        nonzero = np.flatnonzero(projection)
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(max(int(nonzero[0]) - margin, 0), min(int(nonzero[-1]) + margin + 1, shape[axis])))
+
+    return tuple(bbox)
+
+
+def get_bbox_offset(bbox):
+    """
+    Get the offset of the bounding box, i.e., the full-volume index of the first voxel of the bounding box
+    :param bbox: tuple of slices returned by `get_bbox()`
+    :return: tuple of ints (one per axis)
+    """
+    return tuple(s.start for s in bbox)
+
+
+def crop_to_bbox(bbox, *arrays):
+    """
+    Crop arrays to the bounding box. The crops are views (no copy), so writing into them modifies the full arrays.
+    :param bbox: tuple of slices returned by `get_bbox()`
+    :param arrays: arrays to crop
+    :return: cropped array, or tuple of cropped arrays if more than one array is given
+    """
+    cropped = tuple(data[bbox] for data in arrays)
+    return cropped[0] if len(cropped) == 1 else cropped
+
+
+def uncrop(data_cropped, bbox, shape, fill_value=0):
+    """
+    Map a cropped array back to the full volume
+    :param data_cropped: array of the shape of the bounding box
+    :param bbox: tuple of slices returned by `get_bbox()`
+    :param shape: shape of the full volume
+    :param fill_value: value outside the bounding box
+    :return: array of the full volume shape (same dtype as data_cropped)
+    """
+    data = np.full(shape, fill_value, dtype=data_cropped.dtype)
+    data[bbox] = data_cropped
+    return data
@@ -0,0 +1,131 @@
+"""
+Centerline geometry shared by the scripts computing distances from the pontomedullary junction (PMJ) along the spinal
+cord centerline (e.g., inter-rater_variability/02a_rootlets_to_spinal_levels.py,
+pediatric_rootlets/discs_to_vertebral_levels.py).
+
+The centerline is a 3xn array with the (continuous) x, y, z voxel coordinates of the centerline for each slice in the
+RPI orientation, extrapolated up to the PMJ slice. It is obtained either in-process from the spinal cord segmentation
+and the PMJ label (`get_centerline_from_pmj()`), or from the CSV file generated by
+`sct_process_segmentation -pmj ... -v 2`.
+
+Example:
+    centerline = get_centerline_from_pmj(im_seg.data, im_pmj.data, im_seg.dim[4:7])
+    arr_distance = get_distance_from_pmj(centerline, centerline[2].argmax(), px, py, pz)
+    distance_lookup = DistanceLookupTable(arr_distance)
+    distance_lookup.get_distance(120)       # distance (mm) between the PMJ and the slice 120
+    distance_lookup.get_distance(120.5)     # linearly interpolated between the slices 120 and 121
+"""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+
+def get_centerline_from_pmj(data_seg, data_pmj, pixdim, smooth=10, extrapolation_length=20):
+    """
+    Get the spinal cord centerline extrapolated up to the pontomedullary junction (PMJ), in-process (no files):
+        - centroid of the spinal cord segmentation in each slice (slices without segmentation are interpolated)
+        - Gaussian smoothing of the centroids along the superior-inferior axis
+        - linear extrapolation from the top of the segmentation up to the PMJ slice
+    :param data_seg: 3D array with the spinal cord segmentation (RPI orientation)
+    :param data_pmj: 3D array with the PMJ label (RPI orientation)
+    :param pixdim: voxel size (px, py, pz) in mm
+    :param smooth: standard deviation of the Gaussian smoothing in mm
+    :param extrapolation_length: length (in mm) of the top part of the centerline used to fit the extrapolation
+    :return: 3xn array: x, y, z voxel coordinates of the centerline for each slice from the bottom of the segmentation
+    to the PMJ slice (the last point)
+    """
+    if not np.any(data_pmj):
+        raise ValueError('The PMJ label file is empty.')
+    if not np.any(data_seg):
+        raise ValueError('The spinal cord segmentation is empty.')
+    pz = float(pixdim[2])
+    z_pmj = int(np.nonzero(data_pmj)[2].max())
+
+    # Centroid of each slice in one pass: sums of the x and y coordinates of the voxels per slice
+    x, y, z = np.nonzero(data_seg)
+    n_slices = data_seg.shape[2]
+    counts = np.bincount(z, minlength=n_slices)
+    slices_seg = np.flatnonzero(counts)
+    x_mean = np.bincount(z, weights=x, minlength=n_slices)[slices_seg] / counts[slices_seg]
+    y_mean = np.bincount(z, weights=y, minlength=n_slices)[slices_seg] / counts[slices_seg]
+
+    # Fill the slices without segmentation between the bottom and the top of the segmentation, then smooth
+    slices = np.arange(slices_seg[0], slices_seg[-1] + 1)
+    x_ctl = gaussian_filter1d(np.interp(slices, slices_seg, x_mean), smooth / pz, mode='nearest')
+    y_ctl = gaussian_filter1d(np.interp(slices, slices_seg, y_mean), smooth / pz, mode='nearest')
+
+    if z_pmj > slices[-1]:
+        # Fit a line to the top part of the centerline and extrapolate it up to the PMJ slice
+        n_fit = min(max(int(round(extrapolation_length / pz)), 2), len(slices))
+        slices_extrapolated = np.arange(slices[-1] + 1, z_pmj + 1)
+        if n_fit >= 2:
+            x_ctl = np.append(x_ctl, np.polyval(np.polyfit(slices[-n_fit:], x_ctl[-n_fit:], 1), slices_extrapolated))
+            y_ctl = np.append(y_ctl, np.polyval(np.polyfit(slices[-n_fit:], y_ctl[-n_fit:], 1), slices_extrapolated))
+        else:
+            x_ctl = np.append(x_ctl, np.full(len(slices_extrapolated), x_ctl[-1]))
+            y_ctl = np.append(y_ctl, np.full(len(slices_extrapolated), y_ctl[-1]))
+        slices = np.append(slices, slices_extrapolated)
+    else:
+        # The segmentation goes above the PMJ; keep the centerline below the PMJ only
+        keep = slices <= z_pmj
+        if not np.any(keep):
+            raise ValueError('The PMJ is below the spinal cord segmentation.')
+        slices, x_ctl, y_ctl = slices[keep], x_ctl[keep], y_ctl[keep]
+
+    return np.stack((x_ctl, y_ctl, slices.astype(float)), axis=0)
+
+
+def get_distance_from_pmj(centerline_points, z_index, px, py, pz):
+    """
+    Compute distance from projected pontomedullary junction (PMJ) on centerline and cord centerline.
+    Inspiration: https://github.com/sct-pipeline/pmj-based-csa/blob/419ece49c81782f23405d89c7b4b15d8e03ed4bd/get_distance_pmj_disc.py#L40-L60
+    :param centerline_points: 3xn array: Centerline in continuous coordinate (float) for each slice in RPI orientation.
+    :param z_index: z index PMJ on the centerline.
+    :param px: x pixel size.
+    :param py: y pixel size.
+    :param pz: z pixel size.
+    :return: nd-array: distance from PMJ and corresponding indexes.
+    """
+    # Centerline points from the first point to the PMJ, in mm
+    points = centerline_points[:, :z_index + 1] * np.array([px, py, pz])[:, np.newaxis]
+    # Length of the segments between consecutive points
+    segment_lengths = np.sqrt(np.sum(np.diff(points, axis=1) ** 2, axis=0))
+    # Arc length from the PMJ, accumulated from the PMJ downwards; the PMJ itself has distance 0
+    arr_length = np.append(np.cumsum(segment_lengths[::-1])[::-1], 0)
+
+    return np.stack((arr_length, centerline_points[2][:z_index + 1]), axis=0)
+
+
+class DistanceLookupTable:
+    """
+    Lookup table from the slice index to the distance from the PMJ along the centerline
+    :param arr_distance: 2xn array returned by `get_distance_from_pmj()`: distance from the PMJ and the corresponding
+    slice indexes
+    """
+    def __init__(self, arr_distance):
+        slices = np.round(arr_distance[1]).astype(int)
+        self.slice_min = int(slices.min())
+        # Slices not on the centerline are nan
+        self.table = np.full(int(slices.max()) - self.slice_min + 1, np.nan)
+        self.table[slices - self.slice_min] = arr_distance[0]
+
+    def get_distance(self, z):
+        """
+        Get the distance from the PMJ of a slice. Fractional slices are linearly interpolated between the neighbouring
+        slices.
+        :param z: slice index (int or float) or array of slice indexes
+        :return: distance from the PMJ in mm (float or array); nan for slices outside the centerline (or z = nan)
+        """
+        index = np.asarray(z, dtype=float) - self.slice_min
+        valid = np.isfinite(index) & (index >= 0) & (index <= len(self.table) - 1)
+        index = np.where(valid, index, 0)
+
+        lower = np.floor(index).astype(int)
+        upper = np.minimum(lower + 1, len(self.table) - 1)
+        fraction = index - lower
+        # Integer slices are read directly from the table (also when the next slice is nan)
+        distance = np.where(fraction == 0, self.table[lower],
+                            self.table[lower] * (1 - fraction) + self.table[upper] * fraction)
+        distance = np.where(valid, distance, np.nan)
+
+        return float(distance) if distance.ndim == 0 else distance
@@ -0,0 +1,165 @@
+"""
+Consensus of the multi-class segmentations (one class per spinal level) of several raters, computed level by level.
+
+Fusion strategies of the binarized level masks:
+    - staple: binary STAPLE of the level (see staple.py); probability of the level estimated together with the
+      performance of each rater
+    - majority: fraction of the raters labeling the voxel with the level
+    - weighted: vote weighted by the performance of each rater (sensitivity and specificity) from a previous STAPLE
+      run, i.e., the probability of the level given the fixed performance of the raters (one STAPLE E-step)
+
+The probability maps are thresholded to get the consensus masks (see DEFAULT_THRESHOLDS). The levels are independent
+and are processed concurrently in a pool of threads (numpy releases the GIL during most of the work); the time of each
+level is reported. The masks of the levels can overlap; the multi-class segmentation is reassembled by assigning each
+voxel to its most probable level (see `assemble_levels()`).
+
+Example:
+    results = compute_consensus(data_segmentations, levels=[2, 3, 4], strategy='majority', jobs=4)
+    data_consensus, n_contested = assemble_levels(results, data_segmentations[0].shape, DEFAULT_THRESHOLDS['majority'])
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bbox import get_bbox_offset
+from staple import get_patterns, get_posterior, patterns_to_bbox, staple, staple_patterns
+
+STRATEGIES = ['staple', 'majority', 'weighted']
+# Default thresholds of the probability maps
+DEFAULT_THRESHOLDS = {'staple': 0.95, 'majority': 0.5, 'weighted': 0.5}
+
+
+def get_rater_performance(segmentations):
+    """
+    Estimate the performance of each rater with a STAPLE run on the whole segmentations (all levels together)
+    :param segmentations: list of int arrays of the same shape (one per rater)
+    :return: sensitivity: 1D array with the sensitivity of each rater
+    :return: specificity: 1D array with the specificity of each rater
+    """
+    _, sensitivity, specificity, _, _ = staple([data > 0 for data in segmentations], cropped=True)
+    return sensitivity, specificity
+
+
+def save_performance(fname, sensitivity, specificity, raters=None):
+    """
+    Save the performance of the raters to a JSON file
+    :param fname: path to the JSON file
+    :param sensitivity: 1D array with the sensitivity of each rater
+    :param specificity: 1D array with the specificity of each rater
+    :param raters: list of names of the raters (e.g., paths to their segmentations)
+    """
+    with open(fname, 'w') as f:
+        json.dump({'raters': list(raters) if raters is not None else None,
+                   'sensitivity': [float(value) for value in sensitivity],
+                   'specificity': [float(value) for value in specificity]}, f, indent=4)
+
+
+def load_performance(fname):
+    """
+    Load the performance of the raters saved by `save_performance()`
+    :param fname: path to the JSON file
+    :return: sensitivity: 1D array with the sensitivity of each rater
+    :return: specificity: 1D array with the specificity of each rater
+    """
+    with open(fname) as f:
+        performance = json.load(f)
+    return np.array(performance['sensitivity']), np.array(performance['specificity'])
+
+
+def fuse_level(segmentations, level, strategy='staple', performance=None):
+    """
+    Compute the probability map of one level within the union bounding box of the raters' masks of the level
+    :param segmentations: list of int arrays of the same shape (one per rater)
+    :param level: level (label value)
+    :param strategy: fusion strategy (see STRATEGIES)
+    :param performance: (sensitivity, specificity) of the raters; required by the weighted strategy
+    :return: dict with the level, the probabilities (float32 array of the shape of the bounding box; None if no rater
+    labeled the level), the bbox, the probability_outside (probability of the voxels outside the bounding box), the
+    sensitivity and specificity of the raters (STAPLE and weighted strategies; None otherwise) and the time (in s)
+    """
+    start = time.time()
+    masks = [data == level for data in segmentations]
+    patterns, counts, inverse, bbox = get_patterns(masks, masks[0].shape)
+
+    sensitivity, specificity = None, None
+    if strategy == 'staple':
+        probabilities, sensitivity, specificity, _ = staple_patterns(patterns, counts)
+    elif strategy == 'majority':
+        probabilities = patterns.mean(axis=1)
+    elif strategy == 'weighted':
+        if performance is None:
+            raise ValueError('The weighted strategy requires the performance of the raters.')
+        sensitivity, specificity = performance
+        if len(sensitivity) != len(segmentations):
+            raise ValueError(f'The performance of {len(sensitivity)} raters is given for {len(segmentations)} '
+                             f'segmentations.')
+        # Prior of the level: average fraction of the voxels labeled with the level
+        prior = np.dot(counts, patterns.mean(axis=1)) / counts.sum()
+        probabilities = get_posterior(patterns, prior, sensitivity, specificity)
+    else:
+        raise ValueError(f'Unknown strategy: {strategy}. Choose from {STRATEGIES}.')
+
+    probabilities_bbox, probability_outside = patterns_to_bbox(probabilities.astype(np.float32), patterns, inverse,
+                                                               bbox)
+    return {'level': level, 'probabilities': probabilities_bbox, 'bbox': bbox,
+            'probability_outside': probability_outside, 'sensitivity': sensitivity, 'specificity': specificity,
+            'time': time.time() - start}
+
+
+def compute_consensus(segmentations, levels, strategy='staple', performance=None, jobs=1):
+    """
+    Compute the probability maps of the levels concurrently (see `fuse_level()`)
+    :param segmentations: list of int arrays of the same shape (one per rater)
+    :param levels: list of levels (label values)
+    :param strategy: fusion strategy (see STRATEGIES)
+    :param performance: (sensitivity, specificity) of the raters used by the weighted strategy; None to estimate it
+    with `get_rater_performance()`
+    :param jobs: number of threads
+    :return: dict {level: dict returned by `fuse_level()`}, in the order of the levels
+    """
+    if strategy == 'weighted' and performance is None:
+        performance = get_rater_performance(segmentations)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fuse_level, segmentations, level, strategy, performance) for level in levels]
+        return {result['level']: result for result in (future.result() for future in futures)}
+
+
+def assemble_levels(results, shape, threshold):
+    """
+    Reassemble the multi-class segmentation from the probability maps of the levels: each voxel above the threshold for
+    at least one level gets the level with the highest probability (the lowest level in case of equal probabilities).
+    The labels and the highest probabilities are updated in place, within the union bounding box of the levels.
+    :param results: dict {level: dict returned by `fuse_level()`}
+    :param shape: shape of the segmentations
+    :param threshold: threshold of the probability maps
+    :return: data: uint8 array with the levels
+    :return: n_contested: number of voxels above the threshold for more than one level
+    """
+    data = np.zeros(shape, dtype=np.uint8)
+    results = [results[level] for level in sorted(results) if results[level]['bbox'] is not None]
+    if not results:
+        return data, 0
+
+    # Union bounding box of the levels; the voxels outside are background for all raters
+    bbox = tuple(slice(min(result['bbox'][axis].start for result in results),
+                       max(result['bbox'][axis].stop for result in results)) for axis in range(len(shape)))
+    offset = get_bbox_offset(bbox)
+    data_bbox = data[bbox]
+    probability_max = np.zeros(data_bbox.shape, dtype=np.float32)
+    n_levels = np.zeros(data_bbox.shape, dtype=np.uint8)
+
+    for result in results:
+        # Bounding box of the level within the union bounding box
+        level_bbox = tuple(slice(s.start - o, s.stop - o) for s, o in zip(result['bbox'], offset))
+        probabilities = result['probabilities']
+        mask = probabilities > threshold
+        n_levels[level_bbox] += mask
+        winner = mask & (probabilities > probability_max[level_bbox])
+        data_bbox[level_bbox][winner] = result['level']
+        probability_max[level_bbox][winner] = probabilities[winner]
+
+    return data, int(np.count_nonzero(n_levels > 1))
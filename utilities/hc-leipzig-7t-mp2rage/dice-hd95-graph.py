@@ -16,9 +16,16 @@ Usage for cross-validation (MULTICON model - it is neccessary to specify all fol
 python dice-hd95-graph.py -i /path/to/BIDS_structured_data -dataset-folds fold_0 fold_1 fold_2 fold_3 fold_4 fold_all
 -contrast UNIT1 inv-1_part-mag_MP2RAGE inv2_part-mag_MP2RAGE T2w -output /path/to/output_folder
 
+The metrics can also be read from the SQLite metrics store filled by get_statistics_dsc.py -store (instead of the
+per-subject CSV files):
+python dice-hd95-graph.py -store metrics.sqlite -dataset-folds Dataset001_fold0 -contrast UNIT1
+Only the results computed with the metric settings given by -metrics and -nsd-tau (the same as for
+get_statistics_dsc.py; by default, the defaults of get_statistics_dsc.py) are read from the store.
+
 """
 
 import os
+import sys
 import pandas as pd
 import argparse
 from argparse import RawTextHelpFormatter
@@ -29,6 +36,10 @@ from matplotlib.patches import Patch
 from matplotlib.ticker import FixedLocator
 from matplotlib.ticker import FormatStrFormatter
 
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metrics_store import MetricsStore
+
 
 def get_parser():
     """
@@ -38,7 +49,18 @@ def get_parser():
 
     parser = argparse.ArgumentParser(description='The script makes boxplots/violinplots from data structured in BIDS.',
                                      formatter_class=RawTextHelpFormatter, prog=os.path.basename(__file__))
-    parser.add_argument('-i', required=True, help='Path to the BIDS structured data folder.')
+    parser.add_argument('-i', required=False, help='Path to the BIDS structured data folder. Required if -store is '
+                                                   'not used.')
+    parser.add_argument('-store', required=False, help='Path to the SQLite metrics store (filled by '
+                                                       'get_statistics_dsc.py -store) to read the metrics from, '
+                                                       'instead of the CSV files in the BIDS structured data folder.')
+    parser.add_argument('-metrics', required=False, nargs='+', default=['dsc', 'hd_perc', 'assd', 'nsd'],
+                        choices=['dsc', 'hd', 'hd_perc', 'assd', 'nsd'],
+                        help='Metrics of the results read from the store, as given to get_statistics_dsc.py -metrics '
+                             '(must include dsc and hd_perc). Only used with -store. Default: dsc hd_perc assd nsd')
+    parser.add_argument('-nsd-tau', required=False, type=float, default=1.0,
+                        help='Tolerance (in mm) of the normalized surface distance of the results read from the store, '
+                             'as given to get_statistics_dsc.py -nsd-tau. Only used with -store. Default: 1.0')
     parser.add_argument('-dataset-folds', required=True, nargs='+', help='Dataset and fold names - e.g. '
                                                                          'Dataset001_fold0, Dataset002_fold0.')
 
@@ -51,14 +73,48 @@ def get_parser():
     return parser
 
 
-def create_dataframe(directory, dataset_folds, output, contrast):
+def get_metrics_tables(directory, store=None, settings=None):
+    """
+    This function lists the tables with the metrics of each prediction: the CSV files in the BIDS structured data folder
+    or the entries of the metrics store.
+    :param directory: Path to the BIDS structured data folder.
+    :param store: Path to the SQLite metrics store; None to read the CSV files.
+    :param settings: Metric settings of the results read from the store (dict with 'metrics' and 'nsd_tau').
+    :return: List of (filename, source) tuples; source is the path to the CSV file or a dataframe. For the store, the
+    filename is built from the name of the prediction (<prediction>_metrics.csv), so that it is filtered and parsed as
+    the CSV files.
+    """
+    tables = []
+    if store is not None:
+        df_store = MetricsStore(store).load_all(settings)
+        if df_store.empty:
+            raise ValueError(f'No results with the metric settings {settings} in the store {store}.')
+        for prediction, df in df_store.groupby('prediction'):
+            filename = os.path.basename(prediction).replace('.nii.gz', '') + '_metrics.csv'
+            tables.append((filename, df.drop(columns=['reference', 'prediction']).reset_index(drop=True)))
+        return tables
+
+    # Iterate over each subject directory (in the BIDS structured data folder)
+    for file in os.listdir(directory):
+        subject_dir = os.path.join(directory, file, 'anat')
+        if not os.path.exists(subject_dir):
+            continue
+        # Iterate over each file in the subject directory
+        for filename in os.listdir(subject_dir):
+            tables.append((filename, os.path.join(subject_dir, filename)))
+    return tables
+
+
+def create_dataframe(directory, dataset_folds, output, contrast, store=None, settings=None):
     """
-    This function reads the CSV files with statistical data from the BIDS structured data folder, creates a combined
-    dataframe and returns it.
+    This function reads the CSV files with statistical data from the BIDS structured data folder (or the metrics
+    store), creates a combined dataframe and returns it.
     :param directory: Path to the BIDS structured data folder.
     :param dataset_folds: Dataset and fold names - e.g. Dataset001_fold0, Dataset002_fold0.
     :param output: Path to the output folder, where you want to save the combined CSV file.
     :param contrast: Name of contrast(s), that you want to visualize.
+    :param store: Path to the SQLite metrics store; None to read the CSV files.
+    :param settings: Metric settings of the results read from the store (dict with 'metrics' and 'nsd_tau').
     :return: Combined dataframe.
     """
 
@@ -69,59 +125,53 @@ def create_dataframe(directory, dataset_folds, output, contrast):
     valid_filenames = ([f'{dataset_fold}_25_03_15_metrics.csv' for dataset_fold in dataset_folds] +
                        [f'{dataset_fold}_metrics.csv' for dataset_fold in dataset_folds])
 
-    # Iterate over each subject directory (in the BIDS structured data folder)
-    for file in os.listdir(directory):
-        subject_dir = os.path.join(directory, file, 'anat')
-        if not os.path.exists(subject_dir):
+    # Iterate over the tables of all subjects
+    for filename, source in get_metrics_tables(directory, store, settings):
+        # Check if the filename matches
+        if not any(contrast_name in filename for contrast_name in contrast):
             continue
 
-        # Iterate over each file in the subject directory
-        for filename in os.listdir(subject_dir):
-            # Check if the filename matches
-            if not any(contrast_name in filename for contrast_name in contrast):
-                continue
-
-            if not any(filename.endswith(valid_filename) for valid_filename in valid_filenames):
-                continue
-
-            # Skip UNIT1_neg data when contrast is UNIT1 (to not bias the results)
-            if "UNIT1_neg" in filename and contrast == ["UNIT1"]:
-                continue
-
-            elif contrast == ["T2w"] and (
-                    "UNIT1_neg" in filename or "UNIT1" in filename or
-                    "inv-1_part-mag_MP2RAGE" in filename or "inv-2_part-mag_MP2RAGE" in filename):
-                continue
-
-            # Extract subject, dataset, fold, and contrast information from filename
-            parts = filename.split('_')
-            subject = parts[0]
-            if 'T2wmodel' in filename and 'dseg' in filename:
-                dataset, fold, contrast_name = 'T2wmodel_dseg', '', 'T2w'
-            elif contrast == ["UNIT1_neg"]:
-                dataset = parts[-3]
-                fold = '_' + parts[-2]
-                contrast_name = 'UNIT1_neg'
-            else:
-                dataset = parts[-6]
-                fold = '_' + parts[-5]
+        if not any(filename.endswith(valid_filename) for valid_filename in valid_filenames):
+            continue
+
+        # Skip UNIT1_neg data when contrast is UNIT1 (to not bias the results)
+        if "UNIT1_neg" in filename and contrast == ["UNIT1"]:
+            continue
+
+        elif contrast == ["T2w"] and (
+                "UNIT1_neg" in filename or "UNIT1" in filename or
+                "inv-1_part-mag_MP2RAGE" in filename or "inv-2_part-mag_MP2RAGE" in filename):
+            continue
+
+        # Extract subject, dataset, fold, and contrast information from filename
+        parts = filename.split('_')
+        subject = parts[0]
+        if 'T2wmodel' in filename and 'dseg' in filename:
+            dataset, fold, contrast_name = 'T2wmodel_dseg', '', 'T2w'
+        elif contrast == ["UNIT1_neg"]:
+            dataset = parts[-3]
+            fold = '_' + parts[-2]
+            contrast_name = 'UNIT1_neg'
+        else:
+            dataset = parts[-6]
+            fold = '_' + parts[-5]
+            contrast_name = parts[1]
+            if parts[-5] == 'all':
+                fold = '_fold_all'
+                dataset = 'Dataset037'
                 contrast_name = parts[1]
-                if parts[-5] == 'all':
-                    fold = '_fold_all'
-                    dataset = 'Dataset037'
-                    contrast_name = parts[1]
-                if parts[2] == 'T2w' or parts[3] == 'T2w':
-                    contrast_name = 'T2w'
-
-            # Read the CSV and write the subject, dataset, fold, and contrast to the dataframe
-            df = pd.read_csv(os.path.join(subject_dir, filename))
-            df['subject'] = subject
-            df['dataset'] = dataset + fold
-            df['contrast'] = contrast_name.replace("-", "").upper()
-
-            # Append the dataframe and filename
-            dataframes.append(df)
-            file_names.append(filename)
+            if parts[2] == 'T2w' or parts[3] == 'T2w':
+                contrast_name = 'T2w'
+
+        # Read the CSV and write the subject, dataset, fold, and contrast to the dataframe
+        df = pd.read_csv(source) if isinstance(source, str) else source.copy()
+        df['subject'] = subject
+        df['dataset'] = dataset + fold
+        df['contrast'] = contrast_name.replace("-", "").upper()
+
+        # Append the dataframe and filename
+        dataframes.append(df)
+        file_names.append(filename)
 
     # Concatenate all dataframes
     combined_df = pd.concat(dataframes, ignore_index=True)
@@ -488,8 +538,15 @@ def main():
     analysed_contrast = args.contrast
     output = args.output
 
+    if directory is None and args.store is None:
+        parser.error('Either -i or -store is required.')
+    if not {'dsc', 'hd_perc'}.issubset(args.metrics):
+        parser.error('-metrics must include dsc and hd_perc (the Dice and HD95 are plotted).')
+    settings = {'metrics': args.metrics, 'nsd_tau': args.nsd_tau}
+
     # Create the combined dataframe
-    combined_dataframe, contrast = create_dataframe(directory, dataset_folds, output, analysed_contrast)
+    combined_dataframe, contrast = create_dataframe(directory, dataset_folds, output, analysed_contrast, args.store,
+                                                    settings)
 
     # Create the table with mean and standard deviation values
     create_mean_std_table(combined_dataframe, analysed_contrast, output)
@@ -1,16 +1,31 @@
 """
-This script computes segmentation metrics (Dice, ...) using the MetricsReloaded package for nnUNetv2 results and saves
-them as CSV files. One CSV file is generated for each GT-prediction pair.
-It is necessary to download the MetricsReloader package from https://github.com/ivadomed/MetricsReloaded.git 
-
-Usage: python get_statistics_dsc.py -i /path/to/data_processed -test-subjects sub-01 sub-02 sub-03 -metrics dsc
+This script computes segmentation metrics (Dice, HD95, ASSD, NSD) for each label of nnUNetv2 results and saves them as
+CSV files. One CSV file is generated for each GT-prediction pair, and the results of all pairs are aggregated into one
+table. The pairs are processed in a pool of processes (-jobs); each process caches the references it has loaded.
+With -store, the results are also saved in a SQLite store keyed by the content of the files and the metric settings,
+and only the new or changed pairs are computed when the script is re-run (e.g., after adding one new fold).
+The metrics are computed in-process (see utilities/surface_metrics.py) and the CSV files have the same columns as the
+files generated by compute_metrics_reloaded.py from the MetricsReloaded package
+(https://github.com/ivadomed/MetricsReloaded.git), which is no longer needed.
+
+Usage: python get_statistics_dsc.py -i /path/to/data_processed -test-subjects sub-01 sub-02 sub-03 -metrics dsc hd_perc
 """
 
 import argparse
 import os
 import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+import pandas as pd
+
+# Shared modules are located in the utilities folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from surface_metrics import METRICS_TO_NAME, compute_metrics_from_files
+from metrics_store import MetricsStore
+
 
 def parser():
     """
@@ -23,27 +38,38 @@ def parser():
     parser.add_argument('-i', required=True, help='Path to the data processed folder')
     parser.add_argument('-test-subjects', required=True, nargs='+', help='List of test subjects '
                                                                          '(e.g. sub-01 sub-02 sub-03)')
-    parser.add_argument('-metrics', required=False, nargs='+', help='List of metrics to compute. '
-                        'Default is DSC', default=['dsc'], choices=['dsc', 'hd'])
+    parser.add_argument('-metrics', required=False, nargs='+', help='List of metrics to compute: Dice (dsc), '
+                        'Hausdorff distance (hd), 95th percentile of the Hausdorff distance (hd_perc), average '
+                        'symmetric surface distance (assd), normalized surface distance (nsd).',
+                        default=['dsc', 'hd_perc', 'assd', 'nsd'], choices=list(METRICS_TO_NAME))
+    parser.add_argument('-nsd-tau', required=False, type=float, default=1.0,
+                        help='Tolerance (in mm) of the normalized surface distance.')
+    parser.add_argument('-jobs', required=False, type=int, default=os.cpu_count(),
+                        help='Number of parallel processes.')
+    parser.add_argument('-o', required=False,
+                        help='Path to the CSV file with the metrics of all pairs. Default: '
+                             '<input folder>/metrics_all_subjects.csv')
+    parser.add_argument('-store', required=False,
+                        help='Path to the SQLite metrics store (created if it does not exist). Only the pairs which are '
+                             'not in the store (or whose files or settings changed) are computed. Example: '
+                             'metrics.sqlite')
     return parser
 
 
-def compute_metrics(input_folder, subjects, metrics):
+def find_pairs(input_folder, subjects):
     """
-    This function computes metrics from results organised in BIDS and saves them as csv files.
+    This function finds the reference and the prediction files organised in BIDS.
     :param input_folder: input folder with BIDS structured data
-    :param subjects: selected subjects for which the metrics will be computed
-    :param metrics: selected metrics to compute
+    :param subjects: selected subjects
+    :return: list of (subject, reference, prediction) tuples, sorted by reference
     """
 
     # Regular expression to find files with predictions from exact dataset and fold
     pattern = re.compile(
         r'(Dataset\d{3}_fold\d|Dataset\d{3}_fold\d_\d{2}_\d{2}_\d{2}|Dataset\d{3}_fold_\d_\d{2}_\d{2}_\d{2}|Dataset\d{3}_fold_all_\d{2}_\d{2}_\d{2}|T2wmodel_dseg)\.nii\.gz$')
 
-    # Convert a list of metrics to string for MetricsReloader
-    metrics_str = ' '.join(metrics)
-
-    # Iterate over each subject and compute metrics
+    pairs = list()
+    # Iterate over each subject
     for subject in subjects:
         anat_path = Path(input_folder) / subject / "anat"
         if not anat_path.exists():
@@ -56,14 +82,95 @@ def compute_metrics(input_folder, subjects, metrics):
 
         # Find all prediction files that match the pattern and are not GT files
         predictions = [file for file in files if pattern.search(file.name) and not file.name.endswith("GT.nii.gz")]
+        pairs += [(subject, reference, pred) for pred in sorted(predictions)]
 
-        # Get metrics for each prediction file
-        for pred in predictions:
-            output_file = pred.with_name(pred.stem[:-4] + "_nmetrics.csv")
-            os.system(
-                f"python3 ~/PycharmProjects/MetricsReloaded/compute_metrics_reloaded.py "
-                f"-reference {reference} -prediction {pred} -metrics {metrics_str} -output {output_file}"
-            )
+    return pairs
+
+
+def get_output_file(pred):
+    """
+    Get the path to the csv file with the metrics of a prediction
+    :param pred: path to the prediction
+    :return: path to the csv file
+    """
+    return pred.with_name(pred.stem[:-4] + "_nmetrics.csv")
+
+
+def compute_pair(reference, pred, metrics, nsd_tau):
+    """
+    This function computes the metrics of one reference-prediction pair and saves them as csv file (run in a worker
+    process).
+    :param reference: path to the reference segmentation
+    :param pred: path to the prediction
+    :param metrics: selected metrics to compute
+    :param nsd_tau: tolerance (in mm) of the normalized surface distance
+    :return: pandas DataFrame with the metrics
+    """
+    df = compute_metrics_from_files(reference, pred, metrics, nsd_tau)
+    df.to_csv(get_output_file(pred), index=False)
+    return df
+
+
+def compute_metrics(input_folder, subjects, metrics, nsd_tau=1.0, jobs=1, fname_store=None):
+    """
+    This function computes metrics from results organised in BIDS and saves them as csv files.
+    :param input_folder: input folder with BIDS structured data
+    :param subjects: selected subjects for which the metrics will be computed
+    :param metrics: selected metrics to compute
+    :param nsd_tau: tolerance (in mm) of the normalized surface distance
+    :param jobs: number of parallel processes
+    :param fname_store: path to the SQLite metrics store; None to compute all pairs
+    :return: pandas DataFrame with the metrics of all pairs
+    """
+    pairs = find_pairs(input_folder, subjects)
+    if not pairs:
+        raise FileNotFoundError(f'No reference-prediction pair found in {input_folder} for {subjects}.')
+
+    list_of_df = list()
+    store = MetricsStore(fname_store) if fname_store else None
+    settings = {'metrics': metrics, 'nsd_tau': nsd_tau}
+    if store is not None:
+        # Reuse the results of the pairs already in the store
+        columns = ['reference', 'prediction', 'label'] + [METRICS_TO_NAME[metric] for metric in metrics] + \
+            ['EmptyRef', 'EmptyPred']
+        pairs_to_compute = list()
+        for subject, reference, pred in pairs:
+            df = store.get(reference, pred, settings)
+            if df is None:
+                pairs_to_compute.append((subject, reference, pred))
+                continue
+            df = df[columns]
+            if not get_output_file(pred).exists():
+                df.to_csv(get_output_file(pred), index=False)
+            df.insert(0, 'subject', subject)
+            list_of_df.append(df)
+        print(f'{len(pairs) - len(pairs_to_compute)} pairs found in the store {fname_store}.')
+        pairs = pairs_to_compute
+    print(f'Computing metrics for {len(pairs)} reference-prediction pairs with {jobs} processes...')
+
+    start = time.time()
+    # The pairs are submitted sorted by reference, so that the workers mostly reuse their cached reference
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(compute_pair, reference, pred, metrics, nsd_tau): (subject, pred, reference)
+                   for subject, reference, pred in pairs}
+        for i, future in enumerate(as_completed(futures), start=1):
+            subject, pred, reference = futures[future]
+            elapsed = time.time() - start
+            eta = elapsed / i * (len(pairs) - i)
+            try:
+                df = future.result()
+            except Exception as e:
+                print(f'[{i}/{len(pairs)}] ERROR: {pred.name}: {e}')
+                continue
+            if store is not None:
+                store.put(reference, pred, settings, df)
+            df.insert(0, 'subject', subject)
+            list_of_df.append(df)
+            print(f'[{i}/{len(pairs)}] {pred.name} ({elapsed:.0f} s elapsed, ETA {eta:.0f} s)')
+
+    if not list_of_df:
+        raise RuntimeError('The metrics could not be computed for any pair.')
+    return pd.concat(list_of_df, ignore_index=True).sort_values(['subject', 'prediction', 'label'])
 
 
 def main():
@@ -74,7 +181,12 @@ def main():
     metrics = args.metrics
 
     # Compute metrics for selected subjects and save them as csv files
-    compute_metrics(input_folder, subjects, metrics)
+    df = compute_metrics(input_folder, subjects, metrics, args.nsd_tau, args.jobs, args.store)
+
+    # Save the metrics of all pairs into one table
+    fname_out = args.o if args.o else os.path.join(input_folder, 'metrics_all_subjects.csv')
+    df.to_csv(fname_out, index=False)
+    print(f'Metrics of all pairs saved to {fname_out}')
 
 
 if __name__ == '__main__':
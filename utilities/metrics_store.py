@@ -0,0 +1,178 @@
+"""
+Incremental store of segmentation metrics (SQLite), so that re-running the metrics (e.g., after adding one new fold)
+only computes the new or changed reference-prediction pairs.
+
+The results of a pair are looked up by the SHA-256 hashes of the content of the reference and prediction files and by
+the metric settings (e.g., the metrics and the NSD tolerance): renaming or touching a file does not trigger a
+re-computation, while changing its content or the settings does. Each prediction path has one entry per settings,
+which is replaced when the pair is re-computed, so the store can be read directly as one table (see `load_all()`),
+e.g., by hc-leipzig-7t-mp2rage/dice-hd95-graph.py.
+
+Example:
+    store = MetricsStore('metrics.sqlite')
+    settings = {'metrics': ['dsc', 'hd_perc'], 'nsd_tau': 1.0}
+    df = store.get(fname_ref, fname_pred, settings)
+    if df is None:
+        df = compute_metrics_from_files(fname_ref, fname_pred, ['dsc', 'hd_perc'])
+        store.put(fname_ref, fname_pred, settings, df)
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+import pandas as pd
+
+
+@lru_cache(maxsize=None)
+def _hash_file(fname, mtime_ns, size):
+    sha256 = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_file(fname):
+    """
+    Get the SHA-256 hash of the content of a file; the hashes are cached (per process) as long as the modification time
+    and the size of the file do not change
+    :param fname: path to the file
+    :return: hexadecimal hash
+    """
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    return _hash_file(fname, stat.st_mtime_ns, stat.st_size)
+
+
+def results_to_json(df):
+    """
+    Serialize a table of results to JSON; unlike `df.to_json()`, which keeps 10 (at most 15) significant digits, the
+    floats are written with all their digits (and inf/NaN are kept), so a round trip is lossless
+    :param df: pandas DataFrame with the results
+    :return: JSON string
+    """
+    return json.dumps(df.to_dict(orient='split', index=False))
+
+
+def results_from_json(results):
+    """
+    Deserialize a table of results written by `results_to_json()`
+    :param results: JSON string
+    :return: pandas DataFrame with the results
+    """
+    results = json.loads(results)
+    return pd.DataFrame(results['data'], columns=results['columns'])
+
+
+def get_settings_key(settings):
+    """
+    Get the key of the metric settings
+    :param settings: dict with the settings (JSON serializable); the order of lists of metrics does not matter
+    :return: JSON string
+    """
+    return json.dumps({key: sorted(value) if isinstance(value, (list, tuple)) else value
+                       for key, value in settings.items()}, sort_keys=True)
+
+
+class MetricsStore:
+    """
+    SQLite store of the metrics of reference-prediction pairs
+    :param fname: path to the SQLite file; created if it does not exist
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                               'prediction TEXT NOT NULL, '
+                               'settings TEXT NOT NULL, '
+                               'reference TEXT NOT NULL, '
+                               'reference_hash TEXT NOT NULL, '
+                               'prediction_hash TEXT NOT NULL, '
+                               'results TEXT NOT NULL, '
+                               'created REAL NOT NULL, '
+                               'PRIMARY KEY (prediction, settings))')
+            connection.execute('CREATE INDEX IF NOT EXISTS metrics_hashes ON metrics '
+                               '(reference_hash, prediction_hash, settings)')
+
+    @contextmanager
+    def _connect(self):
+        # Commit (or roll back) the transaction and close the connection
+        connection = sqlite3.connect(self.fname, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, fname_ref, fname_pred, settings):
+        """
+        Get the stored results of a pair
+        :param fname_ref: path to the reference
+        :param fname_pred: path to the prediction
+        :param settings: dict with the metric settings
+        :return: pandas DataFrame with the results; None if the pair (with this content and settings) is not stored
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT prediction, results FROM metrics WHERE reference_hash = ? AND '
+                                     'prediction_hash = ? AND settings = ? LIMIT 1',
+                                     (hash_file(fname_ref), hash_file(fname_pred), get_settings_key(settings))
+                                     ).fetchone()
+        if row is None:
+            return None
+        df = results_from_json(row[1])
+        # The paths are the ones of the current pair
+        df['reference'] = str(fname_ref)
+        df['prediction'] = str(fname_pred)
+        # The same content was stored under another path (e.g., a renamed file); register the current path as well
+        if row[0] != os.path.abspath(fname_pred):
+            self.put(fname_ref, fname_pred, settings, df)
+        return df
+
+    def put(self, fname_ref, fname_pred, settings, df):
+        """
+        Store the results of a pair; replaces the previous results of the prediction with the same settings
+        :param fname_ref: path to the reference
+        :param fname_pred: path to the prediction
+        :param settings: dict with the metric settings
+        :param df: pandas DataFrame with the results
+        """
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (os.path.abspath(fname_pred), get_settings_key(settings), os.path.abspath(fname_ref),
+                                hash_file(fname_ref), hash_file(fname_pred), results_to_json(df),
+                                time.time()))
+
+    def load_all(self, settings=None):
+        """
+        Load the results of all stored pairs into one table
+        :param settings: dict with the metric settings to load; None to load the most recent results of each prediction
+        (all the loaded results must then have the same settings)
+        :return: pandas DataFrame with the results of all pairs (empty if the store is empty)
+        """
+        query = 'SELECT prediction, reference, results, settings FROM metrics'
+        parameters = tuple()
+        if settings is not None:
+            query += ' WHERE settings = ?'
+            parameters = (get_settings_key(settings),)
+        with self._connect() as connection:
+            rows = connection.execute(query + ' ORDER BY prediction, created', parameters).fetchall()
+        # Keep the last (i.e., the most recent) row of each prediction
+        rows = list({row[0]: row for row in rows}.values())
+        # Results computed with different settings (e.g., different metrics) cannot be combined into one table
+        settings_keys = sorted({row[3] for row in rows})
+        if len(settings_keys) > 1:
+            raise ValueError(f'The most recent results of the predictions have different metric settings: '
+                             f'{settings_keys}. Select the settings to load.')
+
+        list_of_df = list()
+        for fname_pred, fname_ref, results, _ in rows:
+            df = results_from_json(results)
+            df['reference'] = fname_ref
+            df['prediction'] = fname_pred
+            list_of_df.append(df)
+        return pd.concat(list_of_df, ignore_index=True) if list_of_df else pd.DataFrame()
@@ -0,0 +1,459 @@
+"""
+STAPLE (Simultaneous Truth And Performance Level Estimation, Warfield et al. 2004) of segmentations from several raters,
+computed with numpy and giving the same results as `sitk.STAPLE` (binary) and `sitk.MultiLabelSTAPLE` (multi-label,
+exact mode).
+
+The EM algorithm only depends on the vector of the raters' decisions at each voxel, so the voxels are grouped by their
+(unique) decision vector and the EM runs on these few patterns weighted by their number of voxels, instead of on the
+full field of view. The raters' masks are first cropped to their union bounding box; the voxels outside the box are
+background for all raters, so they are added analytically to the count of the all-background pattern.
+
+The multi-label STAPLE follows `itk::MultiLabelSTAPLEImageFilter` (prior, initialization from the majority vote, tie
+rule) and runs in one of two modes:
+    - exact (default): same float32 computations in the same order as ITK, so the labels are identical to
+      `sitk.MultiLabelSTAPLE`. The probabilities of the labels are computed per pattern, but ITK adds them voxel by
+      voxel in its voxel order in the M-step, and the float32 sums depend on the order of the additions. The voxels
+      outside the bounding box (label 0 for all raters) are interleaved with the voxels of the box in this order, so
+      all the voxels of the field of view are listed for the sums of label 0: the M-step costs as much as in ITK.
+    - fast (exact=False): the EM runs on the patterns only, in float64, with the voxels outside the bounding box as one
+      weighted all-zero pattern; much faster, but a few voxels close to a tie between two labels can differ from ITK.
+
+Example:
+    # Binary STAPLE of one spinal level
+    probabilities, sensitivity, specificity = staple([data == level for data in segmentations])
+    # Multi-label STAPLE of all the levels at once
+    data_staple = multi_label_staple(segmentations)
+    data_staple = multi_label_staple(segmentations, exact=False)
+"""
+
+import numpy as np
+
+from bbox import get_bbox, uncrop
+
+# Convergence thresholds of the SimpleITK filters (maximum change of the raters' performance between two iterations)
+CONVERGENCE_THRESHOLD = 1e-7
+MULTI_LABEL_CONVERGENCE_THRESHOLD = 1e-5
+# Initial sensitivity and specificity of the raters (only used for the first convergence check)
+INITIAL_PERFORMANCE = 0.99999
+# Counts accumulated in float32 (as in ITK) stop increasing at 2**24
+FLOAT32_MAX_COUNT = 2 ** 24
+# Number of voxels processed at once by the M-step of the multi-label STAPLE (bounds the memory use)
+CHUNK_SIZE = 2 ** 20
+
+
+def get_patterns(arrays, shape):
+    """
+    Group the voxels by the vector of values of the arrays (e.g., the raters' decisions), within the union bounding box
+    of the arrays; the voxels outside the box (zero in all arrays) are counted in the all-zero pattern
+    :param arrays: list of arrays of the same shape (one per rater)
+    :param shape: shape of the arrays
+    :return: patterns: 2D array (number of patterns, number of arrays) with the unique vectors of values
+    :return: counts: 1D int64 array with the number of voxels of each pattern
+    :return: inverse: 1D array mapping each voxel of the bounding box (flattened) to its pattern; None if all arrays
+    are empty
+    :return: bbox: tuple of slices returned by `get_bbox()`; None if all arrays are empty
+    """
+    n_voxels = int(np.prod(shape))
+    bbox = get_bbox(*arrays)
+    if bbox is None:
+        return np.zeros((1, len(arrays)), dtype=arrays[0].dtype), np.array([n_voxels]), None, None
+
+    values = [data[bbox].ravel() for data in arrays]
+    patterns, inverse, counts = get_unique_vectors(values)
+
+    # Voxels outside the bounding box
+    n_outside = n_voxels - len(inverse)
+    if n_outside:
+        background = np.flatnonzero(~patterns.any(axis=1))
+        if len(background):
+            counts[background[0]] += n_outside
+        else:
+            patterns = np.concatenate([patterns, np.zeros((1, len(arrays)), dtype=patterns.dtype)])
+            counts = np.append(counts, n_outside)
+
+    return patterns, counts.astype(np.int64), inverse, bbox
+
+
+def get_unique_vectors(values):
+    """
+    Get the unique vectors of values of the voxels, as `np.unique(np.stack(values, axis=1), axis=0)` but much faster:
+    the values of each voxel are encoded into one integer (mixed radix, e.g., the bits of the raters' binary decisions),
+    and the codes are counted with `np.bincount()` (or sorted with a 1D `np.unique()` if there are more possible codes
+    than voxels)
+    :param values: list of 1D arrays of the same length (one per rater)
+    :return: patterns: 2D array (number of patterns, number of arrays) with the unique vectors of values, sorted
+    lexicographically
+    :return: inverse: 1D array mapping each voxel to its pattern
+    :return: counts: 1D array with the number of voxels of each pattern
+    """
+    base = int(max(data.max() for data in values)) + 1
+    if values[0].dtype.kind not in 'bui' or min(data.min() for data in values) < 0 or \
+            len(values) * np.log2(base) >= 63:
+        patterns, inverse, counts = np.unique(np.stack(values, axis=1), axis=0, return_inverse=True,
+                                              return_counts=True)
+        return patterns, inverse.ravel(), counts
+
+    # The first array is the most significant digit, so the codes are sorted as the vectors
+    codes = np.zeros(len(values[0]), dtype=np.int64)
+    for data in values:
+        codes *= base
+        codes += data
+    n_codes = base ** len(values)
+    if n_codes <= len(codes):
+        counts = np.bincount(codes, minlength=n_codes)
+        unique_codes = np.flatnonzero(counts)
+        lookup = np.zeros(n_codes, dtype=np.intp)
+        lookup[unique_codes] = np.arange(len(unique_codes))
+        inverse, counts = lookup[codes], counts[unique_codes]
+    else:
+        unique_codes, inverse, counts = np.unique(codes, return_inverse=True, return_counts=True)
+
+    patterns = np.stack([unique_codes // base ** digit % base for digit in range(len(values) - 1, -1, -1)], axis=1)
+    return patterns.astype(values[0].dtype), inverse, counts
+
+
+def get_posterior(patterns, prior, sensitivity, specificity):
+    """
+    Get the probability of the foreground of each decision pattern given the performance of the raters (E-step of
+    STAPLE)
+    :param patterns: 2D boolean array (number of patterns, number of raters)
+    :param prior: prior probability of the foreground
+    :param sensitivity: 1D array with the sensitivity of each rater
+    :param specificity: 1D array with the specificity of each rater
+    :return: 1D array with the probability of the foreground of each pattern
+    """
+    alpha = prior * np.prod(np.where(patterns, sensitivity, 1 - sensitivity), axis=1)
+    beta = (1 - prior) * np.prod(np.where(patterns, 1 - specificity, specificity), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return alpha / (alpha + beta)
+
+
+def staple_patterns(patterns, counts, confidence_weight=1.0, max_iterations=None,
+                    convergence_threshold=CONVERGENCE_THRESHOLD):
+    """
+    Binary STAPLE on the decision patterns (see `get_patterns()`), as in `itk::STAPLEImageFilter`
+    :param patterns: 2D boolean array (number of patterns, number of raters)
+    :param counts: 1D array with the number of voxels of each pattern
+    :param confidence_weight: weight of the prior probability of the foreground
+    :param max_iterations: maximum number of EM iterations; None for no limit
+    :param convergence_threshold: the EM stops when the sensitivity and specificity of all raters change by less
+    :return: probabilities: 1D array with the probability of the foreground of each pattern
+    :return: sensitivity: 1D array with the sensitivity of each rater
+    :return: specificity: 1D array with the specificity of each rater
+    :return: iterations: number of EM iterations
+    """
+    patterns = patterns.astype(bool)
+    counts = counts.astype(float)
+    n_raters = patterns.shape[1]
+
+    # Initial probabilities: average of the raters; prior of the foreground: average over all voxels
+    probabilities = patterns.mean(axis=1)
+    prior = confidence_weight * np.dot(counts, probabilities) / counts.sum()
+
+    sensitivity = np.full(n_raters, INITIAL_PERFORMANCE)
+    specificity = np.full(n_raters, INITIAL_PERFORMANCE)
+    iterations = 0
+    while max_iterations is None or iterations < max_iterations:
+        sensitivity_previous, specificity_previous = sensitivity, specificity
+        # M-step: performance of the raters
+        weights_fg = counts * probabilities
+        weights_bg = counts * (1 - probabilities)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sensitivity = weights_fg @ patterns / weights_fg.sum()
+            specificity = weights_bg @ ~patterns / weights_bg.sum()
+        # E-step: probabilities of the foreground
+        probabilities = get_posterior(patterns, prior, sensitivity, specificity)
+        iterations += 1
+
+        if np.all(np.abs(sensitivity - sensitivity_previous) <= convergence_threshold) and \
+                np.all(np.abs(specificity - specificity_previous) <= convergence_threshold):
+            break
+        # The performance is undefined (NaN) if the masks are all empty or all full; the EM cannot converge then
+        if np.isnan(sensitivity).any() or np.isnan(specificity).any():
+            break
+
+    return probabilities, sensitivity, specificity, iterations
+
+
+def staple(masks, confidence_weight=1.0, max_iterations=None, convergence_threshold=CONVERGENCE_THRESHOLD,
+           cropped=False):
+    """
+    Binary STAPLE of the raters' masks (same results as `sitk.STAPLE(masks, 1)`)
+    :param masks: list of binary arrays of the same shape (one per rater)
+    :param confidence_weight: weight of the prior probability of the foreground
+    :param max_iterations: maximum number of EM iterations; None for no limit
+    :param convergence_threshold: the EM stops when the sensitivity and specificity of all raters change by less
+    :param cropped: if True, return the probabilities within the union bounding box of the masks only (see below)
+    :return: probabilities: float32 array with the probability of the foreground of each voxel (of the shape of the
+    masks, or of the bounding box if cropped=True)
+    :return: sensitivity: 1D array with the sensitivity of each rater
+    :return: specificity: 1D array with the specificity of each rater
+    :return: (only if cropped=True) bbox: tuple of slices of the bounding box; None if all masks are empty (then the
+    probabilities are None)
+    :return: (only if cropped=True) probability_outside: probability of the voxels outside the bounding box
+    """
+    shape = masks[0].shape
+    patterns, counts, inverse, bbox = get_patterns([mask.astype(bool, copy=False) for mask in masks], shape)
+    probabilities, sensitivity, specificity, _ = staple_patterns(patterns, counts, confidence_weight, max_iterations,
+                                                                 convergence_threshold)
+    probabilities_bbox, probability_outside = patterns_to_bbox(probabilities.astype(np.float32), patterns, inverse,
+                                                               bbox)
+    if cropped:
+        return probabilities_bbox, sensitivity, specificity, bbox, probability_outside
+    if bbox is None:
+        return np.full(shape, probability_outside, dtype=np.float32), sensitivity, specificity
+    return uncrop(probabilities_bbox, bbox, shape, fill_value=probability_outside), sensitivity, specificity
+
+
+def patterns_to_bbox(values, patterns, inverse, bbox):
+    """
+    Map values of the patterns (see `get_patterns()`) back to the voxels of the bounding box
+    :param values: 1D array with one value per pattern
+    :param patterns: 2D array (number of patterns, number of raters)
+    :param inverse: 1D array mapping each voxel of the bounding box to its pattern; None if all masks are empty
+    :param bbox: tuple of slices of the bounding box; None if all masks are empty
+    :return: values_bbox: array of the shape of the bounding box; None if bbox is None
+    :return: value_outside: value of the voxels outside the bounding box (i.e., of the all-zero pattern); 0 if the
+    bounding box is the whole volume
+    """
+    background = np.flatnonzero(~patterns.any(axis=1))
+    value_outside = values[background[0]] if len(background) else values.dtype.type(0)
+    if bbox is None:
+        return None, value_outside
+    return values[inverse].reshape(tuple(s.stop - s.start for s in bbox)), value_outside
+
+
+def get_votes(patterns, n_labels):
+    """
+    Get the number of votes for each label
+    :param patterns: 2D int array (number of patterns, number of raters) with the labels of the raters
+    :param n_labels: number of labels (max label + 1)
+    :return: 2D array (number of patterns, number of labels)
+    """
+    votes = np.zeros((len(patterns), n_labels))
+    for rater_labels in patterns.T:
+        votes[np.arange(len(patterns)), rater_labels] += 1
+    return votes
+
+
+def get_winning_labels(weights, undecided_label):
+    """
+    Get the label with the highest weight, as in ITK: the labels are scanned in increasing order and a weight that is
+    not lower than the highest weight so far gives the undecided label (until a higher weight is found)
+    :param weights: 2D array (number of patterns, number of labels)
+    :param undecided_label: label of the ties
+    :return: 1D int array with the winning label of each pattern
+    """
+    winning_labels = np.full(len(weights), undecided_label, dtype=np.intp)
+    winning_weights = np.zeros(len(weights), dtype=weights.dtype)
+    for label, label_weights in enumerate(weights.T):
+        higher = label_weights > winning_weights
+        not_lower = ~higher & ~(label_weights < winning_weights)
+        winning_labels[higher] = label
+        winning_weights[higher] = label_weights[higher]
+        winning_labels[not_lower] = undecided_label
+    return winning_labels
+
+
+def count_float32(counts):
+    """
+    Counts accumulated by increments of a float32 (as in ITK), which stop increasing at 2**24
+    :param counts: array of ints
+    :return: float32 array
+    """
+    return np.minimum(counts, FLOAT32_MAX_COUNT).astype(np.float32)
+
+
+def sum_sequentially(values, axis):
+    """
+    Sum of values added one after the other (as in ITK); unlike `np.sum()`, which adds pairwise, `np.cumsum()` adds
+    sequentially, so the float32 rounding is the same as in ITK
+    :param values: float array
+    :param axis: axis of the sum
+    :return: array of the dtype of values
+    """
+    return np.take(np.cumsum(values, axis=axis), -1, axis=axis)
+
+
+def get_prior_probabilities(patterns, counts, n_labels):
+    """
+    Prior probability of each label: frequency of the labels of all raters
+    :param patterns: 2D int array (number of patterns, number of raters)
+    :param counts: 1D array with the number of voxels of each pattern
+    :param n_labels: number of labels
+    :return: 1D float32 array
+    """
+    prior_probabilities = count_float32(get_votes(patterns, n_labels).T @ counts)
+    return prior_probabilities / sum_sequentially(prior_probabilities, axis=0)
+
+
+def get_initial_confusion_matrices(patterns, counts, n_labels):
+    """
+    Initial confusion matrices of the raters (observed label x true label) from the majority vote, as in ITK: the rows
+    of the matrices are normalized, and the voxels without majority (undecided true label, i.e., n_labels) are counted
+    in the first column of the next row, as the (n_labels + 1) x n_labels matrices are stored row by row
+    :param patterns: 2D int array (number of patterns, number of raters)
+    :param counts: 1D array with the number of voxels of each pattern
+    :param n_labels: number of labels
+    :return: 3D float32 array (number of raters, number of labels + 1, number of labels)
+    """
+    voting = get_winning_labels(get_votes(patterns, n_labels), n_labels)
+    confusion_matrices = np.zeros((patterns.shape[1], (n_labels + 1) * n_labels), dtype=np.int64)
+    for rater_labels, matrix in zip(patterns.T, confusion_matrices):
+        np.add.at(matrix, rater_labels * n_labels + voting, counts)
+    confusion_matrices = count_float32(confusion_matrices).reshape(-1, n_labels + 1, n_labels)
+    sums = sum_sequentially(confusion_matrices, axis=2)[:, :, np.newaxis]
+    return np.divide(confusion_matrices, sums, out=confusion_matrices, where=sums != 0)
+
+
+def get_label_weights(patterns, prior_probabilities, confusion_matrices, normalize=True):
+    """
+    Get the probability of each label of each pattern given the confusion matrices of the raters (E-step of the
+    multi-label STAPLE), in the order of the operations of ITK
+    :param patterns: 2D int array (number of patterns, number of raters)
+    :param prior_probabilities: 1D float array with the prior probability of each label
+    :param confusion_matrices: 3D float array (number of raters, number of labels + 1, number of labels), of the same
+    dtype as prior_probabilities
+    :param normalize: if False, return the unnormalized weights (used for the final labels)
+    :return: 2D float array (number of patterns, number of labels)
+    """
+    weights = np.tile(prior_probabilities, (len(patterns), 1))
+    for rater_labels, matrix in zip(patterns.T, confusion_matrices):
+        weights *= matrix[rater_labels]
+    if normalize:
+        sums = sum_sequentially(weights, axis=1)[:, np.newaxis]
+        np.divide(weights, sums, out=weights, where=sums != 0)
+    return weights
+
+
+def sort_voxels_by_label(index, labels, n_labels):
+    """
+    Group the voxels by the label given by one rater, keeping the order of the voxels within each label
+    :param index: 1D int32 array with the pattern of each voxel (flattened)
+    :param labels: 1D int array with the label of each voxel given by the rater (flattened)
+    :param n_labels: number of labels
+    :return: index_sorted: 1D int32 array with the pattern of each voxel, grouped by label
+    :return: stops: 1D array with the end of the group of each label in index_sorted
+    """
+    order = np.argsort(labels, kind='stable')
+    return index[order], np.cumsum(np.bincount(labels, minlength=n_labels))
+
+
+def accumulate_label_weights(weights, index_sorted, stops, chunk_size=CHUNK_SIZE):
+    """
+    Sum the probabilities of the labels of the voxels observed with each label by one rater (M-step of the multi-label
+    STAPLE). The float32 sums depend on the order of the additions, so the voxels of each label are added one after the
+    other in their order, as in ITK, by chunks of voxels.
+    :param weights: 2D float32 array (number of patterns, number of labels)
+    :param index_sorted: 1D int32 array with the pattern of each voxel, grouped by label (see `sort_voxels_by_label()`)
+    :param stops: 1D array with the end of the group of each label in index_sorted
+    :param chunk_size: number of voxels of the chunks
+    :return: 2D float32 array (number of labels + 1, number of labels)
+    """
+    n_labels = weights.shape[1]
+    sums = np.zeros((n_labels + 1, n_labels), dtype=np.float32)
+    starts = np.concatenate([[0], stops[:-1]])
+    # One row per label, so that the sums over the voxels are along the contiguous axis
+    weights = np.ascontiguousarray(weights.T)
+    for chunk_start in range(0, len(index_sorted), chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, len(index_sorted))
+        weights_chunk = np.take(weights, index_sorted[chunk_start:chunk_stop], axis=1)
+        for label in np.flatnonzero((starts < chunk_stop) & (stops > chunk_start) & (stops > starts)):
+            segment = weights_chunk[:, max(starts[label], chunk_start) - chunk_start:
+                                    min(stops[label], chunk_stop) - chunk_start]
+            # Continue the sum of the previous chunks: (sum + w1) + w2 + ...
+            segment[:, 0] += sums[label]
+            sums[label] = np.cumsum(segment, axis=1)[:, -1]
+    return sums
+
+
+def multi_label_staple_patterns(patterns, counts, index=None, segmentations=None, prior_probabilities=None,
+                                max_iterations=None, convergence_threshold=MULTI_LABEL_CONVERGENCE_THRESHOLD):
+    """
+    Multi-label STAPLE on the label patterns (see `get_patterns()`), as in `itk::MultiLabelSTAPLEImageFilter`: the
+    performance of each rater is a confusion matrix (observed label x true label), initialized from the majority vote.
+    With the voxels (index and segmentations), the float32 computations of ITK are reproduced in the same order (exact
+    mode); without them, the EM runs on the patterns weighted by their number of voxels, in float64 (fast mode).
+    :param patterns: 2D int array (number of patterns, number of raters)
+    :param counts: 1D array with the number of voxels of each pattern
+    :param index: 1D int32 array with the pattern of each voxel of the field of view (flattened in the voxel order of
+    ITK); None for the fast mode
+    :param segmentations: list of 1D int arrays with the labels of each voxel (flattened; one per rater); None for the
+    fast mode
+    :param prior_probabilities: prior probability of each label; None to use the frequency of the labels of all raters
+    :param max_iterations: maximum number of EM iterations; None for no limit
+    :param convergence_threshold: the EM stops when all the confusion matrices change by less
+    :return: weights: 2D float array (number of patterns, number of labels) with the (unnormalized) probability of each
+    label
+    :return: confusion_matrices: 3D float array (number of raters, number of labels + 1, number of labels)
+    :return: iterations: number of EM iterations
+    """
+    patterns = patterns.astype(np.intp)
+    n_labels = int(patterns.max()) + 1
+
+    if prior_probabilities is None:
+        prior_probabilities = get_prior_probabilities(patterns, counts, n_labels)
+    exact = index is not None
+    dtype = np.float32 if exact else np.float64
+    prior_probabilities = np.asarray(prior_probabilities, dtype=dtype)[:n_labels]
+    confusion_matrices = get_initial_confusion_matrices(patterns, counts, n_labels).astype(dtype)
+    if exact:
+        voxels_by_label = [sort_voxels_by_label(index, data, n_labels) for data in segmentations]
+
+    iterations = 0
+    while max_iterations is None or iterations < max_iterations:
+        # E-step: probability of each label; M-step: confusion matrices (columns normalized)
+        weights = get_label_weights(patterns, prior_probabilities, confusion_matrices)
+        if exact:
+            updated = np.array([accumulate_label_weights(weights, index_sorted, stops)
+                                for index_sorted, stops in voxels_by_label])
+        else:
+            updated = np.zeros_like(confusion_matrices)
+            for rater_labels, matrix in zip(patterns.T, updated):
+                np.add.at(matrix, rater_labels, counts[:, np.newaxis] * weights)
+        sums = sum_sequentially(updated, axis=1)[:, np.newaxis, :]
+        np.divide(updated, sums, out=updated, where=sums != 0)
+        maximum_update = np.abs(updated - confusion_matrices).max()
+        confusion_matrices = updated
+        iterations += 1
+
+        if maximum_update < dtype(convergence_threshold):
+            break
+
+    weights = get_label_weights(patterns, prior_probabilities, confusion_matrices, normalize=False)
+    return weights, confusion_matrices, iterations
+
+
+def multi_label_staple(segmentations, undecided_label=255, prior_probabilities=None, max_iterations=None,
+                       convergence_threshold=MULTI_LABEL_CONVERGENCE_THRESHOLD, exact=True):
+    """
+    Multi-label STAPLE of the raters' segmentations in one call: all the labels (e.g., spinal levels) are estimated at
+    once, so each voxel gets exactly one label
+    :param segmentations: list of int arrays of the same shape (one per rater) with non-negative labels
+    :param undecided_label: label of the voxels with several most probable labels
+    :param prior_probabilities: prior probability of each label; None to use the frequency of the labels of all raters
+    :param max_iterations: maximum number of EM iterations; None for no limit
+    :param convergence_threshold: the EM stops when all the confusion matrices change by less
+    :param exact: if True, same results as `sitk.MultiLabelSTAPLE` if the arrays are in the voxel order of ITK (e.g.,
+    from `sitk.GetArrayFromImage()`), at the cost of going through all the voxels of the field of view at each
+    iteration; if False, the EM runs on the patterns of the bounding box only (see the module docstring)
+    :return: uint8 array with the labels
+    """
+    shape = segmentations[0].shape
+    patterns, counts, inverse, bbox = get_patterns(segmentations, shape)
+    if bbox is None:
+        return np.zeros(shape, dtype=np.uint8)
+
+    index, voxel_segmentations = None, None
+    if exact:
+        # Pattern of each voxel of the whole volume, as ITK adds the voxels outside the bounding box (all-zero pattern)
+        # in between the voxels of the box
+        background = np.flatnonzero(~patterns.any(axis=1))
+        index = uncrop(inverse.astype(np.int32).reshape(tuple(s.stop - s.start for s in bbox)), bbox, shape,
+                       fill_value=background[0] if len(background) else 0).ravel()
+        voxel_segmentations = [np.ravel(data) for data in segmentations]
+    weights, _, _ = multi_label_staple_patterns(patterns, counts, index, voxel_segmentations, prior_probabilities,
+                                                max_iterations, convergence_threshold)
+    labels_bbox, label_outside = patterns_to_bbox(get_winning_labels(weights, undecided_label).astype(np.uint8),
+                                                  patterns, inverse, bbox)
+    return uncrop(labels_bbox, bbox, shape, fill_value=label_outside)
@@ -0,0 +1,195 @@
+"""
+Segmentation metrics computed in-process for each label (spinal level), replacing the calls of
+`compute_metrics_reloaded.py` from [MetricsReloaded](https://github.com/ivadomed/MetricsReloaded):
+    - Dice similarity coefficient
+    - Hausdorff distance and its 95th percentile (HD95)
+    - average symmetric surface distance (ASSD)
+    - normalized surface distance (NSD) with a tolerance in mm
+
+The surfaces are the border voxels of the masks (the mask minus its erosion) and the distances are computed with
+Euclidean distance transforms taking the (anisotropic) voxel size into account. Both are limited to the bounding box
+of the reference and prediction masks of each label, which is exact since all border voxels are inside the box.
+
+The output table has the same columns as the CSV files of MetricsReloaded (reference, prediction, label, one column per
+metric, EmptyRef, EmptyPred), so the downstream scripts (e.g., hc-leipzig-7t-mp2rage/dice-hd95-graph.py) can read
+both.
+
+The reference segmentations are cached (per process), so that many predictions of the same subject (e.g., folds and
+contrasts) are compared against a reference loaded once.
+
+Example:
+    df = compute_metrics_from_files('sub-01_T2w_GT.nii.gz', 'sub-01_T2w_fold0.nii.gz', ['dsc', 'hd_perc'])
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy.ndimage import binary_erosion, distance_transform_edt
+
+from bbox import get_bbox, crop_to_bbox
+
+# Metric names (as in MetricsReloaded) and the corresponding columns of the output table
+METRICS_TO_NAME = {
+    'dsc': 'DiceSimilarityCoefficient',
+    'hd': 'HausdorffDistance',
+    'hd_perc': 'HausdorffDistance95',
+    'assd': 'AverageSymmetricSurfaceDistance',
+    'nsd': 'NormalizedSurfaceDistance',
+}
+SURFACE_METRICS = ['hd', 'hd_perc', 'assd', 'nsd']
+
+
+def get_border(mask):
+    """
+    Get the border voxels of a binary mask, i.e., the voxels of the mask with at least one 6-connected neighbour
+    outside the mask
+    :param mask: 3D boolean array
+    :return: 3D boolean array with the border voxels
+    """
+    return mask & ~binary_erosion(mask)
+
+
+def get_surface_distances(mask_ref, mask_pred, spacing):
+    """
+    Get the distances (in mm) from the border voxels of each mask to the border of the other mask
+    :param mask_ref: 3D boolean array with the reference mask (not empty)
+    :param mask_pred: 3D boolean array with the predicted mask (not empty)
+    :param spacing: voxel size in mm
+    :return: distances_pred_to_ref: 1D array, one distance per border voxel of the prediction
+    :return: distances_ref_to_pred: 1D array, one distance per border voxel of the reference
+    """
+    # Both masks are cropped to their union bounding box
+    bbox = get_bbox(mask_ref, mask_pred)
+    mask_ref, mask_pred = crop_to_bbox(bbox, mask_ref, mask_pred)
+    border_ref = get_border(mask_ref)
+    border_pred = get_border(mask_pred)
+
+    distances_pred_to_ref = distance_transform_edt(~border_ref, sampling=spacing)[border_pred]
+    distances_ref_to_pred = distance_transform_edt(~border_pred, sampling=spacing)[border_ref]
+
+    return distances_pred_to_ref, distances_ref_to_pred
+
+
+def compute_label_metrics(mask_ref, mask_pred, spacing, metrics, nsd_tau=1.0):
+    """
+    Compute the metrics of one label
+    :param mask_ref: 3D boolean array with the reference mask
+    :param mask_pred: 3D boolean array with the predicted mask
+    :param spacing: voxel size in mm
+    :param metrics: list of metrics (keys of METRICS_TO_NAME)
+    :param nsd_tau: tolerance (in mm) of the normalized surface distance
+    :return: dict {column name: value}; as in MetricsReloaded, Dice and NSD are 1 and the distances 0 if both masks are
+    empty, and Dice and NSD are 0 and the distances NaN if only one mask is empty
+    """
+    n_ref = np.count_nonzero(mask_ref)
+    n_pred = np.count_nonzero(mask_pred)
+    empty_ref, empty_pred = n_ref == 0, n_pred == 0
+
+    values = dict()
+    if 'dsc' in metrics:
+        values['dsc'] = 1.0 if empty_ref and empty_pred else \
+            2 * np.count_nonzero(mask_ref & mask_pred) / (n_ref + n_pred)
+
+    surface_metrics = [metric for metric in metrics if metric in SURFACE_METRICS]
+    if surface_metrics:
+        if empty_ref and empty_pred:
+            values.update({metric: 1.0 if metric == 'nsd' else 0.0 for metric in surface_metrics})
+        elif empty_ref or empty_pred:
+            values.update({metric: 0.0 if metric == 'nsd' else np.nan for metric in surface_metrics})
+        else:
+            distances_pred_to_ref, distances_ref_to_pred = get_surface_distances(mask_ref, mask_pred, spacing)
+            n_border = len(distances_pred_to_ref) + len(distances_ref_to_pred)
+            if 'hd' in metrics:
+                values['hd'] = max(distances_pred_to_ref.max(), distances_ref_to_pred.max())
+            if 'hd_perc' in metrics:
+                values['hd_perc'] = max(np.percentile(distances_pred_to_ref, 95),
+                                        np.percentile(distances_ref_to_pred, 95))
+            if 'assd' in metrics:
+                values['assd'] = (distances_pred_to_ref.sum() + distances_ref_to_pred.sum()) / n_border
+            if 'nsd' in metrics:
+                values['nsd'] = (np.count_nonzero(distances_pred_to_ref <= nsd_tau) +
+                                 np.count_nonzero(distances_ref_to_pred <= nsd_tau)) / n_border
+
+    result = {METRICS_TO_NAME[metric]: float(values[metric]) for metric in metrics}
+    result.update({'EmptyRef': bool(empty_ref), 'EmptyPred': bool(empty_pred)})
+    return result
+
+
+def compute_metrics(data_ref, data_pred, spacing, metrics, nsd_tau=1.0):
+    """
+    Compute the metrics of each label present in the reference or the prediction
+    :param data_ref: 3D array with the reference labels
+    :param data_pred: 3D array with the predicted labels
+    :param spacing: voxel size in mm
+    :param metrics: list of metrics (keys of METRICS_TO_NAME)
+    :param nsd_tau: tolerance (in mm) of the normalized surface distance
+    :return: list of dicts (one per label) with the label and the metrics
+    """
+    if data_ref.shape != data_pred.shape:
+        raise ValueError(f'The reference (shape {data_ref.shape}) and the prediction (shape {data_pred.shape}) must '
+                         f'be in the same space.')
+    unknown_metrics = set(metrics) - set(METRICS_TO_NAME)
+    if unknown_metrics:
+        raise ValueError(f'Unknown metrics: {sorted(unknown_metrics)}. Choose from {list(METRICS_TO_NAME)}.')
+
+    # All labels are inside the union bounding box of the reference and the prediction
+    bbox = get_bbox(data_ref, data_pred)
+    if bbox is None:
+        return list()
+    data_ref, data_pred = crop_to_bbox(bbox, data_ref, data_pred)
+
+    labels = np.union1d(np.unique(data_ref), np.unique(data_pred))
+    results = list()
+    for label in labels[labels > 0]:
+        results.append({'label': int(label) if float(label).is_integer() else float(label),
+                        **compute_label_metrics(data_ref == label, data_pred == label, spacing, metrics, nsd_tau)})
+    return results
+
+
+def load_segmentation(fname):
+    """
+    Load a segmentation
+    :param fname: path to the segmentation
+    :return: data: 3D int16 array with the labels
+    :return: affine: 4x4 affine of the image
+    :return: spacing: voxel size in mm
+    """
+    nii = nib.load(fname)
+    data = np.round(np.asanyarray(nii.dataobj)).astype(np.int16)
+    return data, nii.affine, tuple(float(z) for z in nii.header.get_zooms()[:3])
+
+
+@lru_cache(maxsize=4)
+def load_reference(fname):
+    """
+    Load a reference segmentation; cached, so the array is read-only since it is shared between the calls
+    :param fname: path to the reference segmentation (str)
+    :return: same as `load_segmentation()`
+    """
+    data, affine, spacing = load_segmentation(fname)
+    data.flags.writeable = False
+    return data, affine, spacing
+
+
+def compute_metrics_from_files(fname_ref, fname_pred, metrics, nsd_tau=1.0):
+    """
+    Compute the metrics of each label of a prediction
+    :param fname_ref: path to the reference segmentation
+    :param fname_pred: path to the predicted segmentation
+    :param metrics: list of metrics (keys of METRICS_TO_NAME)
+    :param nsd_tau: tolerance (in mm) of the normalized surface distance
+    :return: pandas DataFrame with the columns reference, prediction, label, <metrics>, EmptyRef, EmptyPred
+    """
+    data_ref, affine_ref, spacing = load_reference(str(fname_ref))
+    data_pred, affine_pred, _ = load_segmentation(fname_pred)
+    if not np.allclose(affine_ref, affine_pred, atol=1e-3):
+        print(f'WARNING: The affines of {fname_ref} and {fname_pred} differ.')
+
+    results = compute_metrics(data_ref, data_pred, spacing, metrics, nsd_tau)
+    df = pd.DataFrame(results, columns=['label'] + [METRICS_TO_NAME[metric] for metric in metrics] +
+                      ['EmptyRef', 'EmptyPred'])
+    df.insert(0, 'reference', str(fname_ref))
+    df.insert(1, 'prediction', str(fname_pred))
+    return df